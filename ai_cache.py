@@ -0,0 +1,103 @@
+import asyncio
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt):
+    """
+    Convierte la pregunta en una clave: sin mayúsculas, tildes, signos ni espacios de más.
+    "¿Cuántas dominadas?" y "cuantas dominadas" acaban en la misma entrada.
+    """
+    text = unicodedata.normalize("NFKD", prompt.casefold())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+class ResponseCache:
+    """
+    Caché LRU con caducidad para las respuestas de la IA.
+    Si llega la misma pregunta mientras otra igual está en camino, se espera a esa
+    en lugar de hacer una segunda llamada.
+    """
+
+    def __init__(self, max_size=500, ttl=21600):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()  # clave -> (caduca_en, respuesta)
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put(self, key, value):
+        self._entries[key] = (time.monotonic() + self._ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_compute(self, prompt, factory):
+        """Devuelve la respuesta cacheada o llama a `factory()` una sola vez por pregunta."""
+        key = normalize_prompt(prompt)
+        cached = self._get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await factory()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Evita el aviso de "exception was never retrieved" si nadie esperaba
+            raise
+        else:
+            self._put(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self._inflight[key]
+
+    def purge(self):
+        purged = len(self._entries)
+        self._entries.clear()
+        return purged
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
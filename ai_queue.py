@@ -0,0 +1,149 @@
+import asyncio
+import random
+import time
+
+# Errores de OpenAI que merece la pena reintentar (límites, caídas puntuales).
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {"APIConnectionError", "APITimeoutError"}
+
+
+class AIRateLimitedError(Exception):
+    """El usuario ha gastado sus peticiones; `retry_after` dice cuántos segundos esperar."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Límite por usuario alcanzado, reintentar en {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class AIBusyError(Exception):
+    """La cola de peticiones a la IA está llena."""
+
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate  # fichas por segundo
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+def _is_retryable(error):
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS or type(error).__name__ in RETRYABLE_ERRORS
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class AIWorkQueue:
+    """
+    Cola acotada para todas las llamadas a OpenAI.
+    Un número fijo de workers limita la concurrencia global, cada usuario tiene su
+    cubo de fichas y los errores temporales se reintentan con espera exponencial.
+    """
+
+    def __init__(self, concurrency=4, max_queue=50, user_rate_per_minute=3, user_burst=3,
+                 max_retries=3, base_backoff=1.0, max_buckets=10000):
+        self._concurrency = concurrency
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._user_rate = user_rate_per_minute / 60
+        self._user_burst = user_burst
+        self._max_retries = max_retries
+        self._base_backoff = base_backoff
+        self._max_buckets = max_buckets
+        self._buckets = {}
+        self._workers = []
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if self._workers:
+            return
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._concurrency)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def _check_user(self, user_id):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= self._max_buckets:
+                # Los cubos llenos equivalen a no tener cubo: se pueden tirar sin perder nada.
+                self._buckets = {uid: b for uid, b in self._buckets.items() if not b.is_full()}
+            bucket = self._buckets[user_id] = TokenBucket(self._user_burst, self._user_rate)
+        if not bucket.take():
+            raise AIRateLimitedError(bucket.wait_time())
+
+    async def submit(self, job, user_id=None):
+        """
+        Encola `job` (una función async sin argumentos) y espera su resultado.
+        Lanza AIRateLimitedError o AIBusyError sin llegar a encolar si no hay hueco.
+        """
+        if user_id is not None:
+            self._check_user(user_id)
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((job, future))
+        except asyncio.QueueFull:
+            raise AIBusyError("La cola de IA está llena")
+        return await future
+
+    async def _worker(self):
+        while True:
+            job, future = await self._queue.get()
+            try:
+                if future.cancelled():
+                    continue
+                result = await self._run_with_backoff(job)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    async def _run_with_backoff(self, job):
+        attempt = 0
+        while True:
+            try:
+                return await job()
+            except Exception as e:
+                if attempt >= self._max_retries or not _is_retryable(e):
+                    raise
+                delay = _retry_after(e) or self._base_backoff * (2 ** attempt) + random.uniform(0, self._base_backoff)
+                print(f"!!! AVISO: OpenAI respondió con un error temporal ({e}). Reintentando en {delay:.1f}s.")
+                await asyncio.sleep(delay)
+                attempt += 1
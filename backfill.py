@@ -0,0 +1,260 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+import discord
+
+import config
+
+# Cada lote de mensajes se copia (COPY) a esta tabla temporal, que desaparece al confirmar.
+STAGING_COLUMNS = ["guild_id", "user_id", "created_at", "rutina", "attachment"]
+
+CREATE_STAGING = """
+    CREATE TEMP TABLE backfill_staging (
+        guild_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL,
+        rutina BOOLEAN NOT NULL,
+        attachment BOOLEAN NOT NULL
+    ) ON COMMIT DROP
+"""
+
+# Un solo proceso importa cada servidor a la vez (también entre réplicas).
+LOCK_QUERY = "SELECT pg_try_advisory_lock(hashtextextended('backfill:' || $1::bigint, 0))"
+UNLOCK_QUERY = "SELECT pg_advisory_unlock(hashtextextended('backfill:' || $1::bigint, 0))"
+
+# La primera importación fija hasta dónde se llega; al reanudar se mantiene ese límite.
+RUN_QUERY = "SELECT until_at FROM backfill_runs WHERE guild_id = $1"
+
+START_RUN_QUERY = """
+    INSERT INTO backfill_runs (guild_id, until_at) VALUES ($1, $2)
+    ON CONFLICT (guild_id) DO UPDATE SET until_at = backfill_runs.until_at
+    RETURNING until_at
+"""
+
+# Primer XP ganado en directo en el servidor, y si hay saldos de antes de existir el registro
+# ("opening"): los mensajes anteriores a esos saldos ya dieron XP, pero no sabemos desde cuándo.
+LIVE_XP_QUERY = """
+    SELECT MIN(created_at) FILTER (WHERE reason NOT IN ('opening', 'backfill')) AS first_live,
+           COALESCE(bool_or(reason = 'opening'), FALSE) AS has_opening
+    FROM xp_events WHERE guild_id = $1
+"""
+
+CHECKPOINTS_QUERY = "SELECT channel_id, last_message_id, done FROM backfill_checkpoints WHERE guild_id = $1"
+
+# Pasa el lote al resumen diario con las mismas reglas que en directo: XP base como mucho una vez
+# por ventana de $1 segundos (ventanas fijas, compartidas entre canales), rutina una vez al día
+# y adjuntos contados para aplicar el límite diario al calcular el XP.
+STAGE_QUERY = """
+    WITH staged AS (
+        SELECT guild_id, user_id, created_at, rutina, attachment,
+               (created_at AT TIME ZONE 'UTC')::date AS day,
+               CASE WHEN $1::int > 0 THEN floor(extract(epoch FROM created_at) / $1::int)::bigint END AS slot
+        FROM backfill_staging
+    ), new_slots AS (
+        INSERT INTO backfill_slots (guild_id, user_id, slot)
+        SELECT DISTINCT guild_id, user_id, slot FROM staged WHERE slot IS NOT NULL
+        ON CONFLICT DO NOTHING
+        RETURNING guild_id, user_id, slot
+    ), slot_days AS (
+        SELECT DISTINCT ON (s.guild_id, s.user_id, s.slot) s.guild_id, s.user_id, s.day
+        FROM staged s JOIN new_slots n USING (guild_id, user_id, slot)
+        ORDER BY s.guild_id, s.user_id, s.slot, s.created_at
+    ), daily AS (
+        SELECT guild_id, user_id, day,
+               SUM(messages)::int AS messages, bool_or(rutina) AS rutina, SUM(attachments)::int AS attachments
+        FROM (
+            SELECT guild_id, user_id, day, COUNT(*) AS messages, FALSE AS rutina, 0 AS attachments
+            FROM slot_days GROUP BY 1, 2, 3
+            UNION ALL
+            SELECT guild_id, user_id, day, COUNT(*) FILTER (WHERE slot IS NULL), bool_or(rutina),
+                   COUNT(*) FILTER (WHERE attachment)
+            FROM staged GROUP BY 1, 2, 3
+        ) parts
+        GROUP BY 1, 2, 3
+    )
+    INSERT INTO backfill_daily (guild_id, user_id, day, messages, rutina, attachments)
+    SELECT guild_id, user_id, day, messages, rutina, attachments FROM daily
+    ON CONFLICT (guild_id, user_id, day) DO UPDATE SET
+        messages = backfill_daily.messages + EXCLUDED.messages,
+        rutina = backfill_daily.rutina OR EXCLUDED.rutina,
+        attachments = backfill_daily.attachments + EXCLUDED.attachments
+"""
+
+# Recalcula el XP de los días tocados por el lote y suma a users, weekly_xp y al registro solo
+# la diferencia con lo ya sumado (merged_xp): repetir la fusión no duplica nada.
+# $1 XP por mensaje, $2 XP de rutina, $3 XP por adjunto, $4 adjuntos por día, $5 XP por nivel.
+MERGE_QUERY = """
+    WITH touched AS (
+        SELECT DISTINCT guild_id, user_id, (created_at AT TIME ZONE 'UTC')::date AS day FROM backfill_staging
+    ), computed AS (
+        SELECT d.guild_id, d.user_id, d.day, d.merged_xp AS old_xp,
+               d.messages * $1::int
+               + CASE WHEN d.rutina THEN $2::int ELSE 0 END
+               + LEAST(d.attachments, $4::int) * $3::int AS xp
+        FROM backfill_daily d JOIN touched USING (guild_id, user_id, day)
+    ), delta AS (
+        UPDATE backfill_daily d SET merged_xp = c.xp
+        FROM computed c
+        WHERE d.guild_id = c.guild_id AND d.user_id = c.user_id AND d.day = c.day AND c.xp <> c.old_xp
+        RETURNING d.guild_id, d.user_id, d.day, c.xp - c.old_xp AS xp
+    ), events AS (
+        INSERT INTO xp_events (guild_id, user_id, amount, reason, created_at)
+        SELECT guild_id, user_id, xp, 'backfill', day::timestamp AT TIME ZONE 'UTC' FROM delta
+    ), weekly AS (
+        INSERT INTO weekly_xp (guild_id, week_start, user_id, xp)
+        SELECT guild_id, date_trunc('week', day)::date, user_id, SUM(xp) FROM delta GROUP BY 1, 2, 3
+        ON CONFLICT (guild_id, week_start, user_id) DO UPDATE SET xp = weekly_xp.xp + EXCLUDED.xp
+    ), per_user AS (
+        SELECT guild_id, user_id, SUM(xp)::int AS xp FROM delta GROUP BY 1, 2
+    ), merged AS (
+        INSERT INTO users AS u (guild_id, user_id, xp, level)
+        SELECT guild_id, user_id, xp, xp / $5::int + 1 FROM per_user
+        ON CONFLICT (guild_id, user_id) DO UPDATE SET
+            xp = u.xp + EXCLUDED.xp,
+            level = (u.xp + EXCLUDED.xp) / $5::int + 1
+    )
+    SELECT COALESCE(SUM(xp), 0) FROM per_user
+"""
+
+CHECKPOINT_QUERY = """
+    INSERT INTO backfill_checkpoints (guild_id, channel_id, last_message_id, messages, done)
+    VALUES ($1, $2, $3, $4, $5)
+    ON CONFLICT (guild_id, channel_id) DO UPDATE SET
+        last_message_id = COALESCE(EXCLUDED.last_message_id, backfill_checkpoints.last_message_id),
+        messages = backfill_checkpoints.messages + EXCLUDED.messages,
+        done = EXCLUDED.done,
+        updated_at = NOW()
+"""
+
+
+class BackfillBusyError(Exception):
+    """Ya hay una importación en marcha para ese servidor."""
+
+
+class BackfillDateError(ValueError):
+    """La fecha límite falta (y no se puede deducir) o se solapa con XP ya concedido en directo."""
+
+
+async def resolve_until(conn, guild_id, until=None):
+    """
+    Fecha límite de la importación. Si el servidor ya empezó una, la suya. Si no, `until` o, por
+    defecto, el primer XP ganado en directo (o ahora, si nunca se dio XP): lo posterior ya está
+    contado. Nunca se acepta un límite posterior al primer XP en directo. Si hay saldos de antes
+    del registro, no se sabe desde cuándo da XP el bot y hay que indicar la fecha.
+    """
+    stored = await conn.fetchval(RUN_QUERY, guild_id)
+    if stored:
+        return stored
+    live = await conn.fetchrow(LIVE_XP_QUERY, guild_id)
+    first_live = live['first_live']
+    if until is None:
+        if live['has_opening']:
+            raise BackfillDateError(
+                "Este servidor ya tenía XP antes del registro de movimientos: indica la fecha "
+                "desde la que el bot da XP para no contar dos veces esos mensajes."
+            )
+        until = first_live or datetime.now(timezone.utc)
+    elif first_live and until > first_live:
+        raise BackfillDateError(
+            f"Ya hay XP ganado en directo desde el {first_live:%Y-%m-%d %H:%M} UTC: "
+            f"la fecha límite no puede ser posterior."
+        )
+    return await conn.fetchval(START_RUN_QUERY, guild_id, until)
+
+
+async def message_batches(channel, after_id, until, batch_size):
+    """
+    Recorre el historial del canal desde el mensaje `after_id` (sin incluirlo) hasta `until` y lo
+    entrega en lotes de `batch_size` mensajes leídos: (filas, último_id, leídos, terminado).
+    Solo guarda un lote a la vez, así que la memoria no crece con el tamaño del historial.
+    """
+    records, last_id, scanned = [], after_id, 0
+    after = discord.Object(id=after_id) if after_id else None
+    async for message in channel.history(limit=None, after=after, before=until, oldest_first=True):
+        last_id = message.id
+        scanned += 1
+        if not message.author.bot:
+            records.append((
+                channel.guild.id, message.author.id, message.created_at,
+                "RUTINA HECHA!" in message.content.upper(), bool(message.attachments),
+            ))
+        if scanned >= batch_size:
+            yield records, last_id, scanned, False
+            records, scanned = [], 0
+    yield records, last_id, scanned, True
+
+
+async def backfill_guild_xp(guild, pool, until=None, xp_per_message=config.XP_PER_MESSAGE,
+                            rutina_xp=config.XP_RUTINA_HECHA, attachment_xp=config.XP_ATTACHMENT,
+                            max_attachments=config.MAX_ATTACHMENTS_PER_DAY, xp_per_level=config.XP_PER_LEVEL,
+                            cooldown_seconds=config.XP_COOLDOWN_SECONDS, concurrency=3, batch_size=5000,
+                            progress=None, progress_seconds=5):
+    """
+    Importa el XP de los mensajes antiguos del servidor, anteriores a `until` (ver resolve_until;
+    al reanudar se usa el de la primera vez). Lee `concurrency` canales a la vez y, por cada lote,
+    en una sola transacción: COPY a la tabla temporal, resumen por usuario y día, fusión en users
+    y punto de control del canal. Si se corta, la siguiente llamada sigue donde se quedó cada canal.
+    `progress(summary)` se llama como mucho cada `progress_seconds` segundos.
+    """
+    summary = {
+        "channels": 0, "channels_done": 0, "skipped": 0, "messages": 0, "batches": 0, "xp_added": 0,
+        "until": None,
+    }
+    # La conexión del bloqueo se queda apartada toda la importación: el bloqueo es de sesión.
+    async with pool.acquire() as lock_conn:
+        if not await lock_conn.fetchval(LOCK_QUERY, guild.id):
+            raise BackfillBusyError(f"Ya se está importando el XP de {guild.name}.")
+        try:
+            summary["until"] = until = await resolve_until(lock_conn, guild.id, until)
+            checkpoints = {row['channel_id']: row for row in await lock_conn.fetch(CHECKPOINTS_QUERY, guild.id)}
+
+            channels = []
+            for channel in guild.text_channels:
+                permissions = channel.permissions_for(guild.me)
+                if not (permissions.read_messages and permissions.read_message_history):
+                    summary["skipped"] += 1
+                    continue
+                checkpoint = checkpoints.get(channel.id)
+                if checkpoint and checkpoint['done']:
+                    summary["channels_done"] += 1
+                    continue
+                channels.append((channel, checkpoint['last_message_id'] if checkpoint else None))
+            summary["channels"] = len(channels) + summary["channels_done"]
+
+            semaphore = asyncio.Semaphore(concurrency)
+            # Los canales se leen en paralelo, pero las fusiones van de una en una: tocan las mismas filas.
+            merge_lock = asyncio.Lock()
+            last_report = time.monotonic()
+
+            async def merge(channel, records, last_id, scanned, done):
+                async with merge_lock, pool.acquire() as conn, conn.transaction():
+                    if records:
+                        await conn.execute(CREATE_STAGING)
+                        await conn.copy_records_to_table("backfill_staging", records=records, columns=STAGING_COLUMNS)
+                        await conn.execute(STAGE_QUERY, cooldown_seconds)
+                        summary["xp_added"] += await conn.fetchval(
+                            MERGE_QUERY, xp_per_message, rutina_xp, attachment_xp, max_attachments, xp_per_level
+                        )
+                    await conn.execute(CHECKPOINT_QUERY, guild.id, channel.id, last_id, scanned, done)
+
+            async def import_channel(channel, after_id):
+                nonlocal last_report
+                async with semaphore:
+                    try:
+                        async for records, last_id, scanned, done in message_batches(channel, after_id, until, batch_size):
+                            await merge(channel, records, last_id, scanned, done)
+                            summary["messages"] += scanned
+                            summary["batches"] += 1
+                            if progress and time.monotonic() - last_report >= progress_seconds:
+                                last_report = time.monotonic()
+                                await progress(summary)
+                    except discord.Forbidden:
+                        summary["skipped"] += 1
+                        return
+                summary["channels_done"] += 1
+
+            await asyncio.gather(*(import_channel(channel, after_id) for channel, after_id in channels))
+        finally:
+            await lock_conn.fetchval(UNLOCK_QUERY, guild.id)
+    return summary
@@ -1,71 +1,118 @@
 import discord
 from discord.ext import commands, tasks
-import json
 import os
-import openai
 from datetime import datetime, timedelta, timezone, time
 import config
-from config import DISCORD_BOT_TOKEN, OPENAI_API_KEY, DATABASE_URL, ADMIN_ROLE_ID # <--- CAMBIO
-import asyncpg # <--- CAMBIO
+from config import DISCORD_BOT_TOKEN, OPENAI_API_KEY, DATABASE_URL # <--- CAMBIO
 from keep_alive import keep_alive
-
-import random
-import gspread
-from google.oauth2.service_account import Credentials
-
-keep_alive()
-
-def load_data(file_path, default_data={}):
-    """
-    Carga datos desde un archivo JSON.
-    Si el archivo no existe, está vacío o corrupto, devuelve los datos por defecto.
-    """
-    # Primero, revisa si el archivo existe en la carpeta.
-    if os.path.exists(file_path):
-        # Si existe, lo abre en modo lectura ('r') con codificación UTF-8 (importante para emojis y acentos).
-        with open(file_path, 'r', encoding='utf-8') as f:
-            try:
-                # Intenta leer el contenido y convertirlo de JSON a un diccionario de Python.
-                return json.load(f)
-            except json.JSONDecodeError:
-                # Si el archivo está vacío o mal formateado, no dará error,
-                # sino que devolverá los datos por defecto para evitar que el bot se caiga.
-                return default_data
-    else:
-        # Si el archivo no existe, simplemente devuelve los datos por defecto.
-        return default_data
-
-def save_data(file_path, data):
-    """
-    Guarda los datos (un diccionario de Python) en un archivo JSON.
-    Sobrescribe el archivo si ya existe.
-    """
-    # Abre el archivo en modo escritura ('w'), lo que significa que creará el archivo si no existe
-    # o borrará su contenido si ya existe para escribir los nuevos datos.
-    with open(file_path, 'w', encoding='utf-8') as f:
-        # Convierte el diccionario de Python a formato JSON y lo escribe en el archivo.
-        # indent=4 es para que el archivo se guarde de forma bonita y ordenada,
-        # fácil de leer para un humano.
-        json.dump(data, f, indent=4)
+from xp_buffer import XPWriteBuffer
+from xp_cooldown import XPCooldown
+from user_cache import UserCache, UserRecord
+from role_registry import LevelRoleRegistry
+from guild_settings import GuildSettingsStore, DEFAULTS as GUILD_DEFAULTS
+from routine_source import GoogleSheetRoutineSource, FileRoutineSource
+from routine_enhancer import RoutineEnhancer
+from ai_cache import ResponseCache
+from ai_queue import AIWorkQueue, AIRateLimitedError, AIBusyError
+from campaigns import run_inactivity_campaign
+from role_reconcile import reconcile_level_roles
+from backfill import backfill_guild_xp, BackfillBusyError, BackfillDateError
+from dispatcher import OutboundDispatcher, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from xp_ledger import XPLedger
+from class_scheduler import ClassReminderScheduler, ScheduleCache
+from migrations import run_migrations, adopt_legacy_rows, count_legacy_rows
+from repository import Repository, create_pool
+from leader import LeaseManager
+from weeks import get_week_start
+import metrics
+from time import perf_counter
+import functools
+
+import asyncio
 
 # --- CONFIGURACIÓN DEL BOT ---
 INTENTS = discord.Intents.default()
 INTENTS.message_content = True
 INTENTS.members = True
 
-GOOGLE_SHEET_NAME = "Rutinas Academia Bot"  # Asegúrate de que este nombre sea exacto.
-ROUTINE_CHANNEL_NAME = "rutina-semanal"
-USED_ROUTINES_FILE = "used_routines.json" # ????
 # Define la hora de publicación. Ejemplo: 8:00 AM en horario de España (CET/CEST es UTC+2)
 TIME_TO_POST = time(hour=8, minute=0, tzinfo=timezone(timedelta(hours=2))) 
 # Inicializa el cliente de Google Sheets
 gsheet_client = None
-
-bot = commands.Bot(command_prefix="!", intents=INTENTS, help_command=None)
+# Rutinas ya descargadas (copia local en disco, refrescada en segundo plano), una fuente por Sheet
+routine_sources = {}
+# Versiones mejoradas con IA, generadas con antelación
+routine_enhancer = None
+# Tareas que, con varias réplicas, debe ejecutar solo una (la que tiene su concesión)
+SCHEDULED_JOBS = (
+    "post_daily_routine", "ranking_semanal", "check_inactivity", "revisar_clases", "recordatorio_asesorias",
+    "reconcile_level_roles", "refresh_routines",
+)
+
+def lease_name(job):
+    # Cada réplica solo ve los servidores de sus shards: compiten por una tarea las que tienen los mismos.
+    return f"{job}@{','.join(map(str, config.SHARD_IDS))}" if config.SHARD_IDS else job
+
+class CalistenicoBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        # Se ejecuta una sola vez, antes de conectar al gateway (on_ready se repite en cada reconexión).
+        global health_runner
+        # /healthz y /metrics se sirven desde el mismo event loop que el bot.
+        health_runner = await keep_alive(health_status, config.HEALTH_HOST, config.HEALTH_PORT)
+        print(f"✅ Servidor de salud y métricas escuchando en el puerto {config.HEALTH_PORT}.")
+        await startup()
+
+    async def close(self):
+        # Antes de desconectar, sale lo que quede en la cola de envíos y guardamos el XP en memoria.
+        await dispatcher.stop(timeout=config.OUTBOUND_DRAIN_SECONDS)
+        if leases:
+            # Otra réplica hereda las tareas en su próxima renovación, sin esperar a que caduquen.
+            await leases.close()
+        if xp_buffer:
+            await xp_buffer.close()
+        if xp_ledger:
+            await xp_ledger.close()
+        if class_scheduler:
+            class_scheduler.stop()
+        if health_runner:
+            await health_runner.cleanup()
+        if openai_client:
+            await openai_client.close()
+        if db_pool:
+            await db_pool.close()
+        await super().close()
+
+bot = CalistenicoBot(command_prefix="!", intents=INTENTS, help_command=None,
+                     shard_count=config.SHARD_COUNT, shard_ids=config.SHARD_IDS)
 
 # --- VARIABLES GLOBALES Y CONEXIÓN A DB --- # <--- CAMBIO
 db_pool = None # <--- CAMBIO: La piscina de conexiones a la base de datos
+repo = None # Consultas del bot a la DB (repository.py)
 openai_client = None
+xp_buffer = None # Solo existe si XP_WRITE_BEHIND está activado
+xp_ledger = None # Registro de movimientos de XP (xp_events)
+class_scheduler = None # Avisos de clases programadas
+schedule_cache = None # Texto de !clases ya preparado
+health_runner = None # Servidor HTTP de /healthz y /metrics
+leases = None # Concesiones de las tareas programadas entre réplicas
+guilds_prepared = False # on_ready ya hizo el trabajo que depende de los servidores
+user_cache = UserCache(max_size=config.USER_CACHE_SIZE, ttl=config.USER_CACHE_TTL)
+guild_settings = GuildSettingsStore() # Configuración de cada servidor (guild_config), en memoria
+xp_cooldown = XPCooldown(config.XP_COOLDOWN_SECONDS, max_size=config.XP_COOLDOWN_MAX_USERS)
+# Todo lo que se manda a Discord fuera de las respuestas a comandos sale por aquí
+dispatcher = OutboundDispatcher(
+    workers=config.OUTBOUND_WORKERS,
+    channel_burst=config.OUTBOUND_CHANNEL_BURST, channel_per_second=config.OUTBOUND_CHANNEL_PER_SECOND,
+    dm_burst=config.OUTBOUND_DM_BURST, dm_per_second=config.OUTBOUND_DM_PER_SECOND,
+    merge_seconds=config.LEVEL_UP_MERGE_SECONDS
+)
+metrics.OUTBOUND_PENDING.set_function(lambda: {(): dispatcher.pending})
+ai_cache = ResponseCache(max_size=config.AI_CACHE_SIZE, ttl=config.AI_CACHE_TTL)
+# Todas las llamadas a OpenAI pasan por aquí
+ai_queue = AIWorkQueue(
+    concurrency=config.AI_CONCURRENCY, max_queue=config.AI_MAX_QUEUE,
+    user_rate_per_minute=config.AI_USER_RATE_PER_MINUTE, user_burst=config.AI_USER_BURST
+)
 
 # --- PALETA DE COLORES (sin cambios) ---
 COLOR_PALETTE = [
@@ -77,64 +124,48 @@ COLOR_PALETTE = [
 
 # --- FUNCIONES AUXILIARES (ahora con funciones de DB) --- # <--- CAMBIO
 
-# Eliminamos load_data y save_data, ya no son necesarios.
-
-async def get_user_data(user_id): # <--- CAMBIO: Nueva función para obtener datos de un usuario
-    async with db_pool.acquire() as connection:
-        return await connection.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
-
-async def upsert_user_xp(user_id, xp_gain, is_rutina=False, is_attachment=False):
-    today = datetime.now(timezone.utc).date()
+async def get_user_data(guild_id, user_id): # <--- CAMBIO: Nueva función para obtener datos de un usuario
+    # Los usuarios activos se sirven desde memoria; solo vamos a la DB si no están o caducaron.
+    cached = user_cache.get((guild_id, user_id))
+    if cached:
+        return cached
+    row = await repo.fetch_user(guild_id, user_id)
+    if not row:
+        return None
+    record = UserRecord.from_row(guild_id, user_id, row)
+    user_cache.put(record)
+    return record
+
+async def upsert_user_xp(guild_id, user_id, base_xp, claims_rutina=False, has_attachment=False):
+    """
+    Suma XP a un usuario del servidor en un único round trip.
+    Los bonus de rutina y adjunto solo se conceden si la DB confirma que no se han agotado hoy.
+    Devuelve la fila actualizada junto con old_level, xp_gain y los bonus concedidos,
+    y refresca la caché.
+    """
     now_ts = datetime.now(timezone.utc)
-    
-    # Primero, intentamos obtener los datos del usuario.
-    user_data = await get_user_data(user_id)
-    
-    if not user_data:
-        # Si no hay datos, es un usuario nuevo. Hacemos un INSERT.
-        query_insert = """
-            INSERT INTO users (user_id, xp, weekly_xp, last_message_timestamp, last_rutina_date, last_attachment_date, attachments_today)
-            VALUES ($1, $2, $2, $3, $4, $5, $6)
-            RETURNING xp, level;
-        """
-        async with db_pool.acquire() as connection:
-            return await connection.fetchrow(
-                query_insert, user_id, xp_gain, now_ts, 
-                today if is_rutina else None, 
-                today if is_attachment else None, 
-                1 if is_attachment else 0
-            )
-    else:
-        # Si hay datos, es un usuario existente. Hacemos un UPDATE.
-        update_clauses = [
-            "xp = users.xp + $2",
-            "weekly_xp = users.weekly_xp + $2",
-        ]
-        params = [user_id, xp_gain]
-        param_idx = 3
-
-        if is_rutina:
-            update_clauses.append(f"last_rutina_date = ${param_idx}")
-            params.append(today)
-            param_idx += 1
-        
-        if is_attachment:
-            update_clauses.append(f"last_attachment_date = ${param_idx}")
-            params.append(today)
-            param_idx += 1
-            update_clauses.append("attachments_today = users.attachments_today + 1")
-
-        update_clauses.append(f"last_message_timestamp = ${param_idx}")
-        params.append(now_ts)
+    settings = guild_settings.get(guild_id)
+    row = await repo.upsert_xp(
+        guild_id, user_id, base_xp, claims_rutina, has_attachment, now_ts,
+        settings.xp_rutina_hecha, settings.xp_attachment,
+        config.MAX_ATTACHMENTS_PER_DAY, config.XP_PER_LEVEL, get_week_start(now_ts.date())
+    )
+    user_cache.put(UserRecord.from_row(guild_id, user_id, row))
+    return row
 
-        update_string = ",\n            ".join(update_clauses)
-        query_update = f"UPDATE users SET {update_string} WHERE user_id = $1 RETURNING xp, level;"
-        
-        async with db_pool.acquire() as connection:
-            return await connection.fetchrow(query_update, *params)
+def log_xp_events(guild_id, user_id, base_xp, base_reason, rutina_granted, attachment_granted, created_at):
+    """Apunta en el registro cada parte del XP ganado por separado."""
+    if not xp_ledger:
+        return
+    settings = guild_settings.get(guild_id)
+    xp_ledger.add(guild_id, user_id, base_xp, base_reason, created_at)
+    if rutina_granted:
+        xp_ledger.add(guild_id, user_id, settings.xp_rutina_hecha, "rutina", created_at)
+    if attachment_granted:
+        xp_ledger.add(guild_id, user_id, settings.xp_attachment, "attachment", created_at)
 
 def get_level(xp):
-    return int(xp / 150) + 1
+    return int(xp / config.XP_PER_LEVEL) + 1
 
 def get_role_name_for_level(level):
     if level < 10: return "Rookie 🐣"
@@ -144,83 +175,339 @@ def get_role_name_for_level(level):
     if level % 5 == 0: return f"{base_title} CALISTÉNICO"
     return f"{base_title} DISCIPLINADO"
 
-# --- FUNCIÓN DE ASIGNAR ROLES (sin cambios lógicos) ---
+def get_role_color_for_level(level):
+    base_level_tier = (level // 10)
+    return COLOR_PALETTE[(base_level_tier - 1) % len(COLOR_PALETTE)]
+
+# Tabla nivel -> rol precalculada hasta el nivel 200.
+role_registry = LevelRoleRegistry(get_role_name_for_level, get_role_color_for_level, max_level=200)
+
+def build_gsheet_client():
+    # Importaciones pesadas: solo se cargan si de verdad vamos a usar Google Sheets.
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    # 1. Construimos el diccionario de credenciales leyendo las variables de entorno.
+    gcp_credentials_dict = {
+        "type": "service_account",
+        "project_id": config.GCP_PROJECT_ID,
+        "private_key_id": config.GCP_PRIVATE_KEY_ID,
+        # Este .replace() es clave para que los saltos de línea de la private_key funcionen bien.
+        "private_key": (config.GCP_PRIVATE_KEY or "").replace('\n', '\n'),
+        "client_email": config.GCP_CLIENT_EMAIL,
+        "client_id": config.GCP_CLIENT_ID,
+        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+        "token_uri": "https://oauth2.googleapis.com/token",
+        "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
+        "client_x509_cert_url": config.GCP_CLIENT_X509_CERT_URL
+    }
+
+    # 2. Verificamos que las variables esenciales no estén vacías.
+    if not all([config.GCP_PROJECT_ID, config.GCP_PRIVATE_KEY, config.GCP_CLIENT_EMAIL]):
+        print("⚠️ AVISO: Faltan variables de entorno de GCP. La función de rutinas diarias no funcionará.")
+        return None
+
+    # 3. Autorizamos usando la información del diccionario, no un archivo.
+    scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+    creds = Credentials.from_service_account_info(gcp_credentials_dict, scopes=scopes)
+    client = gspread.authorize(creds)
+    print("✅ Conexión con Google Sheets establecida desde variables de entorno.")
+    return client
+
+def build_openai_client():
+    if not OPENAI_API_KEY:
+        print("⚠️ AVISO: No se proporcionó clave API de OpenAI. El comando !calistenico no funcionará.")
+        return None
+    import openai  # Tarda en importarse: solo si hay clave
+    return openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+async def init_database():
+    # El pool instrumentado mide la espera por conexión y cuenta cada consulta.
+    pool = await create_pool(
+        DATABASE_URL, min_size=config.DB_POOL_MIN_SIZE, max_size=config.DB_POOL_MAX_SIZE,
+        statement_cache_size=config.DB_STATEMENT_CACHE_SIZE, command_timeout=config.DB_COMMAND_TIMEOUT,
+        retries=config.DB_RETRIES, backoff=config.DB_RETRY_BACKOFF_SECONDS, slow_seconds=config.DB_SLOW_QUERY_MS / 1000
+    )
+    async with pool.acquire() as connection:
+        for version, name in await run_migrations(connection):
+            print(f"✅ Migración {version} aplicada: {name}.")
+        # Los datos de cuando solo había un servidor pasan al servidor indicado.
+        if config.LEGACY_GUILD_ID:
+            adopted = await adopt_legacy_rows(connection, config.LEGACY_GUILD_ID)
+            if adopted:
+                print(f"✅ {adopted} usuarios sin servidor asignados al servidor {config.LEGACY_GUILD_ID}.")
+        elif await count_legacy_rows(connection):
+            print("⚠️ AVISO: Hay usuarios sin servidor asignado. Define LEGACY_GUILD_ID para recuperar su XP.")
+    print("✅ Conectado a la base de datos PostgreSQL.")
+    return pool
+
+async def timed_init(component, coro, timings):
+    start = perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[component] = perf_counter() - start
+        metrics.STARTUP_SECONDS.set(timings[component], component)
+
+def routine_source_for(sheet_name):
+    """Fuente de rutinas de un Sheet; si hay ROUTINES_FILE, el archivo local para todos los servidores."""
+    if config.ROUTINES_FILE:
+        key = config.ROUTINES_FILE
+    elif gsheet_client:
+        key = sheet_name
+    else:
+        return None
+    source = routine_sources.get(key)
+    if source is None:
+        if config.ROUTINES_FILE:
+            source = FileRoutineSource(config.ROUTINES_FILE, config.ROUTINES_SNAPSHOT_FILE)
+        else:
+            source = GoogleSheetRoutineSource(gsheet_client, key, snapshot_path_for(key))
+        routine_sources[key] = source
+    return source
+
+def snapshot_path_for(sheet_name):
+    # El Sheet por defecto conserva el nombre de siempre; el resto lleva el suyo en el nombre del archivo.
+    if sheet_name == GUILD_DEFAULTS["routine_sheet"]:
+        return config.ROUTINES_SNAPSHOT_FILE
+    stem, ext = os.path.splitext(config.ROUTINES_SNAPSHOT_FILE)
+    slug = "".join(c if c.isalnum() else "_" for c in sheet_name.lower())
+    return f"{stem}-{slug}{ext}"
+
+def guild_channel(guild, field):
+    """Canal de texto del servidor configurado en `field` (por ejemplo, "ranking_channel")."""
+    return discord.utils.get(guild.text_channels, name=getattr(guild_settings.get(guild.id), field))
+
+async def for_each_guild(job, action):
+    """Ejecuta `action(guild)` en todos los servidores, con GUILD_FANOUT_CONCURRENCY a la vez como mucho."""
+    semaphore = asyncio.Semaphore(config.GUILD_FANOUT_CONCURRENCY)
+
+    async def run(guild):
+        async with semaphore:
+            try:
+                await action(guild)
+            except Exception as e:
+                # Un servidor con problemas (permisos, canales borrados...) no frena a los demás.
+                print(f"❌ ERROR en {job} para el servidor {guild.name} ({guild.id}): {e}")
+
+    await asyncio.gather(*(run(guild) for guild in bot.guilds))
+
+# --- FUNCIÓN DE ASIGNAR ROLES ---
 async def assign_level_role(member, new_level):
-    guild = member.guild
-    new_role_name = get_role_name_for_level(new_level)
-    base_level_tier = (new_level // 10)
-    color_index = (base_level_tier - 1) % len(COLOR_PALETTE)
-    selected_color = COLOR_PALETTE[color_index]
-    roles_de_nivel_base = list(config.LEVEL_ROLES_BASE.values()) + ["Rookie 🐣"]
-    roles_to_remove = [role for role in member.roles if any(base in role.name for base in roles_de_nivel_base) and role.name != new_role_name]
-
-    if roles_to_remove:
-        await member.remove_roles(*roles_to_remove, reason="Actualización de rol de nivel.")
-
-    new_role = discord.utils.get(guild.roles, name=new_role_name)
-    if not new_role:
-        new_role = await guild.create_role(name=new_role_name, color=selected_color, mentionable=False)
-    elif new_role.color == discord.Color.default():
-        await new_role.edit(color=selected_color)
-    
-    if new_role not in member.roles:
-        await member.add_roles(new_role, reason="Subida de nivel.")
+    new_role_id = await role_registry.role_id_for_level(member.guild, new_level)
+    level_role_ids = role_registry.level_role_ids(member.guild)
 
-# --- EVENTOS PRINCIPALES ---
-@bot.event
-async def on_ready():
-    global db_pool, openai_client  # <--- CAMBIO
-    global gsheet_client
-    try: # <--- CAMBIO: Conectamos a la base de datos
-        db_pool = await asyncpg.create_pool(dsn=DATABASE_URL, min_size=1, max_size=10)
-        print("✅ Conectado a la base de datos PostgreSQL.")
-    except Exception as e:
-        print(f"❌ Error al conectar a la base de datos: {e}")
+    # Nos quedamos con los roles que no son de nivel y añadimos el nuevo: una sola llamada a Discord.
+    current_roles = member.roles[1:]  # Sin @everyone
+    new_roles = [role for role in current_roles if role.id not in level_role_ids or role.id == new_role_id]
+    if not any(role.id == new_role_id for role in new_roles):
+        new_roles.append(discord.Object(id=new_role_id))
+    elif len(new_roles) == len(current_roles):
+        return  # Ya tiene exactamente el rol que le toca
+
+    await member.edit(roles=new_roles, reason="Actualización de rol de nivel.")
+
+def leader_only(job, wait=0, run_key=None):
+    """
+    Decorador para las tareas de tasks.loop: solo las ejecuta la réplica dueña de `job`.
+    Con `wait`, una réplica que aún no es dueña espera por si el dueño acaba de caer; con
+    `run_key`, cada ejecución (por ejemplo, la de un día) se apunta en la DB antes de empezar y
+    no se repite aunque otra réplica herede la tarea a medias. Si `run_key()` devuelve None,
+    aún no toca ejecutarla.
+    """
+    def decorator(coro):
+        @functools.wraps(coro)
+        async def wrapper(*args, **kwargs):
+            key = run_key() if run_key is not None else None
+            if run_key is not None and key is None:
+                return
+            if leases is None or not await leases.wait_for(lease_name(job), wait):
+                return
+            if key is not None and not await leases.claim_run(lease_name(job), key):
+                return
+            return await coro(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Claves de ejecución de las tareas con efectos visibles (mensajes y DMs): una por periodo.
+def day_run_key():
+    return datetime.now(timezone.utc).date().isoformat()
+
+def two_day_run_key():
+    # Tramos fijos de 2 días, para la tarea que corre cada 48 h.
+    today = datetime.now(timezone.utc).date()
+    return (today - timedelta(days=today.toordinal() % 2)).isoformat()
+
+def ranking_run_key():
+    # El ranking sale los domingos a las 20:00 UTC, una vez por semana ISO.
+    now = datetime.now(timezone.utc)
+    if now.weekday() != 6 or now.hour != 20:
+        return None
+    year, week, _ = now.isocalendar()
+    return f"{year}-W{week:02d}"
+
+async def on_lease_acquired(job):
+    if job == lease_name("revisar_clases") and class_scheduler:
+        class_scheduler.start()
+
+async def on_lease_lost(job):
+    if job == lease_name("revisar_clases") and class_scheduler:
+        class_scheduler.stop()
+
+async def serves_guild(guild_id):
+    # Con sharding entre réplicas, cada una solo avisa de las clases de sus servidores.
+    await bot.wait_until_ready()
+    return bot.get_guild(guild_id) is not None
+
+# --- ARRANQUE ---
+async def startup():
+    """
+    Inicialización que no depende de los servidores de Discord. La llama setup_hook una sola vez:
+    la DB, Google Sheets y OpenAI se preparan a la vez, y luego se arrancan las tareas.
+    """
+    global db_pool, repo, openai_client
+    global gsheet_client, xp_buffer, xp_ledger, routine_enhancer, class_scheduler, schedule_cache, leases
+    started = perf_counter()
+    timings = {}
+    # La autorización de Google y la importación de openai son bloqueantes: van en hilos.
+    db_result, gsheet_result, openai_result = await asyncio.gather(
+        timed_init("database", init_database(), timings),
+        timed_init("sheets", asyncio.to_thread(build_gsheet_client), timings),
+        timed_init("openai", asyncio.to_thread(build_openai_client), timings),
+        return_exceptions=True
+    )
+
+    if isinstance(gsheet_result, Exception):
+        print(f"❌ ERROR al conectar con Google Sheets desde variables de entorno: {gsheet_result}")
+    else:
+        gsheet_client = gsheet_result
+    if isinstance(openai_result, Exception):
+        print(f"❌ ERROR al preparar el cliente de OpenAI: {openai_result}")
+    else:
+        openai_client = openai_result
+    if isinstance(db_result, Exception):
+        print(f"❌ Error al conectar a la base de datos: {db_result}")
         return
-    
-    try:
-        # 1. Construimos el diccionario de credenciales leyendo las variables de entorno.
-        gcp_credentials_dict = {
-            "type": "service_account",
-            "project_id": config.GCP_PROJECT_ID,
-            "private_key_id": config.GCP_PRIVATE_KEY_ID,
-            # Este .replace() es clave para que los saltos de línea de la private_key funcionen bien.
-            "private_key": config.GCP_PRIVATE_KEY.replace('\n', '\n'),
-            "client_email": config.GCP_CLIENT_EMAIL,
-            "client_id": config.GCP_CLIENT_ID,
-            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-            "token_uri": "https://oauth2.googleapis.com/token",
-            "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-            "client_x509_cert_url": config.GCP_CLIENT_X509_CERT_URL
-        }
-
-        # 2. Verificamos que las variables esenciales no estén vacías.
-        if not all([config.GCP_PROJECT_ID, config.GCP_PRIVATE_KEY, config.GCP_CLIENT_EMAIL]):
-            print("⚠️ AVISO: Faltan variables de entorno de GCP. La función de rutinas diarias no funcionará.")
-            gsheet_client = None
-        else:
-            # 3. Autorizamos usando la información del diccionario, no un archivo.
-            scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-            creds = Credentials.from_service_account_info(gcp_credentials_dict, scopes=scopes)
-            gsheet_client = gspread.authorize(creds)
-            print("✅ Conexión con Google Sheets establecida desde variables de entorno.")
+    db_pool = db_result
+    repo = Repository(db_pool, retries=config.DB_RETRIES, backoff=config.DB_RETRY_BACKOFF_SECONDS)
+    dispatcher.start()
+    await guild_settings.load(repo)
+    await role_registry.load(repo)
+
+    xp_ledger = XPLedger(db_pool, max_pending=config.XP_LEDGER_MAX_PENDING)
+    flush_xp_ledger.start()
+    rollup_xp_ledger.start()
+    if config.XP_WRITE_BEHIND:
+        xp_buffer = XPWriteBuffer(db_pool, get_level, max_pending=config.XP_FLUSH_MAX_PENDING, cache=user_cache)
+        flush_xp_buffer.start()
+        print(f"✅ XP en modo write-behind (volcado cada {config.XP_FLUSH_SECONDS}s).")
+
+    # Una fuente por cada Sheet configurado (o el archivo local, compartido por todos los servidores).
+    for sheet_name in guild_settings.routine_sheets():
+        routine_source_for(sheet_name)
+    if config.ROUTINES_FILE:
+        print(f"✅ Rutinas leídas desde el archivo local {config.ROUTINES_FILE}.")
+    if openai_client:
+        ai_queue.start()
+        if routine_sources:
+            routine_enhancer = RoutineEnhancer(db_pool, openai_client, ai_queue)
+
+    # Los avisos de clases duermen hasta el siguiente vencimiento en lugar de revisar cada hora.
+    schedule_cache = ScheduleCache(repo, render_clases, limit=config.CLASES_LIST_LIMIT,
+                                   ttl=config.CLASES_CACHE_SECONDS)
+    class_scheduler = ClassReminderScheduler(repo, send_class_reminder, on_expired=schedule_cache.invalidate,
+                                             poll_seconds=config.CLASS_POLL_SECONDS, accepts=serves_guild)
+    loads = [timed_init("class_scheduler", class_scheduler.load(), timings)]
+    if routine_enhancer:
+        loads.append(timed_init("routine_enhancer", routine_enhancer.load(), timings))
+    await asyncio.gather(*loads)
+
+    # Los avisos de clases y las tareas programadas solo corren en la réplica dueña de cada una.
+    leases = LeaseManager(
+        db_pool, [lease_name(job) for job in SCHEDULED_JOBS], owner=config.REPLICA_ID, ttl=config.LEASE_TTL_SECONDS,
+        renew_seconds=config.LEASE_RENEW_SECONDS, on_acquired=on_lease_acquired, on_lost=on_lease_lost
+    )
+    metrics.SCHEDULER_LEASE_OWNED.set_function(lambda: {(job,): int(leases.owns(job)) for job in leases.jobs})
+    await leases.renew()
+    leases.start()
 
-    except Exception as e:
-        print(f"❌ ERROR al conectar con Google Sheets desde variables de entorno: {e}")
-        gsheet_client = None
-    # --- FIN DEL BLOQUE DE CONEXIÓN ---
-    
+    if routine_sources:
+        refresh_routines.start()
+    refresh_guild_settings.start()
     check_inactivity.start()
     ranking_semanal.start()
     recordatorio_asesorias.start()
-    revisar_clases.start()
-    post_daily_routine.start() # <-- AÑADE ESTA LÍNEA para iniciar la nueva tarea
-    
+    post_daily_routine.start()
+    if config.ROLE_RECONCILE_HOURS:
+        reconcile_roles.start()
+
+    timings["total"] = perf_counter() - started
+    metrics.STARTUP_SECONDS.set(timings["total"], "total")
+    print("⏱️ Arranque: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+
+# --- EVENTOS PRINCIPALES ---
+@bot.event
+async def on_ready():
+    # on_ready se repite tras cada reconexión al gateway: lo que depende de los servidores se hace una vez.
+    global guilds_prepared
     print(f"✅ Bot conectado como {bot.user}")
+    if guilds_prepared:
+        return
+    guilds_prepared = True
     print(f"   - Servidores: {[guild.name for guild in bot.guilds]}")
 
+    if config.PROVISION_LEVEL_ROLES:
+        await for_each_guild("provision_level_roles", provision_level_roles)
+
+@bot.event
+async def on_guild_join(guild):
+    print(f"✅ El bot se ha unido al servidor {guild.name} ({guild.id}).")
+    if config.PROVISION_LEVEL_ROLES:
+        await provision_level_roles(guild)
+
+async def provision_level_roles(guild):
+    try:
+        created = await role_registry.provision(guild)
+        if created:
+            print(f"✅ Creados {created} roles de nivel en {guild.name}.")
+    except discord.Forbidden:
+        print(f"⚠️ AVISO: Sin permisos para crear los roles de nivel en {guild.name}.")
+
+@bot.event
+async def on_guild_role_create(role):
+    role_registry.on_role_create(role)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    role_registry.on_role_update(before, after)
+
+@bot.event
+async def on_guild_role_delete(role):
+    role_registry.on_role_delete(role)
+
+@tasks.loop(minutes=config.ROUTINES_REFRESH_MINUTES)
+@metrics.timed_task("refresh_routines")
+async def refresh_routines():
+    for name, source in list(routine_sources.items()):
+        if await source.refresh():
+            print(f"✅ Rutinas de {name} actualizadas: {len(source.routines)} en la copia local.")
+    if not routine_enhancer:
+        return
+    # Solo la réplica dueña llama a la IA, y solo para las rutinas nuevas o modificadas (de todos
+    # los Sheets a la vez). Las demás recargan de la DB lo que ya está mejorado.
+    if leases is not None and leases.owns(lease_name("refresh_routines")):
+        generated = await routine_enhancer.warm([routine for source in routine_sources.values() for routine in source.routines])
+        if generated:
+            print(f"✅ {generated} rutinas mejoradas con IA y guardadas en caché.")
+    else:
+        await routine_enhancer.load()
+
 # --- PEGA ESTA NUEVA TAREA PROGRAMADA JUNTO A LAS OTRAS TAREAS ---
 @tasks.loop(time=TIME_TO_POST)
+# Si el dueño cae justo a la hora de publicar, otra réplica lo sustituye; la fecha evita repetir.
+@leader_only("post_daily_routine", wait=config.LEASE_TTL_SECONDS + config.LEASE_RENEW_SECONDS,
+             run_key=day_run_key)
+@metrics.timed_task("post_daily_routine")
 async def post_daily_routine():
     await bot.wait_until_ready()
 
@@ -231,71 +518,45 @@ async def post_daily_routine():
         print("Hoy es fin de semana, no se publica rutina.")
         return # La función se detiene y no hace nada más.
 
-    # Asume que el bot está en un solo servidor
-    guild = bot.guilds[0] if bot.guilds else None
-    if not guild or not gsheet_client:
-        print("Bot no está en un servidor o no hay conexión con Google Sheets. Saltando rutina.")
-        return
+    await for_each_guild("post_daily_routine", publish_daily_routine)
 
-    routine_channel = discord.utils.get(guild.text_channels, name=ROUTINE_CHANNEL_NAME)
-    if not routine_channel:
-        print(f"!!! AVISO: No se encontró el canal #{ROUTINE_CHANNEL_NAME}.")
+async def publish_daily_routine(guild):
+    settings = guild_settings.get(guild.id)
+    routine_source = routine_source_for(settings.routine_sheet)
+    if not routine_source:
+        print(f"No hay conexión con Google Sheets. Saltando rutina en {guild.name}.")
         return
 
-    try:
-        spreadsheet = gsheet_client.open(GOOGLE_SHEET_NAME)
-        worksheet = spreadsheet.sheet1
-        all_routines = worksheet.get_all_records()
-    except Exception as e:
-        print(f"❌ ERROR al leer el Google Sheet: {e}")
+    routine_channel = guild_channel(guild, "routine_channel")
+    if not routine_channel:
+        print(f"!!! AVISO: No se encontró el canal #{settings.routine_channel} en {guild.name}.")
         return
 
+    # Leemos la copia en memoria: nada de esperar a Google a la hora de publicar.
+    all_routines = routine_source.routines
     if not all_routines:
+        print(f"!!! AVISO: Todavía no hay rutinas descargadas de {settings.routine_sheet}. Saltando rutina en {guild.name}.")
         return
 
-    # Lógica para no repetir rutinas en la misma semana
-    used_data = load_data(USED_ROUTINES_FILE, {"last_reset_week": -1, "used_indices": []})
-    current_week = datetime.now(timezone.utc).isocalendar()[1]
-    if used_data["last_reset_week"] != current_week:
-        used_data["last_reset_week"] = current_week
-        used_data["used_indices"] = []
-
-    available_routines = [(i, r) for i, r in enumerate(all_routines) if i not in used_data["used_indices"]]
-    if not available_routines:
-        used_data["used_indices"] = []
-        available_routines = list(enumerate(all_routines))
-        await routine_channel.send("¡Hemos completado todas las rutinas de la semana! Empezamos de nuevo el ciclo. 🔥")
+    # Lógica para no repetir rutinas en la misma semana (el estado vive en la DB)
+    iso = datetime.now(timezone.utc).isocalendar()
+    week_key = f"{iso[0]}-W{iso[1]:02d}"
+    chosen_key, cycle_restarted = await repo.pick_routine(guild.id, week_key, list(routine_source.by_key))
+    if not chosen_key:
+        print(f"!!! AVISO: No se pudo elegir una rutina. Saltando rutina en {guild.name}.")
+        return
+    if cycle_restarted:
+        await dispatcher.send(routine_channel, "¡Hemos completado todas las rutinas de la semana! Empezamos de nuevo el ciclo. 🔥", priority=PRIORITY_HIGH)
 
-    chosen_index, chosen_routine = random.choice(available_routines)
-    used_data["used_indices"].append(chosen_index)
-    save_data(USED_ROUTINES_FILE, used_data)
+    chosen_routine = routine_source.by_key[chosen_key]
 
-    # --- Bloque de mejora de la presentación con IA ---
+    # --- Presentación mejorada con IA (generada de antemano) ---
     raw_title = chosen_routine.get('titulo_rutina', 'Rutina del Día')
     raw_description = chosen_routine.get('descripcion_rutina', 'No hay descripción.')
-    enhanced_description = raw_description
-
-    if openai_client:
-        try:
-            enhancer_prompt = f"""
-            Toma la siguiente rutina y mejórala para un anuncio de Discord.
-            Reglas: NO cambies los ejercicios, series o repeticiones. SÓLO mejora la presentación. Usa emojis (💪,🔥), formato de Discord como **negritas** y añade una intro y cierre motivadores.
-            
-            Título: {raw_title}
-            Descripción: {raw_description}
-            """
-            response = await openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "Eres un entrenador de fitness que formatea rutinas para anuncios de Discord de forma visual y motivadora."},
-                    {"role": "user", "content": enhancer_prompt}
-                ],
-                max_tokens=1024,
-                temperature=0.7
-            )
-            enhanced_description = response.choices[0].message.content
-        except Exception as e:
-            print(f"!!! ERROR al mejorar la rutina con IA: {e}. Publicando sin formato.")
+    enhanced_description = routine_enhancer.get(chosen_routine) if routine_enhancer else None
+    if not enhanced_description:
+        print("!!! AVISO: La rutina elegida aún no tiene versión mejorada. Publicando sin formato.")
+        enhanced_description = raw_description
     
     # Publicar la rutina mejorada en Discord
     embed = discord.Embed(
@@ -305,110 +566,201 @@ async def post_daily_routine():
         timestamp=datetime.now(timezone.utc)
     )
     embed.set_footer(text="¡A entrenar! No olvides escribir 'RUTINA HECHA' al terminar.")
-    await routine_channel.send(f"¡Buenos días, equipo! @everyone aquí tenéis el entrenamiento de hoy:", embed=embed)
+    await dispatcher.send(routine_channel, f"¡Buenos días, equipo! @everyone aquí tenéis el entrenamiento de hoy:", embed=embed, priority=PRIORITY_HIGH)
 
 
 # on_member_join (sin cambios)
 @bot.event
 async def on_member_join(member):
-    welcome_channel = discord.utils.get(member.guild.text_channels, name="bienvenida")
+    welcome_channel = guild_channel(member.guild, "welcome_channel")
     if welcome_channel:
-        await welcome_channel.send(
+        dispatcher.send(
+            welcome_channel,
             f"👋 Bienvenido {member.mention} a la Academia de Calistenia 🏋️ \n"
             "Aquí entrenamos juntos, compartimos progresos y nos respetamos siempre 💪🔥 \n"
             "📌 No olvides leer `#reglas` \n"
             "📸 Comparte tus avances en `#progresos` y motiva a la comunidad \n"
-            "¡Prepárate para crecer con nosotros! \n"
+            "¡Prepárate para crecer con nosotros! \n",
+            priority=PRIORITY_NORMAL
         )
 
 @bot.event
 async def on_message(message):
     if message.author.bot or not db_pool: return # <--- CAMBIO: Verificamos que haya conexión a la DB
 
-    user_id = message.author.id
-    today_str = datetime.now(timezone.utc).date()
-
-    user_data = await get_user_data(user_id) # <--- CAMBIO: Obtenemos datos del usuario desde la DB
+    # El XP es de cada servidor: en los DMs solo se atienden comandos.
+    if message.guild:
+        start = perf_counter()
+        round_trips = metrics.track_round_trips()
+        try:
+            await award_message_xp(message)
+        finally:
+            metrics.ON_MESSAGE_SECONDS.observe(perf_counter() - start)
+            metrics.DB_ROUND_TRIPS_PER_MESSAGE.observe(round_trips.count)
 
-    old_level = user_data['level'] if user_data else 1
-    gained_xp = config.XP_PER_MESSAGE
-    is_rutina, is_attachment = False, False
+    await bot.process_commands(message)
 
-    if "RUTINA HECHA!" in message.content.upper():
-        if not user_data or user_data.get("last_rutina_date") != today_str:
-            gained_xp += config.XP_RUTINA_HECHA
-            is_rutina = True
+async def award_message_xp(message):
+    guild_id = message.guild.id
+    user_id = message.author.id
+    settings = guild_settings.get(guild_id)
+    claims_rutina = "RUTINA HECHA!" in message.content.upper()
+    has_attachment = bool(message.attachments)
+    # El XP base va con ventana por usuario; los bonus de rutina y adjunto tienen sus propios límites diarios.
+    base_xp = settings.xp_per_message if xp_cooldown.allow((guild_id, user_id)) else 0
+    if not base_xp and not claims_rutina and not has_attachment:
+        return  # Mensaje dentro de la ventana y sin bonus posibles: ni siquiera vamos a la DB
+
+    if xp_buffer:
+        # Modo write-behind: las reglas se aplican en memoria y la DB se actualiza en bloque.
+        now_ts = datetime.now(timezone.utc)
+        old_level, new_level, rutina_granted, attachment_granted = await xp_buffer.record(
+            guild_id, user_id, get_user_data, base_xp,
+            claims_rutina, has_attachment, now_ts.date(), now_ts,
+            rutina_xp=settings.xp_rutina_hecha, attachment_xp=settings.xp_attachment
+        )
+        log_xp_events(guild_id, user_id, base_xp, "message", rutina_granted, attachment_granted, now_ts)
+        if new_level > old_level:
+            announce_level_up(message, new_level)
+        return
 
-    if message.attachments:
-        attachments_today = user_data.get("attachments_today", 0) if user_data else 0
-        last_attachment_date = user_data.get("last_attachment_date") if user_data else None
-        
-        # Si la última fecha es diferente a hoy, reseteamos el contador
-        if last_attachment_date != today_str:
-            attachments_today = 0
-            # Necesitamos actualizar esto en la DB incluso si no ganan XP
-            async with db_pool.acquire() as conn:
-                await conn.execute("UPDATE users SET attachments_today = 0, last_attachment_date = $2 WHERE user_id = $1", user_id, today_str)
-
-        if attachments_today < 4:
-            gained_xp += config.XP_ATTACHMENT
-            is_attachment = True
-
-    # <--- CAMBIO: Actualizamos todo en una sola operación de DB
-    updated_data = await upsert_user_xp(user_id, gained_xp, is_rutina, is_attachment)
-    
-    new_level = get_level(updated_data['xp'])
+    # Un único round trip: la DB decide si tocan los bonus de rutina y adjunto.
+    updated_data = await upsert_user_xp(guild_id, user_id, base_xp, claims_rutina, has_attachment)
+    log_xp_events(
+        guild_id, user_id, base_xp, "message",
+        updated_data['grant_rutina'], updated_data['grant_attachment'], updated_data['last_message_timestamp']
+    )
 
-    if new_level > old_level:
-        async with db_pool.acquire() as conn: # <--- CAMBIO: Actualizamos el nivel en la DB
-            await conn.execute("UPDATE users SET level = $1 WHERE user_id = $2", new_level, user_id)
-        
-        await assign_level_role(message.author, new_level)
-        
-        level_up_channel = discord.utils.get(message.guild.text_channels, name="level-up")
-        if level_up_channel:
-            try:
-                await level_up_channel.send(f"🎉 ¡Enhorabuena {message.author.mention}, has subido a **Nivel {new_level}**! Tu nuevo rol es **{get_role_name_for_level(new_level)}**.")
-            except Exception as e:
-                print(f"!!! ERROR al anunciar en #level-up: {e}")
+    if updated_data['level'] > updated_data['old_level']:
+        announce_level_up(message, updated_data['level'])
+
+def announce_level_up(message, new_level):
+    # on_message no espera a Discord: el rol y el anuncio salen por el dispatcher.
+    member = message.author
+    # Si sube varios niveles antes de que salga el cambio de rol, solo se aplica el último.
+    dispatcher.submit(lambda: assign_level_role(member, new_level), priority=PRIORITY_NORMAL,
+                      key=("level_role", member.guild.id, member.id))
+
+    level_up_channel = guild_channel(message.guild, "level_up_channel")
+    if level_up_channel:
+        # Las subidas que coinciden en unos segundos salen juntas en un solo mensaje.
+        dispatcher.announce(
+            level_up_channel,
+            f"🎉 ¡Enhorabuena {member.mention}, has subido a **Nivel {new_level}**! Tu nuevo rol es **{role_registry.name_for_level(new_level)}**.",
+            key=member.id
+        )
 
-    await bot.process_commands(message)
+def is_admin():
+    """Check de comandos: rol de administración del servidor (admin_role_id en guild_config) o permiso de administrador."""
+    async def predicate(ctx):
+        if ctx.guild is None:
+            raise commands.NoPrivateMessage()
+        role_id = guild_settings.get(ctx.guild.id).admin_role_id
+        if ctx.author.guild_permissions.administrator or any(role.id == role_id for role in ctx.author.roles):
+            return True
+        raise commands.MissingRole(role_id)
+    return commands.check(predicate)
 
 # --- COMANDOS PARA MIEMBROS ---
 @bot.command(name="nivel")
+@commands.guild_only()
 async def nivel(ctx):
-    user_data = await get_user_data(ctx.author.id) # <--- CAMBIO
+    user_data = await get_user_data(ctx.guild.id, ctx.author.id) # <--- CAMBIO
     if user_data:
         await ctx.send(f"📊 {ctx.author.mention}, eres **Nivel {user_data['level']}** con **{user_data['xp']}** XP.")
     else:
         await ctx.send("Aún no tienes XP. ¡Empieza a participar!")
 
+@bot.command(name="ranking")
+@commands.guild_only()
+async def ranking(ctx):
+    row = await repo.user_rank(ctx.guild.id, ctx.author.id, get_week_start(datetime.now(timezone.utc).date()))
+    if not row:
+        return await ctx.send("Aún no tienes XP. ¡Empieza a participar!")
+    msg = f"🏅 {ctx.author.mention}, eres el **#{row['rank']}** de la Academia con **{row['xp']}** XP."
+    if row['weekly_xp']:
+        msg += f"\n📅 Esta semana vas **#{row['weekly_rank']}** con **{row['weekly_xp']}** XP."
+    else:
+        msg += "\n📅 Esta semana aún no has sumado XP."
+    await ctx.send(msg)
+
 # --- PEGA ESTE NUEVO COMANDO DE TEST JUNTO A LOS OTROS COMANDOS DE ADMIN ---
 @bot.command(name="test_rutina")
-@commands.has_role(ADMIN_ROLE_ID)
+@is_admin()
 async def test_rutina(ctx):
     await ctx.send("⚙️ Forzando la publicación de una rutina de prueba...")
-    await post_daily_routine()
+    # Directo, sin pasar por la concesión: se publica desde la réplica que atiende el comando.
+    await publish_daily_routine(ctx.guild)
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+class StreamedReply:
+    """Respuesta de Discord que se va editando a medida que llegan los tokens."""
+    __slots__ = ("ctx", "message", "last_edit")
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.message = None
+        self.last_edit = 0.0
+
+    async def show(self, text, final=False):
+        text = text[:DISCORD_MESSAGE_LIMIT - 2] if not final else text[:DISCORD_MESSAGE_LIMIT]
+        if not text:
+            return
+        if not final:
+            # Respetamos el límite de ediciones de Discord: como mucho una cada AI_STREAM_EDIT_INTERVAL.
+            if asyncio.get_running_loop().time() - self.last_edit < config.AI_STREAM_EDIT_INTERVAL:
+                return
+            text += " ▌"
+        if self.message is None:
+            self.message = await self.ctx.reply(text, mention_author=True)
+        else:
+            await self.message.edit(content=text)
+        self.last_edit = asyncio.get_running_loop().time()
+
+async def stream_calistenico(prompt, reply):
+    start = perf_counter()
+    stream = await openai_client.chat.completions.create(
+        model="gpt-4o", messages=[{"role": "system", "content": config.IA_SYSTEM_PROMPT}, {"role": "user", "content": prompt}],
+        max_tokens=600, temperature=0.7, stream=True,
+        stream_options={"include_usage": True}  # El último fragmento trae los tokens consumidos
+    )
+    text = ""
+    usage = None
+    async for chunk in stream:
+        if chunk.usage:
+            usage = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            text += chunk.choices[0].delta.content
+            await reply.show(text)
+    metrics.observe_openai("calistenico", perf_counter() - start, usage)
+    await reply.show(text, final=True)
+    return text
 
-# calistenico (sin cambios)
 @bot.command(name="calistenico")
 async def calistenico(ctx, *, prompt: str):
     if not openai_client: return await ctx.send("Lo siento, la función de IA no está configurada por el administrador.")
+    reply = StreamedReply(ctx)
     try:
         async with ctx.typing():
-            response = await openai_client.chat.completions.create(model="gpt-4o", messages=[{"role": "system", "content": config.IA_SYSTEM_PROMPT}, {"role": "user", "content": prompt}], max_tokens=600, temperature=0.7)
-            await ctx.reply(response.choices[0].message.content, mention_author=True)
+            # Las preguntas repetidas salen de la caché y las simultáneas comparten llamada.
+            # Solo la primera pasa por la cola de IA y va mostrando la respuesta mientras se genera.
+            answer = await ai_cache.get_or_compute(
+                prompt, lambda: ai_queue.submit(lambda: stream_calistenico(prompt, reply), user_id=ctx.author.id)
+            )
+            if reply.message is None:
+                await ctx.reply(answer[:DISCORD_MESSAGE_LIMIT], mention_author=True)
+    except AIRateLimitedError as e:
+        await ctx.send(f"⏳ ¡Más despacio, campeón! Podrás volver a preguntarme en {e.retry_after:.0f} segundos.")
+    except AIBusyError:
+        await ctx.send("😅 Estoy atendiendo muchas preguntas a la vez. Inténtalo de nuevo en un momento.")
     except Exception as e:
         print(f"Error con API de OpenAI: {e}")
         await ctx.send("🤯 Uff, mi cerebro tuvo un cortocircuito. Inténtalo de nuevo en un momento.")
 
-@bot.command(name="clases")
-async def clases(ctx):
-    async with db_pool.acquire() as conn: # <--- CAMBIO
-        clases_records = await conn.fetch("SELECT tipo, fecha_hora FROM clases WHERE fecha_hora >= NOW() ORDER BY fecha_hora ASC")
-    
+def render_clases(clases_records):
     if not clases_records:
-        return await ctx.send("📅 No hay clases programadas.")
+        return "📅 No hay clases programadas."
         
     msg = "📅 **Clases Programadas:**\n"
     clases_gratis = [r for r in clases_records if r['tipo'] == 'gratis']
@@ -418,32 +770,44 @@ async def clases(ctx):
         msg += "\n**Gratuitas:**\n" + "\n".join([f"  - {r['fecha_hora'].strftime('%d/%m/%Y a las %H:%M')} UTC" for r in clases_gratis])
     if clases_premium:
         msg += "\n**Premium:**\n" + "\n".join([f"  - {r['fecha_hora'].strftime('%d/%m/%Y a las %H:%M')} UTC" for r in clases_premium])
-    await ctx.send(msg)
+    return msg
+
+@bot.command(name="clases")
+@commands.guild_only()
+async def clases(ctx):
+    # El horario solo cambia al añadir o expirar una clase: casi siempre sale de memoria.
+    await ctx.send(await schedule_cache.get(ctx.guild.id))
 
 # --- COMANDOS DE AYUDA (sin cambios) ---
 @bot.command(name="help")
 async def help_command(ctx):
     embed = discord.Embed(title="🤖 Comandos de la Academia", description="Aquí tienes los comandos que puedes usar:", color=discord.Color.blue())
     embed.add_field(name="`!nivel`", value="Muestra tu nivel y XP actual.", inline=False)
+    embed.add_field(name="`!ranking`", value="Muestra tu puesto en el ranking semanal y en el total.", inline=False)
     embed.add_field(name="`!calistenico [pregunta]`", value="Habla con el entrenador IA para resolver tus dudas.", inline=False)
     embed.add_field(name="`!clases`", value="Muestra las próximas clases programadas.", inline=False)
     embed.set_footer(text="Gana XP participando, compartiendo tu progreso y ayudando a otros.")
     await ctx.send(embed=embed)
 
 @bot.command(name="adminhelp")
-@commands.has_role(ADMIN_ROLE_ID)
+@is_admin()
 async def adminhelp_command(ctx):
     embed = discord.Embed(title="👑 Comandos de Administración", description="Comandos para gestionar el servidor:", color=discord.Color.gold())
     embed.add_field(name="`!setup`", value="Crea/repara la estructura de canales del servidor.", inline=False)
     embed.add_field(name="`!clase_gratis [AAAA-MM-DD] [HH:MM]`", value="Programa una clase gratuita.", inline=False)
     embed.add_field(name="`!clase_premium [AAAA-MM-DD] [HH:MM]`", value="Programa una clase premium.", inline=False)
     embed.add_field(name="`!test_xp @usuario [cantidad]`", value="Añade XP a un usuario y fuerza un ranking de prueba.", inline=False)
+    embed.add_field(name="`!auditar_xp [reparar]`", value="Compara el XP de cada usuario con el registro de movimientos (y lo corrige con `reparar`).", inline=False)
+    embed.add_field(name="`!purgar_cache_ia`", value="Muestra las estadísticas de la caché de `!calistenico` y la vacía.", inline=False)
+    embed.add_field(name="`!reconciliar_roles [aplicar]`", value="Muestra qué miembros tienen un rol de nivel que no les toca (y lo corrige con `aplicar`).", inline=False)
+    embed.add_field(name="`!importar_xp [AAAA-MM-DD]`", value="Suma el XP de los mensajes antiguos, hasta la fecha indicada o el primer XP ganado en directo. Si se corta, sigue donde se quedó.", inline=False)
+    embed.add_field(name="`!configurar [campo] [valor]`", value="Muestra o cambia la configuración de este servidor (`-` vuelve al valor por defecto).", inline=False)
     await ctx.send(embed=embed)
 
 # --- COMANDOS DE ADMINISTRACIÓN ---
 # setup (sin cambios)
 @bot.command(name="setup")
-@commands.has_role(ADMIN_ROLE_ID)
+@is_admin()
 async def setup(ctx):
     await ctx.send("Configurando y verificando canales del servidor...")
     canales = { "📜 INFORMACIÓN": ["bienvenida", "reglas", "anuncios", "level-up", "ranking"], "🏋️ ENTRENAMIENTO": ["rutina-semanal", "videos-explicativos", "progresos"], "💬 COMUNIDAD": ["charla-general", "presentaciones", "💬-banquito"], "💎 PREMIUM": ["clases-grupales", "asesorias-personales", "clases-exclusivas"], "🎤 ZONAS DE VOZ": ["🎤-parque-de-barras"]}
@@ -457,119 +821,252 @@ async def setup(ctx):
     await ctx.send("✅ ¡Servidor configurado!")
 
 @bot.command(name="clase_gratis")
-@commands.has_role(ADMIN_ROLE_ID)
+@is_admin()
 async def clase_gratis(ctx, fecha: str, hora: str):
     try:
         dt = datetime.strptime(f"{fecha} {hora}", "%Y-%m-%d %H:%M").replace(tzinfo=timezone.utc)
     except ValueError:
         return await ctx.send("❌ Formato inválido. Usa: `AAAA-MM-DD HH:MM` (en UTC)")
     
-    async with db_pool.acquire() as conn: # <--- CAMBIO
-        await conn.execute("INSERT INTO clases (tipo, fecha_hora) VALUES ('gratis', $1)", dt)
+    class_id = await repo.add_class(ctx.guild.id, "gratis", dt) # <--- CAMBIO
+    schedule_cache.invalidate()
+    class_scheduler.add(ctx.guild.id, class_id, dt)
         
     await ctx.send(f"✅ Clase gratuita programada para el **{dt.strftime('%d/%m/%Y a las %H:%M')} UTC**.")
 
 @bot.command(name="clase_premium")
-@commands.has_role(ADMIN_ROLE_ID)
+@is_admin()
 async def clase_premium(ctx, fecha: str, hora: str):
     try:
         dt = datetime.strptime(f"{fecha} {hora}", "%Y-%m-%d %H:%M").replace(tzinfo=timezone.utc)
     except ValueError:
         return await ctx.send("❌ Formato inválido. Usa: `AAAA-MM-DD HH:MM` (en UTC)")
         
-    async with db_pool.acquire() as conn: # <--- CAMBIO
-        await conn.execute("INSERT INTO clases (tipo, fecha_hora) VALUES ('premium', $1)", dt)
+    class_id = await repo.add_class(ctx.guild.id, "premium", dt) # <--- CAMBIO
+    schedule_cache.invalidate()
+    class_scheduler.add(ctx.guild.id, class_id, dt)
         
     await ctx.send(f"✅ Clase premium programada para el **{dt.strftime('%d/%m/%Y a las %H:%M')} UTC**.")
 
 @bot.command(name="test_xp")
-@commands.has_role(ADMIN_ROLE_ID)
+@is_admin()
 async def test_xp(ctx, member: discord.Member, cantidad: int):
-    user_data = await get_user_data(member.id) # <--- CAMBIO
-    old_level = user_data['level'] if user_data else 1
-    
-    updated_data = await upsert_user_xp(member.id, cantidad, cantidad) # <--- CAMBIO
+    if xp_buffer:
+        # Pasamos por el buffer para que su vista en memoria no quede desfasada.
+        now_ts = datetime.now(timezone.utc)
+        old_level, new_level, _, _ = await xp_buffer.record(
+            ctx.guild.id, member.id, get_user_data, cantidad, False, False, now_ts.date(), now_ts
+        )
+        log_xp_events(ctx.guild.id, member.id, cantidad, "admin", False, False, now_ts)
+        await ctx.send(f"✅ Añadidos `{cantidad}` XP a {member.mention}.")
+        if new_level > old_level:
+            await assign_level_role(member, new_level)
+            await ctx.send(f"¡{member.mention} ha subido al **Nivel {new_level}**!")
+        return
+
+    updated_data = await upsert_user_xp(ctx.guild.id, member.id, cantidad)
+    log_xp_events(ctx.guild.id, member.id, cantidad, "admin", False, False, updated_data['last_message_timestamp'])
     
     await ctx.send(f"✅ Añadidos `{cantidad}` XP a {member.mention}. XP total: `{updated_data['xp']}`.")
     
-    new_level = get_level(updated_data['xp'])
-    if new_level > old_level:
-        async with db_pool.acquire() as conn:
-            await conn.execute("UPDATE users SET level = $1 WHERE user_id = $2", new_level, member.id)
+    new_level = updated_data['level']
+    if new_level > updated_data['old_level']:
         await assign_level_role(member, new_level)
         await ctx.send(f"¡{member.mention} ha subido al **Nivel {new_level}**!")
 
+@bot.command(name="auditar_xp")
+@is_admin()
+async def auditar_xp(ctx, accion: str = None):
+    # Primero guardamos todo lo pendiente para comparar con datos al día.
+    if xp_buffer:
+        await xp_buffer.flush()
+    await xp_ledger.flush()
+
+    if accion == "reparar":
+        fixed = await xp_ledger.rebuild_totals(ctx.guild.id, config.XP_PER_LEVEL)
+        user_cache.clear()
+        return await ctx.send(f"🛠️ XP reconstruido desde el registro para `{fixed}` usuarios.")
+
+    mismatches = await xp_ledger.audit(ctx.guild.id)
+    if not mismatches:
+        return await ctx.send("✅ El XP de todos los usuarios coincide con el registro de movimientos.")
+    lines = [f"  - <@{r['user_id']}>: `{r['xp']}` XP en users, `{r['ledger_xp']}` en el registro" for r in mismatches]
+    await ctx.send("⚠️ **Diferencias encontradas:**\n" + "\n".join(lines))
+
+@bot.command(name="reconciliar_roles")
+@is_admin()
+async def reconciliar_roles(ctx, accion: str = None):
+    dry_run = accion != "aplicar"
+    status = await ctx.send("🔄 Comparando los roles de nivel de todos los miembros con la DB...")
+
+    async def progress(summary):
+        await status.edit(content=f"🔄 Roles corregidos: `{summary['applied']}` de `{summary['changes']}`...")
+
+    summary = await run_role_reconcile(ctx.guild, dry_run=dry_run, progress=progress)
+    msg = (
+        f"{'🔍 **Simulación:**' if dry_run else '✅ **Roles de nivel reconciliados:**'} "
+        f"`{summary['members']}` miembros, `{summary['unchanged']}` correctos, `{summary['changes']}` por corregir."
+    )
+    if summary['roles_to_create']:
+        msg += f"\nRoles que faltan{' (se crearán)' if dry_run else ' (creados)'}: " + ", ".join(summary['roles_to_create'])
+    if dry_run:
+        if summary['preview']:
+            msg += "\n" + "\n".join(f"  - {line}" for line in summary['preview'])
+            if summary['changes'] > len(summary['preview']):
+                msg += f"\n  - ... y {summary['changes'] - len(summary['preview'])} más."
+            msg += "\nUsa `!reconciliar_roles aplicar` para corregirlos."
+    else:
+        msg += f"\nAplicados: `{summary['applied']}`, sin permisos: `{summary['forbidden']}`, fallidos: `{summary['failed']}`."
+    await status.edit(content=msg[:2000])
+
+@bot.command(name="importar_xp")
+@is_admin()
+async def importar_xp(ctx, hasta: str = None):
+    until = None
+    if hasta:
+        try:
+            until = datetime.strptime(hasta, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        except ValueError:
+            return await ctx.send("❌ Formato inválido. Usa: `AAAA-MM-DD` (en UTC)")
+    status = await ctx.send("📥 Importando el XP de los mensajes antiguos...")
+
+    async def progress(summary):
+        await status.edit(
+            content=f"📥 Mensajes leídos: `{summary['messages']}`, XP sumado: `{summary['xp_added']}`, "
+                    f"canales terminados: `{summary['channels_done']}` de `{summary['channels']}`..."
+        )
+
+    # Lo pendiente en memoria se guarda antes: la fusión parte de los totales reales y la fecha
+    # por defecto sale del primer XP en directo ya registrado.
+    if xp_buffer:
+        await xp_buffer.flush()
+    await xp_ledger.flush()
+    settings = guild_settings.get(ctx.guild.id)
+    try:
+        summary = await backfill_guild_xp(
+            ctx.guild, db_pool, until=until, xp_per_message=settings.xp_per_message,
+            rutina_xp=settings.xp_rutina_hecha, attachment_xp=settings.xp_attachment,
+            concurrency=config.BACKFILL_CONCURRENCY, batch_size=config.BACKFILL_BATCH_SIZE, progress=progress
+        )
+    except BackfillBusyError as e:
+        return await status.edit(content=f"⏳ {e}")
+    except BackfillDateError as e:
+        return await status.edit(content=f"❌ {e}")
+    user_cache.clear()
+    await status.edit(content=(
+        f"✅ **XP histórico importado** (mensajes anteriores al {summary['until'].strftime('%d/%m/%Y %H:%M')} UTC): "
+        f"`{summary['messages']}` mensajes leídos, `{summary['xp_added']}` XP sumado, "
+        f"`{summary['channels_done']}` de `{summary['channels']}` canales terminados, `{summary['skipped']}` sin acceso.\n"
+        f"Usa `!reconciliar_roles aplicar` para poner los roles de nivel al día."
+    ))
+
+@bot.command(name="purgar_cache_ia")
+@is_admin()
+async def purgar_cache_ia(ctx):
+    stats = ai_cache.stats()
+    purged = ai_cache.purge()
+    await ctx.send(
+        f"🧹 Caché de IA vaciada ({purged} respuestas). "
+        f"Aciertos: `{stats['hits']}`, compartidas: `{stats['coalesced']}`, fallos: `{stats['misses']}` "
+        f"(tasa de acierto: `{stats['hit_rate']:.0%}`)."
+    )
+
+@bot.command(name="configurar")
+@is_admin()
+async def configurar(ctx, campo: str = None, valor: str = None):
+    if campo is None or valor is None:
+        settings = guild_settings.get(ctx.guild.id)
+        lines = [
+            f"  - `{field}`: `{getattr(settings, field)}`" + (" (por defecto)" if settings.is_default(field) else "")
+            for field in settings.FIELDS
+        ]
+        return await ctx.send("⚙️ **Configuración de este servidor:**\n" + "\n".join(lines))
+    try:
+        settings = await guild_settings.update(repo, ctx.guild.id, campo, valor)
+    except ValueError as e:
+        return await ctx.send(f"❌ Valor no válido: {e}")
+    if campo == "routine_sheet" and routine_source_for(settings.routine_sheet):
+        # Un Sheet nuevo se descarga ya, sin esperar al siguiente refresco.
+        await routine_source_for(settings.routine_sheet).refresh()
+    await ctx.send(f"✅ `{campo}` es ahora `{getattr(settings, campo)}`.")
+
 # --- TAREAS AUTOMÁTICAS (LOOPS) ---
 
 # @tasks.loop(seconds=60) # <--- CAMBIO: Eliminamos este loop por completo
 # async def save_data_loop():
 #     pass
 
+@tasks.loop(seconds=config.XP_FLUSH_SECONDS)
+@metrics.timed_task("flush_xp_buffer")
+async def flush_xp_buffer():
+    if xp_buffer:
+        await xp_buffer.flush()
+
+@tasks.loop(seconds=config.XP_LEDGER_FLUSH_SECONDS)
+@metrics.timed_task("flush_xp_ledger")
+async def flush_xp_ledger():
+    await xp_ledger.flush()
+
+@tasks.loop(minutes=config.XP_ROLLUP_MINUTES)
+@metrics.timed_task("rollup_xp_ledger")
+async def rollup_xp_ledger():
+    processed = await xp_ledger.rollup()
+    if processed:
+        print(f"Resumen diario de XP actualizado con {processed} eventos.")
+
 @tasks.loop(hours=24)
+@leader_only("check_inactivity", run_key=day_run_key)
+@metrics.timed_task("check_inactivity")
 async def check_inactivity():
     await bot.wait_until_ready()
-    seven_days_ago = datetime.now(timezone.utc) - timedelta(days=7)
-    
-    async with db_pool.acquire() as conn: # <--- CAMBIO
-        inactive_users = await conn.fetch("SELECT user_id FROM users WHERE last_message_timestamp < $1", seven_days_ago)
-        
-        for record in inactive_users:
-            user = bot.get_user(record['user_id'])
-            if user:
-                try:
-                    await user.send("💪 ¡Hey! Notamos que llevas unos días sin pasar por la Academia de Calistenia 🏋️‍♂️.\n¡Vuelve a entrenar con nosotros y comparte tu progreso!")
-                    # Actualizamos su timestamp para no volver a molestarle pronto
-                    await conn.execute("UPDATE users SET last_message_timestamp = $1 WHERE user_id = $2", datetime.now(timezone.utc), user.id)
-                except discord.Forbidden:
-                    print(f"No se pudo enviar DM al usuario inactivo {user.name}")
-
-@tasks.loop(hours=1)
-async def revisar_clases():
+    cutoff = datetime.now(timezone.utc) - timedelta(days=config.INACTIVITY_DAYS)
+    await for_each_guild("check_inactivity", lambda guild: nudge_inactive_members(guild, cutoff))
+
+async def nudge_inactive_members(guild, cutoff):
+    summary = await run_inactivity_campaign(
+        bot, repo, guild.id, cutoff,
+        "💪 ¡Hey! Notamos que llevas unos días sin pasar por la Academia de Calistenia 🏋️‍♂️.\n¡Vuelve a entrenar con nosotros y comparte tu progreso!",
+        concurrency=config.NUDGE_CONCURRENCY, per_second=config.NUDGE_PER_SECOND, dispatcher=dispatcher
+    )
+    print(
+        f"Campaña de inactividad en {guild.name}: {summary['sent']} DMs enviados de {summary['inactive']} inactivos "
+        f"({summary['forbidden']} con DMs cerrados, {summary['not_found']} no encontrados, {summary['failed']} fallidos)."
+    )
+
+async def send_class_reminder(guild_id, tipo, fecha_hora, day_str):
     await bot.wait_until_ready()
-    now = datetime.now(timezone.utc)
-    
-    async with db_pool.acquire() as conn:
-        # Primero, borramos las clases que ya pasaron
-        await conn.execute("DELETE FROM clases WHERE fecha_hora < $1", now)
-        
-        # Luego, buscamos las clases que necesiten recordatorio
-        clases_a_recordar = await conn.fetch("SELECT id, tipo, fecha_hora FROM clases")
-        
-    guild = bot.guilds[0] if bot.guilds else None
+    guild = bot.get_guild(guild_id)
     if not guild: return
     
-    for clase in clases_a_recordar:
-        canal_nombre = "clases-grupales" if clase['tipo'] == "gratis" else "clases-exclusivas"
-        canal = discord.utils.get(guild.text_channels, name=canal_nombre)
-        if not canal: continue
-        
-        time_until = clase['fecha_hora'] - now
-        # Lógica de recordatorio (sin cambios)
-        if timedelta(hours=47) < time_until <= timedelta(hours=48) or timedelta(hours=23) < time_until <= timedelta(hours=24):
-            day_str = "2 días" if time_until > timedelta(hours=24) else "MAÑANA"
-            await canal.send(f"@everyone 🚨 ¡Recordatorio! La clase de **{clase['tipo']}** es en {day_str} ({clase['fecha_hora'].strftime('%d/%m a las %H:%M')} UTC)")
+    canal = guild_channel(guild, "clases_gratis_channel" if tipo == "gratis" else "clases_premium_channel")
+    if not canal: return
+    # Esperamos al envío: si falla, el planificador libera el aviso y lo reintenta.
+    await dispatcher.send(canal, f"@everyone 🚨 ¡Recordatorio! La clase de **{tipo}** es en {day_str} ({fecha_hora.strftime('%d/%m a las %H:%M')} UTC)", priority=PRIORITY_HIGH)
 
 # recordatorio_asesorias (sin cambios)
 @tasks.loop(hours=48)
+@leader_only("recordatorio_asesorias", run_key=two_day_run_key)
+@metrics.timed_task("recordatorio_asesorias")
 async def recordatorio_asesorias():
     await bot.wait_until_ready()
-    guild = bot.guilds[0] if bot.guilds else None
-    if not guild: return
-    asesorias_channel = discord.utils.get(guild.text_channels, name="asesorias-personales")
-    if asesorias_channel: await asesorias_channel.send("@everyone 📢 ¿Ya reservaste tu asesoría 1 a 1 Premium? ¡No te pierdas la oportunidad de progresar con guía personalizada! 💪")
+    await for_each_guild("recordatorio_asesorias", remind_asesorias)
+
+async def remind_asesorias(guild):
+    asesorias_channel = guild_channel(guild, "asesorias_channel")
+    if asesorias_channel: dispatcher.send(asesorias_channel, "@everyone 📢 ¿Ya reservaste tu asesoría 1 a 1 Premium? ¡No te pierdas la oportunidad de progresar con guía personalizada! 💪", priority=PRIORITY_HIGH)
 
 @tasks.loop(hours=24)
+@leader_only("ranking_semanal", run_key=ranking_run_key)
+@metrics.timed_task("ranking_semanal")
 async def ranking_semanal():
     await bot.wait_until_ready()
-    if datetime.now(timezone.utc).weekday() != 6 or datetime.now(timezone.utc).hour != 20: return
-    
-    guild = bot.guilds[0] if bot.guilds else None
-    if not guild: return
-    ranking_channel = discord.utils.get(guild.text_channels, name="ranking")
+    await for_each_guild("ranking_semanal", publish_weekly_ranking)
+
+async def publish_weekly_ranking(guild):
+    ranking_channel = guild_channel(guild, "ranking_channel")
     if not ranking_channel: return
     
-    async with db_pool.acquire() as conn: # <--- CAMBIO
-        sorted_users = await conn.fetch("SELECT user_id, weekly_xp FROM users WHERE weekly_xp > 0 ORDER BY weekly_xp DESC LIMIT 10")
+    sorted_users = await repo.weekly_top(guild.id, get_week_start(datetime.now(timezone.utc).date())) # <--- CAMBIO
     
     if not sorted_users: return
     
@@ -578,7 +1075,7 @@ async def ranking_semanal():
         user = guild.get_member(user_data['user_id'])
         embed.description += f"**{i+1}.** {user.mention if user else 'Usuario Desconocido'} - `{user_data['weekly_xp']}` XP\n"
     
-    await ranking_channel.send(embed=embed)
+    await dispatcher.send(ranking_channel, embed=embed, priority=PRIORITY_NORMAL)
     
     campeon_id = sorted_users[0]['user_id']
     campeon_member = guild.get_member(campeon_id)
@@ -587,26 +1084,103 @@ async def ranking_semanal():
         role_name = f"🏆 Campeón de la Semana #{max_n + 1}"
         campeon_role = await guild.create_role(name=role_name, color=discord.Color.gold(), mentionable=True)
         await campeon_member.add_roles(campeon_role)
-        await ranking_channel.send(f"¡Felicidades {campeon_member.mention}, eres el **{role_name}**!")
+        dispatcher.send(ranking_channel, f"¡Felicidades {campeon_member.mention}, eres el **{role_name}**!", priority=PRIORITY_NORMAL)
     
     if guild.member_count > 15:
-        for user_id, data in sorted_users[:10]:
-            member = guild.get_member(int(user_id))
+        for data in sorted_users[:10]:
+            member = guild.get_member(data['user_id'])
             if member:
-                try: await member.send(f"🚀 ¡Felicidades! Estás en el TOP 10 de la Academia con `{data['weekly_xp']}` XP esta semana.")
-                except discord.Forbidden: pass
+                # Si tiene los DMs cerrados, el dispatcher lo anota y sigue.
+                dispatcher.send(member, f"🚀 ¡Felicidades! Estás en el TOP 10 de la Academia con `{data['weekly_xp']}` XP esta semana.", priority=PRIORITY_LOW)
+
+    # No hace falta resetear nada: el lunes empieza otra semana en weekly_xp.
+
+async def run_role_reconcile(guild, dry_run=False, progress=None):
+    # Los niveles que aún estén en memoria se guardan antes de leerlos de la DB.
+    if xp_buffer and not dry_run:
+        await xp_buffer.flush()
+
+    def level_for(user_id, level):
+        # Si subió de nivel después de la lectura, la caché ya lo sabe.
+        cached = user_cache.get((guild.id, user_id))
+        return cached['level'] if cached else level
+
+    return await reconcile_level_roles(
+        guild, repo, role_registry, dry_run=dry_run, level_for=level_for,
+        concurrency=config.ROLE_RECONCILE_CONCURRENCY, per_second=config.ROLE_RECONCILE_PER_SECOND,
+        dispatcher=dispatcher, progress=progress
+    )
 
-    async with db_pool.acquire() as conn: # <--- CAMBIO: Reseteamos el XP semanal de todos con un solo comando, ¡mucho más eficiente!
-        await conn.execute("UPDATE users SET weekly_xp = 0")
-    print("XP semanal reseteado para todos los usuarios.")
+@tasks.loop(hours=config.ROLE_RECONCILE_HOURS or 24)
+@leader_only("reconcile_level_roles")
+@metrics.timed_task("reconcile_level_roles")
+async def reconcile_roles():
+    await bot.wait_until_ready()
+    await for_each_guild("reconcile_level_roles", reconcile_guild_roles)
+
+async def reconcile_guild_roles(guild):
+    summary = await run_role_reconcile(guild)
+    if summary['changes']:
+        print(
+            f"Roles de nivel en {guild.name}: {summary['applied']} corregidos de {summary['changes']} "
+            f"({summary['forbidden']} sin permisos, {summary['failed']} fallidos)."
+        )
+
+@tasks.loop(minutes=config.GUILD_CONFIG_REFRESH_MINUTES)
+@metrics.timed_task("refresh_guild_settings")
+async def refresh_guild_settings():
+    # Recoge los cambios de !configurar y los roles de nivel apuntados desde otra réplica.
+    await guild_settings.load(repo)
+    await role_registry.load(repo)
+
+# --- SALUD Y MÉTRICAS ---
+def scheduled_loops():
+    """Tareas programadas que deberían estar corriendo con la configuración actual."""
+    loops = [
+        flush_xp_ledger, rollup_xp_ledger, check_inactivity, ranking_semanal, recordatorio_asesorias,
+        post_daily_routine, refresh_guild_settings
+    ]
+    if xp_buffer:
+        loops.append(flush_xp_buffer)
+    if config.ROLE_RECONCILE_HOURS:
+        loops.append(reconcile_roles)
+    if routine_sources:
+        loops.append(refresh_routines)
+    return loops
+
+async def health_status():
+    """Estado de cada componente para /healthz: {nombre: (ok, detalle)}."""
+    latency = bot.latency
+    checks = {
+        "gateway": (bot.is_ready() and not bot.is_closed() and latency < config.HEALTH_MAX_LATENCY,
+                    f"{latency * 1000:.0f} ms"),
+    }
+
+    if db_pool is None:
+        checks["database"] = (False, "sin conexión")
+    else:
+        try:
+            start = perf_counter()
+            await asyncio.wait_for(repo.ping(), timeout=2)
+            checks["database"] = (True, f"{(perf_counter() - start) * 1000:.0f} ms, "
+                                        f"{db_pool.get_size() - db_pool.get_idle_size()}/{db_pool.get_size()} conexiones en uso")
+        except Exception as e:
+            checks["database"] = (False, repr(e))
+
+    stopped = [loop.coro.__name__ for loop in scheduled_loops() if not loop.is_running() or loop.failed()]
+    checks["loops"] = (not stopped, f"parados: {', '.join(stopped)}" if stopped else "todos en marcha")
+    checks["dispatcher"] = (dispatcher.running, f"{dispatcher.pending} envíos pendientes")
+    owned = leases.owned if leases else []
+    checks["leases"] = (leases is not None and leases.running,
+                        f"dueña de: {', '.join(owned)}" if owned else "en espera (otra réplica tiene las tareas)")
+    checks["class_scheduler"] = (
+        class_scheduler is not None and (class_scheduler.running or lease_name("revisar_clases") not in owned),
+        f"{len(class_scheduler) if class_scheduler else 0} avisos pendientes"
+    )
+    return checks
 
 # --- EJECUCIÓN DEL BOT ---
 if __name__ == "__main__":
-    if OPENAI_API_KEY:
-        openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
-    else:
-        print("⚠️ AVISO: No se proporcionó clave API de OpenAI. El comando !calistenico no funcionará.")
-    
     if not DISCORD_BOT_TOKEN or not DATABASE_URL: # <--- CAMBIO
         print("❌ ERROR: Falta el token de Discord o la URI de la base de datos.")
     else:
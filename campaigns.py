@@ -0,0 +1,103 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+import discord
+
+from dispatcher import PRIORITY_LOW
+
+# Usa el índice sobre (guild_id, last_message_timestamp). last_nudged_at es independiente de la
+# actividad real: avisar a alguien ya no cuenta como que haya escrito.
+INACTIVE_USERS_QUERY = """
+    SELECT user_id FROM users
+    WHERE guild_id = $1 AND last_message_timestamp < $2
+      AND (last_nudged_at IS NULL OR last_nudged_at < $2)
+"""
+
+MARK_NUDGED_QUERY = "UPDATE users SET last_nudged_at = $3 WHERE guild_id = $1 AND user_id = ANY($2::bigint[])"
+
+
+class RateLimiter:
+    """Reparte las llamadas para no pasar de `per_second` en total entre todos los workers."""
+    __slots__ = ("interval", "next_at")
+
+    def __init__(self, per_second):
+        self.interval = 1 / per_second
+        self.next_at = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(now, self.next_at)
+        self.next_at = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+async def run_inactivity_campaign(bot, repo, guild_id, cutoff, text, concurrency=5, per_second=2, batch_size=500,
+                                  dispatcher=None):
+    """
+    Manda un DM a todos los usuarios del servidor `guild_id` inactivos desde `cutoff`.
+    La DB solo se usa para leer la lista (por el repositorio, con reintentos) y para guardar
+    los resultados en bloque; los envíos van en paralelo con un límite de concurrencia y de ritmo.
+    Con `dispatcher`, los DMs salen por su cola con prioridad baja.
+    """
+    rows = await repo.inactive_users(guild_id, cutoff)
+
+    queue = asyncio.Queue()
+    for row in rows:
+        queue.put_nowait(row['user_id'])
+
+    limiter = RateLimiter(per_second)
+    summary = {"inactive": len(rows), "sent": 0, "forbidden": 0, "not_found": 0, "failed": 0}
+    done = []  # IDs ya tratados pendientes de guardar
+
+    async def save_done():
+        if not done:
+            return
+        batch = done[:]
+        done.clear()
+        try:
+            async with repo.pool.acquire() as conn:
+                await conn.execute(MARK_NUDGED_QUERY, guild_id, batch, datetime.now(timezone.utc))
+        except Exception:
+            # Se vuelven a poner para el siguiente intento: si se pierden, mañana se les avisa otra vez.
+            done.extend(batch)
+            raise
+
+    async def worker():
+        while True:
+            try:
+                user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await limiter.wait()
+            try:
+                user = bot.get_user(user_id) or await bot.fetch_user(user_id)
+                if dispatcher:
+                    await dispatcher.send(user, text, priority=PRIORITY_LOW)
+                else:
+                    await user.send(text)
+                summary["sent"] += 1
+            except discord.Forbidden:
+                # DMs cerrados: lo marcamos igualmente para no reintentarlo cada día.
+                summary["forbidden"] += 1
+            except discord.NotFound:
+                summary["not_found"] += 1
+            except Exception as e:
+                # Cualquier otro fallo afecta solo a este usuario: el resto de la campaña sigue.
+                summary["failed"] += 1
+                print(f"!!! ERROR al enviar DM de inactividad a {user_id}: {e!r}")
+                continue
+            done.append(user_id)
+            if len(done) >= batch_size:
+                try:
+                    await save_done()
+                except Exception as e:
+                    print(f"!!! ERROR al guardar los avisos de inactividad (se reintenta al final): {e!r}")
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        # Lo ya enviado se guarda aunque la campaña se corte, para no repetir el DM en la siguiente.
+        await save_done()
+    return summary
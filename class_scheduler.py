@@ -0,0 +1,228 @@
+import asyncio
+import heapq
+import itertools
+import time
+from datetime import datetime, timedelta, timezone
+
+# (tipo de aviso, antelación, texto para el mensaje). Ordenados de más a menos antelación.
+REMINDERS = (
+    ("48h", timedelta(hours=48), "2 días"),
+    ("24h", timedelta(hours=24), "MAÑANA"),
+)
+
+UPCOMING_CLASSES_QUERY = """
+    SELECT id, guild_id, tipo, fecha_hora, reminder_48h_sent, reminder_24h_sent
+    FROM clases WHERE fecha_hora >= $1
+    ORDER BY fecha_hora
+"""
+
+# Clases creadas desde la última carga (por ejemplo, con un comando atendido por otra réplica).
+NEW_CLASSES_QUERY = """
+    SELECT id, guild_id, tipo, fecha_hora, reminder_48h_sent, reminder_24h_sent
+    FROM clases WHERE id > $1 AND fecha_hora >= $2
+    ORDER BY id
+"""
+
+# Marcar el aviso como enviado antes de mandarlo: si dos procesos lo intentan, solo uno obtiene fila.
+CLAIM_REMINDER_QUERIES = {
+    "48h": "UPDATE clases SET reminder_48h_sent = TRUE WHERE id = $1 AND NOT reminder_48h_sent RETURNING guild_id, tipo, fecha_hora",
+    "24h": "UPDATE clases SET reminder_24h_sent = TRUE WHERE id = $1 AND NOT reminder_24h_sent RETURNING guild_id, tipo, fecha_hora",
+}
+RELEASE_REMINDER_QUERIES = {
+    "48h": "UPDATE clases SET reminder_48h_sent = FALSE WHERE id = $1",
+    "24h": "UPDATE clases SET reminder_24h_sent = FALSE WHERE id = $1",
+}
+
+EXPIRE = "expire"
+RETRY_DELAY = timedelta(minutes=1)
+# Un aviso atrasado (por ejemplo, tras un reinicio) solo se manda si llega con menos de este retraso.
+MISSED_GRACE = timedelta(hours=1)
+
+
+class ClassReminderScheduler:
+    """
+    Cola de prioridad con los próximos avisos de clase.
+    Duerme justo hasta el siguiente, y cada aviso se marca en la DB para que salga una sola vez
+    aunque el bot se reinicie. Las clases nuevas entran con add() sin esperar a ningún barrido.
+    Con `poll_seconds`, además se recogen cada tanto las clases que otra réplica haya creado, y
+    con `accepts(guild_id)` solo se avisa de las clases de los servidores que atiende este proceso.
+    Las lecturas van por el repositorio (con reintentos); las marcas, directas al pool.
+    """
+
+    def __init__(self, repo, send_reminder, on_expired=None, poll_seconds=None, accepts=None):
+        self._repo = repo
+        self._pool = repo.pool
+        self._send_reminder = send_reminder
+        self._accepts = accepts
+        self._on_expired = on_expired
+        self._poll_seconds = poll_seconds
+        self._heap = []
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._task = None
+        self._last_id = 0  # id más alto ya en la cola
+        self._next_poll = 0.0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _push(self, when, kind, class_id, guild_id):
+        heapq.heappush(self._heap, (when, next(self._seq), kind, class_id, guild_id))
+        self._wake.set()
+
+    def add(self, guild_id, class_id, fecha_hora, sent_48h=False, sent_24h=False):
+        self._last_id = max(self._last_id, class_id)
+        sent = {"48h": sent_48h, "24h": sent_24h}
+        for kind, advance, _ in REMINDERS:
+            if not sent[kind]:
+                self._push(fecha_hora - advance, kind, class_id, guild_id)
+        self._push(fecha_hora, EXPIRE, class_id, guild_id)
+
+    async def load(self):
+        """(Re)carga la cola entera desde la DB."""
+        now = datetime.now(timezone.utc)
+        async with self._pool.acquire() as conn:
+            # Las clases que ya pasaron mientras el bot estaba apagado se borran aquí.
+            await conn.execute("DELETE FROM clases WHERE fecha_hora < $1", now)
+        rows = await self._repo.upcoming_classes(now)
+        self._heap = []
+        for row in rows:
+            self.add(row['guild_id'], row['id'], row['fecha_hora'], row['reminder_48h_sent'], row['reminder_24h_sent'])
+        self._wake.set()
+        return len(rows)
+
+    async def load_new(self):
+        """Añade a la cola las clases creadas desde la última carga."""
+        rows = await self._repo.new_classes(self._last_id, datetime.now(timezone.utc))
+        for row in rows:
+            self.add(row['guild_id'], row['id'], row['fecha_hora'], row['reminder_48h_sent'], row['reminder_24h_sent'])
+        return len(rows)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    async def _run(self):
+        while True:
+            if self._poll_seconds and time.monotonic() >= self._next_poll:
+                self._next_poll = time.monotonic() + self._poll_seconds
+                try:
+                    await self.load_new()
+                except Exception as e:
+                    print(f"❌ ERROR al buscar clases nuevas: {e}")
+
+            delay = (self._heap[0][0] - datetime.now(timezone.utc)).total_seconds() if self._heap else None
+            if delay is None or delay > 0:
+                # Si entra una clase con un aviso anterior, add() nos despierta antes de tiempo.
+                if self._poll_seconds:
+                    delay = min(delay, self._poll_seconds) if delay is not None else self._poll_seconds
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, kind, class_id, guild_id = heapq.heappop(self._heap)
+            try:
+                await self._fire(kind, class_id, guild_id)
+            except Exception as e:
+                print(f"❌ ERROR en el aviso '{kind}' de la clase {class_id}: {e}")
+
+    async def _fire(self, kind, class_id, guild_id):
+        if kind == EXPIRE:
+            async with self._pool.acquire() as conn:
+                await conn.execute("DELETE FROM clases WHERE id = $1", class_id)
+            if self._on_expired:
+                self._on_expired(class_id)
+            return
+        if self._accepts and not await self._accepts(guild_id):
+            return  # Servidor de otro shard: lo avisa el proceso que lo atiende
+
+        async with self._pool.acquire() as conn:
+            row = await conn.fetchrow(CLAIM_REMINDER_QUERIES[kind], class_id)
+        if not row:
+            return  # Ya enviado (o la clase se borró)
+
+        now = datetime.now(timezone.utc)
+        index = [k for k, _, _ in REMINDERS].index(kind)
+        if row['fecha_hora'] <= now or row['fecha_hora'] - now < REMINDERS[index][1] - MISSED_GRACE:
+            # Aviso atrasado (el bot estuvo apagado o la clase se creó con menos antelación):
+            # se queda marcado como enviado sin mandarlo, para no avisar "MAÑANA" de una clase de hoy.
+            return
+
+        try:
+            await self._send_reminder(row['guild_id'], row['tipo'], row['fecha_hora'], REMINDERS[index][2])
+        except Exception:
+            # No se pudo mandar: lo liberamos y lo reintentamos en un minuto.
+            async with self._pool.acquire() as conn:
+                await conn.execute(RELEASE_REMINDER_QUERIES[kind], class_id)
+            self._push(now + RETRY_DELAY, kind, class_id, guild_id)
+            raise
+
+
+SCHEDULE_QUERY = """
+    SELECT tipo, fecha_hora FROM clases
+    WHERE guild_id = $1 AND fecha_hora >= $2
+    ORDER BY fecha_hora ASC
+    LIMIT $3
+"""
+
+
+class ScheduleCache:
+    """
+    Horario de clases de cada servidor ya formateado para !clases.
+    Solo se vuelve a consultar la DB cuando alguien lo invalida (clase nueva o expirada),
+    cuando empieza la primera clase de la lista o, como tarde, a los `ttl` segundos: invalidate()
+    solo ve los cambios de este proceso, no los que se hacen desde otra réplica.
+    """
+
+    def __init__(self, repo, render, limit=25, ttl=60):
+        self._repo = repo
+        self._render = render
+        self._limit = limit
+        self._ttl = timedelta(seconds=ttl)
+        self._entries = {}  # guild_id -> (texto, válido hasta)
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self, guild_id):
+        entry = self._entries.get(guild_id)
+        if entry is None or datetime.now(timezone.utc) >= entry[1]:
+            return None
+        return entry[0]
+
+    async def get(self, guild_id):
+        text = self._fresh(guild_id)
+        if text is not None:
+            self.hits += 1
+            return text
+        # Si llegan muchos !clases a la vez con la caché vacía, solo uno va a la DB.
+        async with self._lock:
+            text = self._fresh(guild_id)
+            if text is not None:
+                self.hits += 1
+                return text
+            self.misses += 1
+            now = datetime.now(timezone.utc)
+            rows = await self._repo.class_schedule(guild_id, now, self._limit)
+            text = self._render(rows)
+            expires = now + self._ttl
+            if rows:
+                expires = min(expires, rows[0]['fecha_hora'])
+            self._entries[guild_id] = (text, expires)
+            return text
+
+    def invalidate(self, *_):
+        # Las clases nuevas y las que expiran son pocas: basta con rehacer todos los horarios.
+        self._entries.clear()
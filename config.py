@@ -12,9 +12,30 @@ ADMIN_ROLE_ID = int(os.getenv("ADMIN_ROLE_ID"))
 
 # OpenAI
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Caché de respuestas de !calistenico (número de respuestas y segundos de vida)
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", "500"))
+AI_CACHE_TTL = int(os.getenv("AI_CACHE_TTL", "21600"))
+# Cola de peticiones a OpenAI: concurrencia global, tamaño máximo y límite por usuario
+AI_CONCURRENCY = int(os.getenv("AI_CONCURRENCY", "4"))
+AI_MAX_QUEUE = int(os.getenv("AI_MAX_QUEUE", "50"))
+AI_USER_RATE_PER_MINUTE = float(os.getenv("AI_USER_RATE_PER_MINUTE", "3"))
+AI_USER_BURST = int(os.getenv("AI_USER_BURST", "3"))
+# Segundos mínimos entre ediciones al ir mostrando una respuesta en streaming
+AI_STREAM_EDIT_INTERVAL = float(os.getenv("AI_STREAM_EDIT_INTERVAL", "1.2"))
 
 # Base de datos (Neon Postgres)
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Pool de conexiones: tamaño, sentencias preparadas que guarda cada conexión (0 detrás de
+# pgbouncer en modo transacción) y segundos máximos por consulta
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+# Reintentos de conexión y de lecturas ante cortes pasajeros (la espera base se duplica en cada
+# uno) y milisegundos a partir de los que una consulta se avisa como lenta
+DB_RETRIES = int(os.getenv("DB_RETRIES", "3"))
+DB_RETRY_BACKOFF_SECONDS = float(os.getenv("DB_RETRY_BACKOFF_SECONDS", "0.5"))
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "250"))
 
 # Google Sheets Vars
 GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID")
@@ -24,10 +45,35 @@ GCP_CLIENT_EMAIL = os.getenv("GCP_CLIENT_EMAIL")
 GCP_CLIENT_ID = os.getenv("GCP_CLIENT_ID")
 GCP_CLIENT_X509_CERT_URL = os.getenv("GCP_CLIENT_X509_CERT_URL")
 
+# Rutinas: copia local en disco y cada cuánto se comprueba si el Sheet cambió.
+# Si ROUTINES_FILE apunta a un JSON, se usa ese archivo en lugar de Google Sheets.
+ROUTINES_SNAPSHOT_FILE = os.getenv("ROUTINES_SNAPSHOT_FILE", "routines_snapshot.json")
+ROUTINES_REFRESH_MINUTES = int(os.getenv("ROUTINES_REFRESH_MINUTES", "30"))
+ROUTINES_FILE = os.getenv("ROUTINES_FILE")
+
 # XP y roles
 XP_PER_MESSAGE = 5
 XP_RUTINA_HECHA = 15
 XP_ATTACHMENT = 20
+XP_PER_LEVEL = 150
+MAX_ATTACHMENTS_PER_DAY = 4
+# Segundos mínimos entre dos mensajes que den XP base (0 = sin límite) y usuarios que se recuerdan
+XP_COOLDOWN_SECONDS = int(os.getenv("XP_COOLDOWN_SECONDS", "60"))
+XP_COOLDOWN_MAX_USERS = int(os.getenv("XP_COOLDOWN_MAX_USERS", "50000"))
+
+# Modo write-behind: el XP se acumula en memoria y se vuelca en bloque a la DB.
+XP_WRITE_BEHIND = os.getenv("XP_WRITE_BEHIND", "0") == "1"
+XP_FLUSH_SECONDS = int(os.getenv("XP_FLUSH_SECONDS", "10"))
+XP_FLUSH_MAX_PENDING = int(os.getenv("XP_FLUSH_MAX_PENDING", "200"))
+
+# Registro de movimientos de XP: cada cuánto se guarda y cada cuánto se resume por día
+XP_LEDGER_FLUSH_SECONDS = int(os.getenv("XP_LEDGER_FLUSH_SECONDS", "15"))
+XP_LEDGER_MAX_PENDING = int(os.getenv("XP_LEDGER_MAX_PENDING", "500"))
+XP_ROLLUP_MINUTES = int(os.getenv("XP_ROLLUP_MINUTES", "15"))
+
+# Caché en memoria de la tabla users
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "5000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))
 
 LEVEL_ROLES_BASE = {
     10: "ESPARTANO ⚔️",
@@ -52,6 +98,63 @@ LEVEL_ROLES_BASE = {
     200: "LEYENDA SUPREMA 🔱"
 }
 
+# Campaña de inactividad: días sin escribir, DMs en paralelo y DMs por segundo
+INACTIVITY_DAYS = int(os.getenv("INACTIVITY_DAYS", "7"))
+NUDGE_CONCURRENCY = int(os.getenv("NUDGE_CONCURRENCY", "5"))
+NUDGE_PER_SECOND = float(os.getenv("NUDGE_PER_SECOND", "2"))
+
+# Reconciliación de roles de nivel: cada cuántas horas se repasan todos los miembros (0 = solo
+# con !reconciliar_roles), cambios de rol en paralelo y cambios por segundo
+ROLE_RECONCILE_HOURS = int(os.getenv("ROLE_RECONCILE_HOURS", "24"))
+ROLE_RECONCILE_CONCURRENCY = int(os.getenv("ROLE_RECONCILE_CONCURRENCY", "4"))
+ROLE_RECONCILE_PER_SECOND = float(os.getenv("ROLE_RECONCILE_PER_SECOND", "5"))
+
+# Importación del XP de mensajes antiguos: canales leídos a la vez y mensajes por lote (COPY + fusión)
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", "3"))
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "5000"))
+
+# Envíos a Discord: workers, presupuesto por canal y por DM (ráfaga y mensajes por segundo)
+# y segundos durante los que se juntan los anuncios de subida de nivel de un mismo canal
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "4"))
+OUTBOUND_CHANNEL_BURST = int(os.getenv("OUTBOUND_CHANNEL_BURST", "5"))
+OUTBOUND_CHANNEL_PER_SECOND = float(os.getenv("OUTBOUND_CHANNEL_PER_SECOND", "1"))
+OUTBOUND_DM_BURST = int(os.getenv("OUTBOUND_DM_BURST", "2"))
+OUTBOUND_DM_PER_SECOND = float(os.getenv("OUTBOUND_DM_PER_SECOND", "0.5"))
+LEVEL_UP_MERGE_SECONDS = float(os.getenv("LEVEL_UP_MERGE_SECONDS", "3"))
+# Segundos que se espera al cerrar a que salga lo que quede en la cola antes de descartarlo
+OUTBOUND_DRAIN_SECONDS = float(os.getenv("OUTBOUND_DRAIN_SECONDS", "10"))
+
+# Varios servidores: sharding (por defecto, lo decide Discord), tareas programadas en paralelo
+# entre servidores, servidor al que pasan los datos de antes de haber varios, y cada cuánto
+# se relee la configuración de cada servidor (guild_config)
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+SHARD_IDS = [int(shard) for shard in os.getenv("SHARD_IDS").split(",")] if os.getenv("SHARD_IDS") else None
+GUILD_FANOUT_CONCURRENCY = int(os.getenv("GUILD_FANOUT_CONCURRENCY", "5"))
+LEGACY_GUILD_ID = int(os.getenv("LEGACY_GUILD_ID")) if os.getenv("LEGACY_GUILD_ID") else None
+GUILD_CONFIG_REFRESH_MINUTES = int(os.getenv("GUILD_CONFIG_REFRESH_MINUTES", "5"))
+
+# Varias réplicas: cada tarea programada la ejecuta solo la que tiene su concesión en la DB.
+# Segundos que dura una concesión, cada cuánto se renueva y nombre de esta réplica (por defecto, host:pid)
+LEASE_TTL_SECONDS = int(os.getenv("LEASE_TTL_SECONDS", "15"))
+LEASE_RENEW_SECONDS = int(os.getenv("LEASE_RENEW_SECONDS", "5"))
+REPLICA_ID = os.getenv("REPLICA_ID")
+# Cada cuánto busca clases nuevas la réplica que manda los avisos (las pudo crear otra)
+CLASS_POLL_SECONDS = int(os.getenv("CLASS_POLL_SECONDS", "60"))
+
+# Máximo de clases que muestra !clases
+CLASES_LIST_LIMIT = int(os.getenv("CLASES_LIST_LIMIT", "25"))
+# Segundos que dura como mucho el horario de !clases en caché (recoge las clases creadas o
+# borradas desde otra réplica, que no invalidan la caché de esta)
+CLASES_CACHE_SECONDS = int(os.getenv("CLASES_CACHE_SECONDS", "60"))
+
+# Servidor HTTP de /healthz y /metrics, y latencia máxima del gateway (segundos) para darlo por sano
+HEALTH_HOST = os.getenv("HEALTH_HOST", "0.0.0.0")
+HEALTH_PORT = int(os.getenv("PORT", os.getenv("HEALTH_PORT", "8080")))
+HEALTH_MAX_LATENCY = float(os.getenv("HEALTH_MAX_LATENCY", "10"))
+
+# Crear al arrancar todos los roles de nivel que falten en el servidor
+PROVISION_LEVEL_ROLES = os.getenv("PROVISION_LEVEL_ROLES", "1") == "1"
+
 LEVEL_ROLES_MODIFIERS = {
     5: "CALISTÉNICO",
     1: "DISCIPLINADO",
@@ -0,0 +1,228 @@
+import asyncio
+import itertools
+
+import discord
+
+import metrics
+from ai_queue import TokenBucket
+
+# Orden de salida: la rutina del día y los recordatorios de clases pasan por delante del resto.
+PRIORITY_HIGH = 0    # Rutina del día, recordatorios de clases y asesorías
+PRIORITY_NORMAL = 1  # Ranking, bienvenidas y cambios de rol
+PRIORITY_LOW = 2     # Anuncios de subida de nivel y DMs de campañas
+
+PRIORITY_NAMES = {PRIORITY_HIGH: "high", PRIORITY_NORMAL: "normal", PRIORITY_LOW: "low"}
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+
+class DispatcherStoppedError(Exception):
+    """El dispatcher se ha parado (el bot se está cerrando): el trabajo no se envió."""
+
+
+class _Job:
+    __slots__ = ("action", "bucket_key", "future", "key", "priority")
+
+    def __init__(self, action, bucket_key, future, key, priority):
+        self.action = action
+        self.bucket_key = bucket_key
+        self.future = future
+        self.key = key
+        self.priority = priority
+
+
+def _consume_exception(future):
+    # Los envíos "dispara y olvida" no esperan el resultado: así asyncio no avisa de excepciones sin leer.
+    if not future.cancelled():
+        future.exception()
+
+
+def _split_lines(lines, limit=DISCORD_MESSAGE_LIMIT):
+    chunks, current = [], ""
+    for line in lines:
+        line = line[:limit]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class OutboundDispatcher:
+    """
+    Cola única para todo lo que el bot manda a Discord.
+    Unos pocos workers sacan los trabajos por prioridad; cada canal y cada DM tiene su cubo de
+    fichas, y si un canal se queda sin presupuesto su mensaje espera fuera de la cola sin frenar
+    a los demás. Quien encola recibe un future: puede esperarlo o seguir sin más.
+    """
+
+    def __init__(self, workers=4, channel_burst=5, channel_per_second=1.0, dm_burst=2, dm_per_second=0.5,
+                 merge_seconds=3.0, max_buckets=10000):
+        self._worker_count = workers
+        self._channel_budget = (channel_burst, channel_per_second)
+        self._dm_budget = (dm_burst, dm_per_second)
+        self._merge_seconds = merge_seconds
+        self._max_buckets = max_buckets
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._buckets = {}
+        self._keyed = {}          # clave -> trabajo aún sin empezar (para fusionar repetidos)
+        self._announcements = {}  # channel.id -> (canal, prioridad, {clave: línea}) pendientes de fusionar
+        self._deferred = 0        # trabajos esperando presupuesto fuera de la cola
+        self._unfinished = set()  # futures aún sin resultado, para fallarlos al parar
+        self._stopping = False
+        self._workers = []
+
+    @property
+    def pending(self):
+        return self._queue.qsize() + self._deferred
+
+    @property
+    def running(self):
+        return bool(self._workers) and not all(worker.done() for worker in self._workers)
+
+    def start(self):
+        if self._workers:
+            return
+        self._stopping = False
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._worker_count)]
+
+    async def stop(self, timeout=10.0):
+        """
+        Deja de aceptar trabajos, espera hasta `timeout` segundos a que salga lo ya encolado y
+        después para los workers. Lo que no haya salido falla con DispatcherStoppedError, para
+        que quien lo espera no se quede colgado.
+        """
+        # Los anuncios aún sin fusionar entran en la cola antes de cerrarla.
+        for channel_id in list(self._announcements):
+            self._flush_announcements(channel_id)
+        self._stopping = True
+        if self.running:
+            try:
+                await asyncio.wait_for(self.drain(), timeout)
+            except asyncio.TimeoutError:
+                print(f"⚠️ AVISO: {len(self._unfinished)} envíos a Discord sin terminar al cerrar; se descartan.")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for future in list(self._unfinished):
+            if not future.done():
+                future.set_exception(DispatcherStoppedError("El bot se está cerrando."))
+
+    async def drain(self):
+        """Manda ya los anuncios pendientes y espera a que la cola quede vacía."""
+        for channel_id in list(self._announcements):
+            self._flush_announcements(channel_id)
+        while True:
+            await self._queue.join()
+            if not self._deferred:
+                return
+            await asyncio.sleep(0.05)
+
+    # --- Encolar ---
+    def _enqueue(self, action, bucket_key=None, priority=PRIORITY_NORMAL, key=None):
+        if self._stopping:
+            future = asyncio.get_running_loop().create_future()
+            future.add_done_callback(_consume_exception)
+            future.set_exception(DispatcherStoppedError("El bot se está cerrando."))
+            return future
+        if key is not None:
+            job = self._keyed.get(key)
+            if job is not None:
+                # Aún no ha salido: basta con la versión más reciente.
+                job.action = action
+                return job.future
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        future.add_done_callback(self._unfinished.discard)
+        self._unfinished.add(future)
+        job = _Job(action, bucket_key, future, key, priority)
+        if key is not None:
+            self._keyed[key] = job
+        self._queue.put_nowait((priority, next(self._seq), job))
+        return future
+
+    def send(self, target, content=None, *, priority=PRIORITY_NORMAL, **kwargs):
+        """Encola target.send(content, **kwargs). `target` es un canal, un usuario o un miembro."""
+        kind = "dm" if isinstance(target, (discord.User, discord.Member)) else "channel"
+        return self._enqueue(lambda: target.send(content, **kwargs), (kind, target.id), priority)
+
+    def submit(self, action, *, priority=PRIORITY_NORMAL, key=None):
+        """
+        Encola cualquier llamada a Discord (`action` es una función async sin argumentos).
+        Con `key`, un trabajo igual que aún no haya empezado se sustituye en lugar de repetirse.
+        """
+        return self._enqueue(action, None, priority, key)
+
+    def announce(self, channel, line, *, key=None, priority=PRIORITY_LOW):
+        """
+        Añade una línea a los anuncios del canal. Las que lleguen durante `merge_seconds` salen
+        juntas en un solo mensaje; con la misma `key` solo se queda la última.
+        """
+        if self._stopping:
+            return
+        pending = self._announcements.get(channel.id)
+        if pending is None:
+            pending = self._announcements[channel.id] = (channel, priority, {})
+            asyncio.get_running_loop().call_later(self._merge_seconds, self._flush_announcements, channel.id)
+        else:
+            metrics.OUTBOUND_MERGED.inc()
+        pending[2][key if key is not None else next(self._seq)] = line
+
+    def _flush_announcements(self, channel_id):
+        pending = self._announcements.pop(channel_id, None)
+        if not pending:
+            return
+        channel, priority, lines = pending
+        for chunk in _split_lines(lines.values()):
+            self.send(channel, chunk, priority=priority)
+
+    # --- Workers ---
+    def _bucket(self, bucket_key):
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            if len(self._buckets) >= self._max_buckets:
+                # Un cubo lleno es igual que no tenerlo: se pueden tirar sin perder nada.
+                self._buckets = {k: b for k, b in self._buckets.items() if not b.is_full()}
+            burst, rate = self._dm_budget if bucket_key[0] == "dm" else self._channel_budget
+            bucket = self._buckets[bucket_key] = TokenBucket(burst, rate)
+        return bucket
+
+    def _requeue(self, item):
+        self._deferred -= 1
+        self._queue.put_nowait(item)
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            job = item[2]
+            try:
+                if job.future.cancelled():
+                    continue
+                if job.bucket_key is not None:
+                    bucket = self._bucket(job.bucket_key)
+                    if not bucket.take():
+                        # Este canal no tiene presupuesto: vuelve a la cola cuando lo tenga.
+                        self._deferred += 1
+                        asyncio.get_running_loop().call_later(bucket.wait_time(), self._requeue, item)
+                        continue
+                if job.key is not None:
+                    self._keyed.pop(job.key, None)
+                result = await job.action()
+                metrics.OUTBOUND_JOBS.inc(1, PRIORITY_NAMES[job.priority], "ok")
+                if not job.future.done():
+                    job.future.set_result(result)
+            except Exception as e:
+                if isinstance(e, discord.Forbidden):
+                    metrics.OUTBOUND_JOBS.inc(1, PRIORITY_NAMES[job.priority], "forbidden")
+                else:
+                    metrics.OUTBOUND_JOBS.inc(1, PRIORITY_NAMES[job.priority], "error")
+                    print(f"!!! ERROR al enviar a Discord (prioridad {PRIORITY_NAMES[job.priority]}): {e}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,78 @@
+import config
+
+# Valores de un servidor sin configuración propia: los que usaba el bot cuando solo había uno.
+DEFAULTS = {
+    "routine_channel": "rutina-semanal",
+    "level_up_channel": "level-up",
+    "ranking_channel": "ranking",
+    "welcome_channel": "bienvenida",
+    "asesorias_channel": "asesorias-personales",
+    "clases_gratis_channel": "clases-grupales",
+    "clases_premium_channel": "clases-exclusivas",
+    "routine_sheet": "Rutinas Academia Bot",
+    "xp_per_message": config.XP_PER_MESSAGE,
+    "xp_rutina_hecha": config.XP_RUTINA_HECHA,
+    "xp_attachment": config.XP_ATTACHMENT,
+    "admin_role_id": config.ADMIN_ROLE_ID,
+}
+
+
+class GuildSettings:
+    """Configuración de un servidor (una fila de guild_config con los huecos rellenos por defecto)."""
+    FIELDS = tuple(DEFAULTS)
+    __slots__ = ("guild_id",) + FIELDS
+
+    def __init__(self, guild_id, **values):
+        self.guild_id = guild_id
+        for field in self.FIELDS:
+            value = values.get(field)
+            setattr(self, field, DEFAULTS[field] if value is None else value)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['guild_id'], **{field: row[field] for field in cls.FIELDS})
+
+    def is_default(self, field):
+        return getattr(self, field) == DEFAULTS[field]
+
+
+SETTINGS_COLUMNS = ", ".join(GuildSettings.FIELDS)
+
+
+class GuildSettingsStore:
+    """
+    La configuración de todos los servidores, en memoria: on_message la consulta sin ir a la DB.
+    Se lee entera con load() (al arrancar y cada tanto, por si la cambió otra réplica).
+    """
+
+    def __init__(self):
+        self._settings = {}
+
+    def __len__(self):
+        return len(self._settings)
+
+    def get(self, guild_id):
+        settings = self._settings.get(guild_id)
+        if settings is None:
+            settings = self._settings[guild_id] = GuildSettings(guild_id)
+        return settings
+
+    def routine_sheets(self):
+        return {settings.routine_sheet for settings in self._settings.values()} | {DEFAULTS["routine_sheet"]}
+
+    async def load(self, repo):
+        rows = await repo.guild_settings()
+        self._settings = {row['guild_id']: GuildSettings.from_row(row) for row in rows}
+        return len(rows)
+
+    async def update(self, repo, guild_id, field, value):
+        """
+        Cambia un campo del servidor y devuelve su configuración nueva. `value` llega como texto
+        (desde un comando); "-" vuelve al valor por defecto. ValueError si el campo o el valor no valen.
+        """
+        if field not in DEFAULTS:
+            raise ValueError(f"Campo desconocido: {field}")
+        parsed = None if value == "-" else type(DEFAULTS[field])(value)
+        row = await repo.update_guild_setting(guild_id, field, parsed)
+        settings = self._settings[guild_id] = GuildSettings.from_row(row)
+        return settings
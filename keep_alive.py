@@ -1,15 +1,37 @@
-from flask import Flask
-from threading import Thread
+from aiohttp import web
 
-app = Flask('')
+import metrics
 
-@app.route('/')
-def home():
-    return 'Bot is running!'
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
 
-def run():
-    app.run(host='0.0.0.0', port=8080)
+async def keep_alive(health_check, host="0.0.0.0", port=8080):
+    """
+    Servidor HTTP en el mismo event loop que el bot (sin hilos aparte).
+    `health_check()` devuelve {componente: (ok, detalle)}; /healthz responde 503 si alguno falla.
+    Devuelve el runner para poder pararlo con `await runner.cleanup()`.
+    """
 
-def keep_alive():
-    t = Thread(target=run)
-    t.start()
\ No newline at end of file
+    async def home(request):
+        return web.Response(text="Bot is running!")
+
+    async def healthz(request):
+        checks = await health_check()
+        healthy = all(ok for ok, _ in checks.values())
+        body = {
+            "status": "ok" if healthy else "fail",
+            "checks": {name: {"ok": ok, "detail": detail} for name, (ok, detail) in checks.items()},
+        }
+        return web.json_response(body, status=200 if healthy else 503)
+
+    async def metrics_endpoint(request):
+        return web.Response(body=metrics.render().encode(), headers={"Content-Type": PROMETHEUS_CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/", home)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/metrics", metrics_endpoint)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
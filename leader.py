@@ -0,0 +1,129 @@
+import asyncio
+import os
+import socket
+import time
+import uuid
+
+# Coge (o renueva) de una vez todas las concesiones libres, caducadas o ya nuestras.
+# Devuelve las tareas que quedan a nuestro nombre.
+ACQUIRE_QUERY = """
+    INSERT INTO scheduler_leases (job, owner, expires_at)
+    SELECT job, $2, NOW() + $3 * INTERVAL '1 second'
+    FROM UNNEST($1::text[]) AS job
+    ON CONFLICT (job) DO UPDATE SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at
+    WHERE scheduler_leases.owner = EXCLUDED.owner OR scheduler_leases.expires_at < NOW()
+    RETURNING job
+"""
+
+# Apunta la ejecución `run_key` de una tarea solo si seguimos siendo los dueños y nadie la hizo ya.
+CLAIM_RUN_QUERY = """
+    UPDATE scheduler_leases SET last_run = $3
+    WHERE job = $1 AND owner = $2 AND expires_at > NOW() AND last_run IS DISTINCT FROM $3
+    RETURNING job
+"""
+
+# Soltar es dar la concesión por caducada: la fila se queda para conservar last_run, y así la
+# réplica que la coja no repite la ejecución del periodo en curso.
+RELEASE_QUERY = "UPDATE scheduler_leases SET expires_at = NOW() WHERE owner = $1"
+
+
+def default_owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class LeaseManager:
+    """
+    Reparte las tareas programadas entre las réplicas del bot con concesiones en scheduler_leases.
+    Cada `renew_seconds` se renuevan las que ya son nuestras y se cogen las libres o caducadas;
+    si el dueño de una muere, otra réplica la hereda en cuanto caduca (`ttl` segundos).
+    Localmente damos una concesión por perdida antes de que caduque en la DB, nunca después.
+    """
+
+    def __init__(self, pool, jobs, owner=None, ttl=15, renew_seconds=5, on_acquired=None, on_lost=None):
+        self._pool = pool
+        self.jobs = tuple(jobs)
+        self.owner = owner or default_owner()
+        self.ttl = ttl
+        self.renew_seconds = renew_seconds
+        self._on_acquired = on_acquired
+        self._on_lost = on_lost
+        self._held = {}  # tarea -> time.monotonic() hasta el que seguro que es nuestra
+        self._task = None
+
+    @property
+    def owned(self):
+        return sorted(job for job in self._held if self.owns(job))
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def owns(self, job):
+        deadline = self._held.get(job)
+        return deadline is not None and time.monotonic() < deadline
+
+    async def wait_for(self, job, timeout=0):
+        """Espera hasta `timeout` segundos a ser el dueño de `job` (por si el anterior acaba de caer)."""
+        deadline = time.monotonic() + timeout
+        while not self.owns(job):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(min(1, self.renew_seconds))
+        return True
+
+    async def claim_run(self, job, run_key):
+        """True si esta réplica debe hacer la ejecución `run_key` de `job` (y queda apuntada)."""
+        if not self.owns(job):
+            return False
+        async with self._pool.acquire() as conn:
+            return await conn.fetchval(CLAIM_RUN_QUERY, job, self.owner, run_key) is not None
+
+    async def renew(self):
+        before = set(self.owned)
+        started = time.monotonic()
+        try:
+            async with self._pool.acquire() as conn:
+                rows = await conn.fetch(ACQUIRE_QUERY, list(self.jobs), self.owner, self.ttl)
+        except Exception as e:
+            # Sin DB no podemos renovar: las que tenemos caducan solas cuando toque.
+            print(f"⚠️ AVISO: No se pudieron renovar las concesiones de tareas: {e}")
+        else:
+            self._held = {row['job']: started + self.ttl for row in rows}
+        after = set(self.owned)
+
+        for job in sorted(after - before):
+            print(f"👑 Esta réplica ({self.owner}) se encarga ahora de {job}.")
+            await self._notify(self._on_acquired, job)
+        for job in sorted(before - after):
+            print(f"⚠️ Esta réplica ({self.owner}) ya no se encarga de {job}.")
+            await self._notify(self._on_lost, job)
+
+    async def _notify(self, callback, job):
+        if callback is None:
+            return
+        try:
+            await callback(job)
+        except Exception as e:
+            print(f"❌ ERROR al cambiar el dueño de {job}: {e}")
+
+    async def _run(self):
+        while True:
+            await self.renew()
+            await asyncio.sleep(self.renew_seconds)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Suelta todas las concesiones para que otra réplica las coja sin esperar a que caduquen."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._held = {}
+        try:
+            async with self._pool.acquire() as conn:
+                await conn.execute(RELEASE_QUERY, self.owner)
+        except Exception as e:
+            print(f"⚠️ AVISO: No se pudieron soltar las concesiones (caducarán solas): {e}")
@@ -0,0 +1,302 @@
+import contextvars
+import functools
+import math
+import re
+import time
+
+# --- Tipos de métricas (formato de texto de Prometheus) ---
+
+_REGISTRY = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (f'{name}="{_escape(value)}"' for name, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _REGISTRY.append(self)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, *labels):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def total(self):
+        return sum(self._values.values())
+
+    def render(self):
+        lines = self._header()
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._function = None
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def set_function(self, function):
+        """`function()` devuelve {tupla_de_etiquetas: valor} y se evalúa al exportar."""
+        self._function = function
+
+    def render(self):
+        lines = self._header()
+        values = self._function() if self._function else self._values
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._series = {}  # etiquetas -> [conteos por bucket, suma, total]
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def summary(self, *labels):
+        """(número de observaciones, suma) de una serie."""
+        series = self._series.get(labels)
+        return (series[2], series[1]) if series else (0, 0.0)
+
+    def render(self):
+        lines = self._header()
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = ("le", _format_value(bound) if bound != math.inf else "+Inf")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Métricas del bot ---
+
+ON_MESSAGE_SECONDS = Histogram(
+    "calistenico_on_message_seconds", "Tiempo de procesado del XP de un mensaje en on_message")
+DB_ROUND_TRIPS_PER_MESSAGE = Histogram(
+    "calistenico_db_round_trips_per_message", "Consultas a la DB por mensaje procesado",
+    buckets=(0, 1, 2, 3, 4, 5, 8))
+DB_QUERIES = Counter("calistenico_db_queries_total", "Consultas a la DB", ("method", "query"))
+DB_QUERY_SECONDS = Histogram(
+    "calistenico_db_query_seconds", "Duración de las consultas a la DB", ("method", "query"))
+DB_SLOW_QUERIES = Counter(
+    "calistenico_db_slow_queries_total", "Consultas que pasaron del umbral de consulta lenta", ("query",))
+DB_RETRIES = Counter(
+    "calistenico_db_retries_total", "Lecturas repetidas tras un corte pasajero de la conexión", ("query",))
+DB_POOL_ACQUIRE_SECONDS = Histogram(
+    "calistenico_db_pool_acquire_seconds", "Espera para obtener una conexión del pool")
+OPENAI_REQUEST_SECONDS = Histogram(
+    "calistenico_openai_request_seconds", "Duración de las llamadas a OpenAI", ("kind",),
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60))
+OPENAI_TOKENS = Counter("calistenico_openai_tokens_total", "Tokens consumidos en OpenAI", ("kind", "type"))
+OUTBOUND_JOBS = Counter(
+    "calistenico_outbound_jobs_total", "Envíos y acciones hechos por el dispatcher", ("priority", "result"))
+OUTBOUND_MERGED = Counter("calistenico_outbound_merged_total", "Anuncios fusionados con otro del mismo canal")
+OUTBOUND_PENDING = Gauge("calistenico_outbound_pending", "Trabajos esperando en el dispatcher")
+TASK_RUN_SECONDS = Histogram(
+    "calistenico_task_run_seconds", "Duración de cada ejecución de las tareas programadas", ("task",),
+    buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900))
+STARTUP_SECONDS = Gauge(
+    "calistenico_startup_seconds", "Tiempo de inicialización de cada componente al arrancar", ("component",))
+TASK_LAST_RUN = Gauge(
+    "calistenico_task_last_run_timestamp_seconds", "Última vez que terminó cada tarea programada", ("task",))
+SCHEDULER_LEASE_OWNED = Gauge(
+    "calistenico_scheduler_lease_owned", "1 si esta réplica es la dueña de la tarea programada", ("task",))
+
+
+# --- Seguimiento de round trips por mensaje ---
+
+class _RoundTrips:
+    __slots__ = ("count",)
+
+    def __init__(self):
+        self.count = 0
+
+
+_round_trips = contextvars.ContextVar("db_round_trips", default=None)
+
+
+def track_round_trips():
+    """Empieza a contar las consultas que haga la tarea actual. Devuelve el contador."""
+    tracker = _RoundTrips()
+    _round_trips.set(tracker)
+    return tracker
+
+
+def observe_openai(kind, seconds, usage=None):
+    OPENAI_REQUEST_SECONDS.observe(seconds, kind)
+    if usage:
+        OPENAI_TOKENS.inc(usage.prompt_tokens or 0, kind, "prompt")
+        OPENAI_TOKENS.inc(usage.completion_tokens or 0, kind, "completion")
+
+
+def timed_task(name):
+    """Decorador para las tareas de tasks.loop: mide cada ejecución y apunta cuándo terminó."""
+    def decorator(coro):
+        @functools.wraps(coro)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await coro(*args, **kwargs)
+            finally:
+                TASK_RUN_SECONDS.observe(time.perf_counter() - start, name)
+                TASK_LAST_RUN.set(time.time(), name)
+        return wrapper
+    return decorator
+
+
+# --- Pool de asyncpg instrumentado ---
+
+_QUERY_METHODS = ("execute", "executemany", "fetch", "fetchrow", "fetchval", "copy_records_to_table")
+
+_QUERY_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", re.IGNORECASE)
+
+
+def describe_query(query):
+    """Nombre genérico de una consulta sin nombre propio: su verbo y su tabla ("delete clases")."""
+    verb = query.split(None, 1)[0].lower() if query.strip() else "?"
+    table = _QUERY_TABLE.search(query)
+    return f"{verb} {table.group(1)}" if table else verb
+
+
+class _InstrumentedConnection:
+    """Envuelve una conexión para contar y cronometrar cada consulta."""
+    __slots__ = ("_conn", "_pool")
+
+    def __init__(self, conn, pool):
+        self._conn = conn
+        self._pool = pool
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if name not in _QUERY_METHODS:
+            return attr
+
+        async def timed(*args, **kwargs):
+            tracker = _round_trips.get()
+            if tracker is not None:
+                tracker.count += 1
+            start = time.perf_counter()
+            try:
+                return await attr(*args, **kwargs)
+            finally:
+                self._pool.observe(name, args, time.perf_counter() - start)
+        return timed
+
+
+class _TimedAcquire:
+    __slots__ = ("_pool", "_conn")
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        self._conn = await self._pool._pool.acquire()
+        DB_POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - start)
+        return _InstrumentedConnection(self._conn, self._pool)
+
+    async def __aexit__(self, *exc):
+        await self._pool._pool.release(self._conn)
+
+
+class InstrumentedPool:
+    """
+    Mismo uso que el pool de asyncpg, pero midiendo esperas y consultas.
+    `query_names` da nombre a cada texto de consulta en las métricas; las que tarden más de
+    `slow_seconds` se avisan por consola.
+    """
+
+    def __init__(self, pool, query_names=None, slow_seconds=None):
+        self._pool = pool
+        self._query_names = query_names or {}
+        self._slow_seconds = slow_seconds
+        self._described = {}
+
+    def acquire(self):
+        return _TimedAcquire(self)
+
+    def query_name(self, method, args):
+        if method == "copy_records_to_table":
+            return f"copy {args[0]}" if args else "copy"
+        query = args[0] if args else ""
+        name = self._query_names.get(query)
+        if name is None:
+            name = self._described.get(query)
+            if name is None:
+                name = self._described[query] = describe_query(query)
+        return name
+
+    def observe(self, method, args, seconds):
+        name = self.query_name(method, args)
+        DB_QUERIES.inc(1, method, name)
+        DB_QUERY_SECONDS.observe(seconds, method, name)
+        if self._slow_seconds is not None and seconds >= self._slow_seconds:
+            DB_SLOW_QUERIES.inc(1, name)
+            print(f"🐢 Consulta lenta: {name} ({method}) tardó {seconds * 1000:.0f} ms.")
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
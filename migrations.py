@@ -0,0 +1,338 @@
+# Migraciones versionadas del esquema. Cada una se aplica una sola vez, en su propia
+# transacción, y queda apuntada en schema_migrations: lanzarlas de nuevo al arrancar no hace nada.
+# Para cambiar el esquema se añade una migración al final; nunca se edita una ya publicada.
+
+# Clave del bloqueo que serializa las migraciones si arrancan dos procesos a la vez.
+# Es un bloqueo de transacción, así que también funciona detrás de pgbouncer.
+MIGRATION_LOCK_ID = 727_150_001
+
+CREATE_MIGRATIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+"""
+
+MIGRATIONS = [
+    (1, "tablas base: users y clases", [
+        # Las instalaciones antiguas ya las tienen (creadas a mano): IF NOT EXISTS las respeta.
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            xp INTEGER NOT NULL DEFAULT 0,
+            level INTEGER NOT NULL DEFAULT 1,
+            last_message_timestamp TIMESTAMPTZ,
+            last_rutina_date DATE,
+            last_attachment_date DATE,
+            attachments_today INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS clases (
+            id SERIAL PRIMARY KEY,
+            tipo TEXT NOT NULL,
+            fecha_hora TIMESTAMPTZ NOT NULL
+        )
+        """,
+    ]),
+    (2, "tablas del bot: rutinas, XP semanal, registro de XP y avisos de clases", [
+        """
+        CREATE TABLE IF NOT EXISTS used_routines (
+            week_key TEXT NOT NULL,
+            routine_key TEXT NOT NULL,
+            used_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (week_key, routine_key)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS routine_enhancements (
+            cache_key TEXT PRIMARY KEY,
+            content TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_nudged_at TIMESTAMPTZ",
+        """
+        CREATE TABLE IF NOT EXISTS weekly_xp (
+            week_start DATE NOT NULL,
+            user_id BIGINT NOT NULL,
+            xp INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (week_start, user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS xp_events (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            amount INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS xp_daily (
+            day DATE NOT NULL,
+            user_id BIGINT NOT NULL,
+            xp INTEGER NOT NULL DEFAULT 0,
+            events INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, user_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS xp_daily_user_id_idx ON xp_daily (user_id)",
+        """
+        CREATE TABLE IF NOT EXISTS xp_rollup_state (
+            id INTEGER PRIMARY KEY,
+            last_event_id BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        "INSERT INTO xp_rollup_state (id, last_event_id) VALUES (1, 0) ON CONFLICT DO NOTHING",
+        # Saldo de apertura: el XP que ya tenía cada usuario antes de existir el registro.
+        """
+        INSERT INTO xp_events (user_id, amount, reason)
+        SELECT user_id, xp, 'opening' FROM users
+        WHERE xp <> 0 AND NOT EXISTS (SELECT 1 FROM xp_events)
+        """,
+        "ALTER TABLE clases ADD COLUMN IF NOT EXISTS reminder_48h_sent BOOLEAN NOT NULL DEFAULT FALSE",
+        "ALTER TABLE clases ADD COLUMN IF NOT EXISTS reminder_24h_sent BOOLEAN NOT NULL DEFAULT FALSE",
+        "CREATE INDEX IF NOT EXISTS users_xp_idx ON users (xp DESC)",
+    ]),
+    (3, "índices de las consultas frecuentes", [
+        # Campaña de inactividad: rango sobre last_message_timestamp y filtro de last_nudged_at
+        # resueltos solo con el índice (index-only scan).
+        "DROP INDEX IF EXISTS users_last_message_timestamp_idx",
+        """
+        CREATE INDEX IF NOT EXISTS users_inactivity_idx
+        ON users (last_message_timestamp) INCLUDE (user_id, last_nudged_at)
+        """,
+        # Top semanal y puesto semanal: solo interesan las filas con XP positivo.
+        "DROP INDEX IF EXISTS weekly_xp_week_xp_idx",
+        """
+        CREATE INDEX IF NOT EXISTS weekly_xp_top_idx
+        ON weekly_xp (week_start, xp DESC) INCLUDE (user_id) WHERE xp > 0
+        """,
+        # Horario de !clases, carga de avisos y borrado de clases pasadas.
+        "DROP INDEX IF EXISTS clases_fecha_hora_idx",
+        "CREATE INDEX IF NOT EXISTS clases_fecha_hora_idx ON clases (fecha_hora) INCLUDE (tipo)",
+    ]),
+    (4, "concesiones de las tareas programadas entre réplicas", [
+        # Una fila por tarea: quién la ejecuta, hasta cuándo, y la última ejecución hecha.
+        """
+        CREATE TABLE IF NOT EXISTS scheduler_leases (
+            job TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            last_run TEXT
+        )
+        """,
+    ]),
+    (5, "datos por servidor: guild_id en todas las tablas y configuración de cada servidor", [
+        # Las filas de cuando solo había un servidor quedan con guild_id = 0 hasta que el bot
+        # las adopta (LEGACY_GUILD_ID). Las nuevas siempre llevan su servidor: sin valor por defecto.
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS guild_id BIGINT NOT NULL DEFAULT 0",
+        "ALTER TABLE users ALTER COLUMN guild_id DROP DEFAULT",
+        "ALTER TABLE users DROP CONSTRAINT IF EXISTS users_pkey",
+        "ALTER TABLE users ADD PRIMARY KEY (guild_id, user_id)",
+        "DROP INDEX IF EXISTS users_xp_idx",
+        "CREATE INDEX IF NOT EXISTS users_guild_xp_idx ON users (guild_id, xp DESC)",
+        "DROP INDEX IF EXISTS users_inactivity_idx",
+        """
+        CREATE INDEX IF NOT EXISTS users_inactivity_idx
+        ON users (guild_id, last_message_timestamp) INCLUDE (user_id, last_nudged_at)
+        """,
+
+        "ALTER TABLE weekly_xp ADD COLUMN IF NOT EXISTS guild_id BIGINT NOT NULL DEFAULT 0",
+        "ALTER TABLE weekly_xp ALTER COLUMN guild_id DROP DEFAULT",
+        "ALTER TABLE weekly_xp DROP CONSTRAINT IF EXISTS weekly_xp_pkey",
+        "ALTER TABLE weekly_xp ADD PRIMARY KEY (guild_id, week_start, user_id)",
+        "DROP INDEX IF EXISTS weekly_xp_top_idx",
+        """
+        CREATE INDEX IF NOT EXISTS weekly_xp_top_idx
+        ON weekly_xp (guild_id, week_start, xp DESC) INCLUDE (user_id) WHERE xp > 0
+        """,
+
+        "ALTER TABLE xp_events ADD COLUMN IF NOT EXISTS guild_id BIGINT NOT NULL DEFAULT 0",
+        "ALTER TABLE xp_events ALTER COLUMN guild_id DROP DEFAULT",
+        "ALTER TABLE xp_daily ADD COLUMN IF NOT EXISTS guild_id BIGINT NOT NULL DEFAULT 0",
+        "ALTER TABLE xp_daily ALTER COLUMN guild_id DROP DEFAULT",
+        "ALTER TABLE xp_daily DROP CONSTRAINT IF EXISTS xp_daily_pkey",
+        "ALTER TABLE xp_daily ADD PRIMARY KEY (guild_id, day, user_id)",
+        "DROP INDEX IF EXISTS xp_daily_user_id_idx",
+        "CREATE INDEX IF NOT EXISTS xp_daily_user_idx ON xp_daily (guild_id, user_id)",
+
+        # clases_fecha_hora_idx se queda: los avisos y el borrado de clases pasadas son de todos los servidores.
+        "ALTER TABLE clases ADD COLUMN IF NOT EXISTS guild_id BIGINT NOT NULL DEFAULT 0",
+        "ALTER TABLE clases ALTER COLUMN guild_id DROP DEFAULT",
+        "CREATE INDEX IF NOT EXISTS clases_guild_fecha_hora_idx ON clases (guild_id, fecha_hora) INCLUDE (tipo)",
+
+        "ALTER TABLE used_routines ADD COLUMN IF NOT EXISTS guild_id BIGINT NOT NULL DEFAULT 0",
+        "ALTER TABLE used_routines ALTER COLUMN guild_id DROP DEFAULT",
+        "ALTER TABLE used_routines DROP CONSTRAINT IF EXISTS used_routines_pkey",
+        "ALTER TABLE used_routines ADD PRIMARY KEY (guild_id, week_key, routine_key)",
+
+        # Una fila por servidor; cada columna en NULL usa el valor por defecto del bot.
+        """
+        CREATE TABLE IF NOT EXISTS guild_config (
+            guild_id BIGINT PRIMARY KEY,
+            routine_channel TEXT,
+            level_up_channel TEXT,
+            ranking_channel TEXT,
+            welcome_channel TEXT,
+            asesorias_channel TEXT,
+            clases_gratis_channel TEXT,
+            clases_premium_channel TEXT,
+            routine_sheet TEXT,
+            xp_per_message INTEGER,
+            xp_rutina_hecha INTEGER,
+            xp_attachment INTEGER,
+            admin_role_id BIGINT,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+    ]),
+    (6, "importación del XP histórico: puntos de control, ventanas de XP base y resumen diario", [
+        # Hasta qué momento se importa en cada servidor (lo posterior ya se ganó en directo).
+        """
+        CREATE TABLE IF NOT EXISTS backfill_runs (
+            guild_id BIGINT PRIMARY KEY,
+            until_at TIMESTAMPTZ NOT NULL,
+            started_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        # Último mensaje importado de cada canal: se sigue desde ahí.
+        """
+        CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+            guild_id BIGINT NOT NULL,
+            channel_id BIGINT NOT NULL,
+            last_message_id BIGINT,
+            messages BIGINT NOT NULL DEFAULT 0,
+            done BOOLEAN NOT NULL DEFAULT FALSE,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (guild_id, channel_id)
+        )
+        """,
+        # Ventanas de XP_COOLDOWN_SECONDS en las que un usuario ya ganó XP base (entre todos los canales).
+        """
+        CREATE TABLE IF NOT EXISTS backfill_slots (
+            guild_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            slot BIGINT NOT NULL,
+            PRIMARY KEY (guild_id, user_id, slot)
+        )
+        """,
+        # Lo importado por usuario y día, y cuánto XP de ese día ya se sumó a users.
+        """
+        CREATE TABLE IF NOT EXISTS backfill_daily (
+            guild_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            day DATE NOT NULL,
+            messages INTEGER NOT NULL DEFAULT 0,
+            rutina BOOLEAN NOT NULL DEFAULT FALSE,
+            attachments INTEGER NOT NULL DEFAULT 0,
+            merged_xp INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, user_id, day)
+        )
+        """,
+    ]),
+    (7, "XP de la semana en curso de users.weekly_xp a weekly_xp", [
+        # Las instalaciones antiguas llevaban el XP semanal en users.weekly_xp (las nuevas no tienen
+        # la columna). Se pasa a la semana en curso para no perder el ranking al desplegar a mitad
+        # de semana; la columna se deja por si aún corre un proceso con el código anterior.
+        """
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'weekly_xp'
+            ) THEN
+                INSERT INTO weekly_xp (guild_id, week_start, user_id, xp)
+                SELECT guild_id, date_trunc('week', NOW() AT TIME ZONE 'UTC')::date, user_id, weekly_xp
+                FROM users WHERE weekly_xp > 0
+                ON CONFLICT (guild_id, week_start, user_id) DO UPDATE SET xp = weekly_xp.xp + EXCLUDED.xp;
+            END IF;
+        END
+        $$
+        """,
+    ]),
+    (8, "resumen diario de XP: marca por transacción en vez de por id", [
+        # La marca por id se saltaba para siempre un evento con id menor que se confirmaba
+        # después de otro mayor ya resumido. Cada evento guarda ahora la transacción que lo
+        # insertó y el resumen solo coge las que ya no pueden estar en curso (ver xp_ledger.py).
+        # Los eventos existentes quedan en la transacción 0, por delante de cualquier nueva.
+        "ALTER TABLE xp_events ADD COLUMN IF NOT EXISTS tx_id XID8 NOT NULL DEFAULT '0'",
+        "ALTER TABLE xp_events ALTER COLUMN tx_id SET DEFAULT pg_current_xact_id()",
+        "CREATE INDEX IF NOT EXISTS xp_events_tx_idx ON xp_events (tx_id, id)",
+        "ALTER TABLE xp_rollup_state ADD COLUMN IF NOT EXISTS last_tx_id XID8 NOT NULL DEFAULT '0'",
+    ]),
+    (9, "roles de nivel apuntados por ID", [
+        # Para reconocer los roles de nivel aunque la tabla de nombres cambie.
+        """
+        CREATE TABLE IF NOT EXISTS level_roles (
+            guild_id BIGINT NOT NULL,
+            role_id BIGINT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (guild_id, role_id)
+        )
+        """,
+    ]),    (10, "bonus concedidos en el último mensaje", [
+        # Bits de los bonus que concedió el último UPSERT_XP_QUERY (1 rutina, 2 adjunto): el
+        # RETURNING solo ve la fila nueva y así puede devolverlos sin leer la anterior.
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_grants SMALLINT NOT NULL DEFAULT 0",
+    ]),
+]
+
+# Tablas con filas de antes de la migración 5 y columnas que, junto al servidor, identifican una fila.
+LEGACY_TABLES = {
+    "users": ("user_id",),
+    "weekly_xp": ("week_start", "user_id"),
+    "xp_daily": ("day", "user_id"),
+    "used_routines": ("week_key", "routine_key"),
+    "xp_events": (),
+    "clases": (),
+}
+
+
+async def count_legacy_rows(conn):
+    """Usuarios que aún no tienen servidor (guild_id = 0)."""
+    return await conn.fetchval("SELECT COUNT(*) FROM users WHERE guild_id = 0")
+
+
+async def adopt_legacy_rows(conn, guild_id):
+    """
+    Pasa al servidor `guild_id` todas las filas sin servidor. Si el servidor ya tiene una fila
+    con la misma clave, la antigua se queda como está. Devuelve los usuarios adoptados.
+    """
+    adopted = 0
+    async with conn.transaction():
+        for table, key_columns in LEGACY_TABLES.items():
+            conflict = "".join(f" AND n.{column} = o.{column}" for column in key_columns)
+            query = f"UPDATE {table} o SET guild_id = $1 WHERE o.guild_id = 0"
+            if key_columns:
+                query += f" AND NOT EXISTS (SELECT 1 FROM {table} n WHERE n.guild_id = $1{conflict})"
+            status = await conn.execute(query, guild_id)
+            if table == "users":
+                adopted = int(status.split()[-1])
+    return adopted
+
+
+async def run_migrations(conn):
+    """Aplica las migraciones pendientes. Devuelve [(versión, nombre)] de las aplicadas."""
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+        await conn.execute(CREATE_MIGRATIONS_TABLE)
+    applied = {row['version'] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+
+    newly_applied = []
+    for version, name, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+            # Otro proceso pudo aplicarla mientras esperábamos el bloqueo.
+            if await conn.fetchval("SELECT 1 FROM schema_migrations WHERE version = $1", version):
+                continue
+            for statement in statements:
+                await conn.execute(statement)
+            await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+        newly_applied.append((version, name))
+    return newly_applied
@@ -0,0 +1,324 @@
+import asyncio
+import random
+
+import asyncpg
+
+import metrics
+from backfill import CHECKPOINT_QUERY, MERGE_QUERY, STAGE_QUERY
+from campaigns import INACTIVE_USERS_QUERY, MARK_NUDGED_QUERY
+from class_scheduler import (
+    CLAIM_REMINDER_QUERIES, NEW_CLASSES_QUERY, RELEASE_REMINDER_QUERIES, SCHEDULE_QUERY, UPCOMING_CLASSES_QUERY,
+)
+from guild_settings import DEFAULTS as GUILD_DEFAULTS, SETTINGS_COLUMNS
+from leader import ACQUIRE_QUERY, CLAIM_RUN_QUERY, RELEASE_QUERY
+from role_reconcile import LEVELS_QUERY
+from role_registry import TRACK_ROLES_QUERY, TRACKED_ROLES_QUERY, UNTRACK_ROLE_QUERY
+from user_cache import UserRecord
+from xp_buffer import FLUSH_QUERY
+from xp_ledger import AUDIT_QUERY, REBUILD_QUERY, ROLLUP_QUERY
+
+# Cortes de conexión pasajeros: Neon despertando, el pooler cerrando una conexión inactiva,
+# un reinicio del servidor... Una lectura que falla por uno de ellos se puede repetir sin riesgo.
+TRANSIENT_ERRORS = (
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.AdminShutdownError,
+    asyncpg.TooManyConnectionsError,
+    ConnectionError,
+    asyncio.TimeoutError,
+)
+
+# --- Consultas ---
+# Todas son textos fijos (los valores van siempre como parámetros): asyncpg prepara cada una
+# una sola vez por conexión y reutiliza la sentencia preparada en las siguientes llamadas.
+
+USER_COLUMNS = ", ".join(UserRecord.FIELDS[1:])
+
+USER_QUERY = f"SELECT {USER_COLUMNS} FROM users WHERE guild_id = $1 AND user_id = $2"
+
+# Reglas diarias aplicadas sobre la fila del usuario (u): la rutina una vez al día y los adjuntos
+# hasta $10 por día (el contador se resetea si cambió el día).
+_GRANT_RUTINA = "($4::boolean AND u.last_rutina_date IS DISTINCT FROM $6::date)"
+_ATTACHMENTS_BASE = "(CASE WHEN u.last_attachment_date = $6::date THEN u.attachments_today ELSE 0 END)"
+_GRANT_ATTACHMENT = f"($5::boolean AND {_ATTACHMENTS_BASE} < $10::int)"
+_XP_GAIN = (
+    f"($3::int + CASE WHEN {_GRANT_RUTINA} THEN $8::int ELSE 0 END"
+    f" + CASE WHEN {_GRANT_ATTACHMENT} THEN $9::int ELSE 0 END)"
+)
+
+# Una sola sentencia: si el usuario es nuevo se inserta con los bonus que pida; si ya existe (o
+# otro mensaje lo acaba de crear), el DO UPDATE calcula los bonus sobre la fila bloqueada y al
+# día, así que dos mensajes a la vez nunca conceden dos veces el bonus del día. Los bonus
+# concedidos quedan en last_grants (1 rutina, 2 adjunto) para devolverlos y sumar el XP de la
+# semana en la misma sentencia. Devuelve también el nivel anterior.
+UPSERT_XP_QUERY = f"""
+    WITH upserted AS (
+        INSERT INTO users AS u (guild_id, user_id, xp, level, last_message_timestamp,
+                                last_rutina_date, last_attachment_date, attachments_today, last_grants)
+        SELECT $1, $2, xp_gain, xp_gain / $11::int + 1, $7::timestamptz,
+               CASE WHEN $4::boolean THEN $6::date END,
+               CASE WHEN $5::boolean THEN $6::date END,
+               grant_attachment::int,
+               $4::boolean::int | (grant_attachment::int << 1)
+        FROM (
+            SELECT grant_attachment,
+                   $3::int + CASE WHEN $4::boolean THEN $8::int ELSE 0 END
+                   + CASE WHEN grant_attachment THEN $9::int ELSE 0 END AS xp_gain
+            FROM (SELECT $5::boolean AND $10::int > 0 AS grant_attachment) AS first_message
+        ) AS new_user
+        ON CONFLICT (guild_id, user_id) DO UPDATE SET
+            xp = u.xp + {_XP_GAIN},
+            level = (u.xp + {_XP_GAIN}) / $11::int + 1,
+            last_message_timestamp = $7::timestamptz,
+            last_rutina_date = CASE WHEN {_GRANT_RUTINA} THEN $6::date ELSE u.last_rutina_date END,
+            last_attachment_date = CASE WHEN $5::boolean THEN $6::date ELSE u.last_attachment_date END,
+            attachments_today = CASE
+                WHEN $5::boolean THEN {_ATTACHMENTS_BASE} + {_GRANT_ATTACHMENT}::int
+                ELSE u.attachments_today
+            END,
+            last_grants = {_GRANT_RUTINA}::int | ({_GRANT_ATTACHMENT}::int << 1)
+        RETURNING u.xp, u.level, u.last_message_timestamp,
+                  u.last_rutina_date, u.last_attachment_date, u.attachments_today,
+                  u.last_grants & 1 <> 0 AS grant_rutina,
+                  u.last_grants & 2 <> 0 AS grant_attachment
+    ), totals AS (
+        SELECT *,
+               $3::int + CASE WHEN grant_rutina THEN $8::int ELSE 0 END
+               + CASE WHEN grant_attachment THEN $9::int ELSE 0 END AS xp_gain
+        FROM upserted
+    ), weekly AS (
+        INSERT INTO weekly_xp (guild_id, week_start, user_id, xp)
+        SELECT $1, $12::date, $2, xp_gain FROM totals WHERE xp_gain <> 0
+        ON CONFLICT (guild_id, week_start, user_id) DO UPDATE SET xp = weekly_xp.xp + EXCLUDED.xp
+    )
+    SELECT xp, level, last_message_timestamp, last_rutina_date, last_attachment_date, attachments_today,
+           (xp - xp_gain) / $11::int + 1 AS old_level, xp_gain, grant_rutina, grant_attachment
+    FROM totals
+"""
+
+# Elige al azar una rutina no usada esta semana y la marca como usada en la misma sentencia.
+# Si dos procesos eligen a la vez la misma, la clave primaria hace que uno no obtenga fila
+# y vuelva a intentarlo. De paso se borran las marcas de semanas anteriores.
+PICK_ROUTINE_QUERY = """
+    WITH purge AS (
+        DELETE FROM used_routines WHERE guild_id = $1 AND week_key <> $2
+    )
+    INSERT INTO used_routines (guild_id, week_key, routine_key)
+    SELECT $1, $2, candidate.key
+    FROM UNNEST($3::text[]) AS candidate(key)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM used_routines used
+        WHERE used.guild_id = $1 AND used.week_key = $2 AND used.routine_key = candidate.key
+    )
+    ORDER BY random()
+    LIMIT 1
+    ON CONFLICT DO NOTHING
+    RETURNING routine_key;
+"""
+
+REMAINING_ROUTINES_QUERY = """
+    SELECT COUNT(*) FROM UNNEST($3::text[]) AS candidate(key)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM used_routines
+        WHERE guild_id = $1 AND week_key = $2 AND routine_key = candidate.key
+    )
+"""
+
+RESET_ROUTINES_QUERY = "DELETE FROM used_routines WHERE guild_id = $1 AND week_key = $2"
+
+# Top 10 de la semana, servido por el índice parcial weekly_xp_top_idx
+WEEKLY_TOP_QUERY = """
+    SELECT user_id, xp AS weekly_xp FROM weekly_xp
+    WHERE guild_id = $1 AND week_start = $2 AND xp > 0
+    ORDER BY xp DESC LIMIT 10
+"""
+
+# Puesto del usuario: cuenta sobre los índices de xp, sin ordenar la tabla. El coste crece con
+# el puesto (se recorren las entradas del índice de todos los que van por delante), no con el
+# tamaño del servidor: barato para los primeros, del orden de la tabla para los últimos.
+# El "o.xp > 0" no cambia el resultado pero deja usar el índice parcial de weekly_xp.
+USER_RANK_QUERY = """
+    SELECT u.xp,
+           (SELECT COUNT(*) FROM users o WHERE o.guild_id = $1 AND o.xp > u.xp) + 1 AS rank,
+           w.xp AS weekly_xp,
+           (SELECT COUNT(*) FROM weekly_xp o
+            WHERE o.guild_id = $1 AND o.week_start = $3 AND o.xp > 0 AND o.xp > w.xp) + 1 AS weekly_rank
+    FROM users u
+    LEFT JOIN weekly_xp w ON w.guild_id = $1 AND w.week_start = $3 AND w.user_id = u.user_id
+    WHERE u.guild_id = $1 AND u.user_id = $2
+"""
+
+ADD_CLASS_QUERY = "INSERT INTO clases (guild_id, tipo, fecha_hora) VALUES ($1, $2, $3) RETURNING id"
+
+PING_QUERY = "SELECT 1"
+
+GUILD_SETTINGS_QUERY = f"SELECT guild_id, {SETTINGS_COLUMNS} FROM guild_config"
+
+# Una sentencia fija por campo de guild_config: el nombre del campo que llega de !configurar solo
+# elige entre ellas, nunca se pega en la SQL.
+UPDATE_GUILD_SETTING_QUERIES = {
+    field: (
+        f"INSERT INTO guild_config (guild_id, {field}) VALUES ($1, $2) "
+        f"ON CONFLICT (guild_id) DO UPDATE SET {field} = EXCLUDED.{field}, updated_at = NOW() "
+        f"RETURNING guild_id, {SETTINGS_COLUMNS}"
+    )
+    for field in GUILD_DEFAULTS
+}
+
+# Nombre de cada consulta en las métricas y en el aviso de consulta lenta, también las de
+# los demás módulos. Las que no están aquí se nombran por su verbo y su tabla.
+QUERY_NAMES = {
+    USER_QUERY: "usuario",
+    UPSERT_XP_QUERY: "sumar_xp",
+    PICK_ROUTINE_QUERY: "elegir_rutina",
+    REMAINING_ROUTINES_QUERY: "rutinas_restantes",
+    RESET_ROUTINES_QUERY: "reiniciar_rutinas",
+    WEEKLY_TOP_QUERY: "top_semanal",
+    USER_RANK_QUERY: "puesto_ranking",
+    ADD_CLASS_QUERY: "crear_clase",
+    PING_QUERY: "ping",
+    FLUSH_QUERY: "volcar_xp",
+    ROLLUP_QUERY: "resumir_xp",
+    AUDIT_QUERY: "auditar_xp",
+    REBUILD_QUERY: "reconstruir_xp",
+    INACTIVE_USERS_QUERY: "usuarios_inactivos",
+    MARK_NUDGED_QUERY: "marcar_avisados",
+    LEVELS_QUERY: "niveles_servidor",
+    UPCOMING_CLASSES_QUERY: "proximas_clases",
+    NEW_CLASSES_QUERY: "clases_nuevas",
+    SCHEDULE_QUERY: "horario_clases",
+    ACQUIRE_QUERY: "renovar_concesiones",
+    CLAIM_RUN_QUERY: "apuntar_ejecucion",
+    RELEASE_QUERY: "soltar_concesiones",
+    TRACKED_ROLES_QUERY: "roles_de_nivel",
+    TRACK_ROLES_QUERY: "apuntar_roles_de_nivel",
+    UNTRACK_ROLE_QUERY: "olvidar_rol_de_nivel",
+    STAGE_QUERY: "importar_resumir",
+    MERGE_QUERY: "importar_fusionar",
+    CHECKPOINT_QUERY: "importar_punto_control",
+}
+QUERY_NAMES[GUILD_SETTINGS_QUERY] = "configuracion_servidores"
+QUERY_NAMES.update({query: f"configurar_{field}" for field, query in UPDATE_GUILD_SETTING_QUERIES.items()})
+QUERY_NAMES.update({query: f"reclamar_aviso_{kind}" for kind, query in CLAIM_REMINDER_QUERIES.items()})
+QUERY_NAMES.update({query: f"liberar_aviso_{kind}" for kind, query in RELEASE_REMINDER_QUERIES.items()})
+
+
+def backoff_delay(attempt, base):
+    """Espera antes del reintento `attempt` (0, 1, 2...): crece al doble cada vez, con algo de azar."""
+    return base * 2 ** attempt * (0.5 + random.random())
+
+
+async def create_pool(dsn, min_size=1, max_size=10, statement_cache_size=100, command_timeout=None,
+                      retries=3, backoff=0.5, slow_seconds=None):
+    """
+    Abre el pool de asyncpg ya instrumentado. Si la primera conexión falla por un corte pasajero
+    (por ejemplo, Neon arrancando la base de datos suspendida), lo vuelve a intentar.
+    Con statement_cache_size=0 no se guardan sentencias preparadas con nombre: es lo que hace
+    falta detrás de pgbouncer en modo transacción.
+    """
+    for attempt in range(retries + 1):
+        try:
+            pool = await asyncpg.create_pool(
+                dsn=dsn, min_size=min_size, max_size=max_size,
+                statement_cache_size=statement_cache_size, command_timeout=command_timeout
+            )
+            break
+        except TRANSIENT_ERRORS + (OSError,) as e:
+            if attempt == retries:
+                raise
+            delay = backoff_delay(attempt, backoff)
+            print(f"⚠️ AVISO: No se pudo conectar a la base de datos ({e!r}). Reintento en {delay:.1f}s.")
+            await asyncio.sleep(delay)
+    return metrics.InstrumentedPool(pool, query_names=QUERY_NAMES, slow_seconds=slow_seconds)
+
+
+class Repository:
+    """
+    Las consultas del bot a Postgres. Las lecturas se repiten con espera creciente si falla la
+    conexión; las escrituras no, porque no sabemos si llegaron a aplicarse antes del corte.
+    """
+
+    def __init__(self, pool, retries=3, backoff=0.5):
+        self.pool = pool
+        self.retries = retries
+        self.backoff = backoff
+
+    async def _read(self, method, query, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.pool.acquire() as conn:
+                    return await getattr(conn, method)(query, *args)
+            except TRANSIENT_ERRORS as e:
+                if attempt == self.retries:
+                    raise
+                name = QUERY_NAMES.get(query) or metrics.describe_query(query)
+                metrics.DB_RETRIES.inc(1, name)
+                delay = backoff_delay(attempt, self.backoff)
+                print(f"⚠️ AVISO: Corte en la consulta {name} ({e!r}). Reintento {attempt + 1}/{self.retries} en {delay:.1f}s.")
+                await asyncio.sleep(delay)
+
+    async def ping(self):
+        return await self._read("fetchval", PING_QUERY)
+
+    async def fetch_user(self, guild_id, user_id):
+        return await self._read("fetchrow", USER_QUERY, guild_id, user_id)
+
+    async def weekly_top(self, guild_id, week_start):
+        return await self._read("fetch", WEEKLY_TOP_QUERY, guild_id, week_start)
+
+    async def user_rank(self, guild_id, user_id, week_start):
+        return await self._read("fetchrow", USER_RANK_QUERY, guild_id, user_id, week_start)
+
+    async def upsert_xp(self, guild_id, user_id, base_xp, claims_rutina, has_attachment, now_ts,
+                        rutina_xp, attachment_xp, max_attachments, xp_per_level, week_start):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow(
+                UPSERT_XP_QUERY, guild_id, user_id, base_xp, claims_rutina, has_attachment,
+                now_ts.date(), now_ts, rutina_xp, attachment_xp, max_attachments, xp_per_level, week_start
+            )
+
+    async def pick_routine(self, guild_id, week_key, routine_keys):
+        """
+        Devuelve (clave_elegida, ciclo_reiniciado) para el servidor.
+        Cuando ya se usaron todas las rutinas de la semana, se reinicia el ciclo.
+        """
+        cycle_restarted = False
+        async with self.pool.acquire() as conn:
+            for _ in range(5):
+                chosen = await conn.fetchval(PICK_ROUTINE_QUERY, guild_id, week_key, routine_keys)
+                if chosen:
+                    return chosen, cycle_restarted
+                remaining = await conn.fetchval(REMAINING_ROUTINES_QUERY, guild_id, week_key, routine_keys)
+                if remaining == 0:
+                    await conn.execute(RESET_ROUTINES_QUERY, guild_id, week_key)
+                    cycle_restarted = True
+        return None, cycle_restarted
+
+    async def upcoming_classes(self, now):
+        return await self._read("fetch", UPCOMING_CLASSES_QUERY, now)
+
+    async def new_classes(self, after_id, now):
+        return await self._read("fetch", NEW_CLASSES_QUERY, after_id, now)
+
+    async def class_schedule(self, guild_id, now, limit):
+        return await self._read("fetch", SCHEDULE_QUERY, guild_id, now, limit)
+
+    async def inactive_users(self, guild_id, cutoff):
+        return await self._read("fetch", INACTIVE_USERS_QUERY, guild_id, cutoff)
+
+    async def member_levels(self, guild_id):
+        return await self._read("fetch", LEVELS_QUERY, guild_id)
+
+    async def tracked_level_roles(self):
+        return await self._read("fetch", TRACKED_ROLES_QUERY)
+
+    async def guild_settings(self):
+        return await self._read("fetch", GUILD_SETTINGS_QUERY)
+
+    async def update_guild_setting(self, guild_id, field, value):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow(UPDATE_GUILD_SETTING_QUERIES[field], guild_id, value)
+
+    async def add_class(self, guild_id, tipo, fecha_hora):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(ADD_CLASS_QUERY, guild_id, tipo, fecha_hora)
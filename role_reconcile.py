@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+import discord
+
+from campaigns import RateLimiter
+from dispatcher import PRIORITY_LOW
+
+# Nivel de todos los usuarios del servidor en una sola lectura (por la clave primaria).
+LEVELS_QUERY = "SELECT user_id, level FROM users WHERE guild_id = $1"
+
+
+async def reconcile_level_roles(guild, repo, registry, dry_run=False, level_for=None, concurrency=4, per_second=5,
+                                dispatcher=None, progress=None, progress_seconds=5, preview_limit=15):
+    """
+    Deja a cada miembro del servidor con el rol de nivel que le toca según la DB, y ningún otro.
+    Lee todos los niveles de una vez, compara con los roles de los miembros en memoria y solo
+    llama a Discord para los que no cuadran, con `concurrency` cambios a la vez y `per_second`
+    como mucho. Los miembros sin fila en users se quedan sin rol de nivel.
+
+    Con `dry_run` no cambia nada (ni crea roles): solo cuenta y prepara la vista previa.
+    `level_for(user_id, nivel_leído)` da el nivel justo antes de aplicar cada cambio, por si el
+    miembro subió mientras tanto. `progress(summary)` se llama cada `progress_seconds` segundos.
+    """
+    rows = await repo.member_levels(guild.id)
+    levels = {row['user_id']: row['level'] for row in rows}
+
+    summary = {
+        "members": 0, "unchanged": 0, "changes": 0, "applied": 0, "forbidden": 0, "failed": 0,
+        "roles_to_create": [], "preview": [],
+    }
+
+    # Los roles que falten se crean antes de comparar (uno por nivel distinto, no por miembro).
+    for level in sorted(set(levels.values())):
+        if registry.known_role_id(guild, level) is None:
+            name = registry.name_for_level(level)
+            if name in summary["roles_to_create"]:
+                continue
+            summary["roles_to_create"].append(name)
+            if not dry_run:
+                await registry.role_id_for_level(guild, level)
+    level_role_ids = registry.level_role_ids(guild)
+
+    def target_role_id(level):
+        return registry.known_role_id(guild, level) if level is not None else None
+
+    pending = []
+    for member in guild.members:
+        if member.bot:
+            continue
+        summary["members"] += 1
+        level = levels.get(member.id)
+        target = target_role_id(level)
+        current = [role for role in member.roles if role.id in level_role_ids]
+        # Con el rol aún sin crear (solo en dry_run) el miembro siempre cuenta como cambio.
+        if (level is None or target) and [role.id for role in current] == ([target] if target else []):
+            summary["unchanged"] += 1
+            continue
+        summary["changes"] += 1
+        pending.append((member, level))
+        if len(summary["preview"]) < preview_limit:
+            before = ", ".join(role.name for role in current) or "—"
+            after = registry.name_for_level(level) if level is not None else "—"
+            summary["preview"].append(f"{member.display_name}: {before} → {after}")
+
+    if dry_run or not pending:
+        return summary
+
+    queue = asyncio.Queue()
+    for item in pending:
+        queue.put_nowait(item)
+    limiter = RateLimiter(per_second)
+    last_report = time.monotonic()
+
+    async def apply(member, level):
+        if level_for is not None:
+            level = level_for(member.id, level)
+        target = target_role_id(level)
+        if level is not None and target is None:
+            target = await registry.role_id_for_level(guild, level)
+        ids = registry.level_role_ids(guild)
+        new_roles = [role for role in member.roles[1:] if role.id not in ids]  # Sin @everyone
+        if target:
+            new_roles.append(discord.Object(id=target))
+        await member.edit(roles=new_roles, reason="Reconciliación de roles de nivel.")
+
+    async def worker():
+        nonlocal last_report
+        while True:
+            try:
+                member, level = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await limiter.wait()
+            try:
+                if dispatcher:
+                    # Misma clave que el cambio de rol al subir de nivel: si hay uno pendiente, sale uno solo.
+                    await dispatcher.submit(lambda: apply(member, level), priority=PRIORITY_LOW,
+                                            key=("level_role", guild.id, member.id))
+                else:
+                    await apply(member, level)
+                summary["applied"] += 1
+            except discord.Forbidden:
+                summary["forbidden"] += 1
+            except discord.HTTPException as e:
+                summary["failed"] += 1
+                print(f"!!! ERROR al corregir el rol de nivel de {member.id} en {guild.name}: {e}")
+            if progress and time.monotonic() - last_report >= progress_seconds:
+                last_report = time.monotonic()
+                await progress(summary)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summary
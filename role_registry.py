@@ -0,0 +1,169 @@
+import asyncio
+
+import discord
+
+# Todos los roles de nivel que el bot ha usado en cada servidor, también los de tablas de
+# niveles anteriores: por nombre ya no se reconocen, pero hay que poder quitarlos.
+TRACKED_ROLES_QUERY = "SELECT guild_id, role_id FROM level_roles"
+TRACK_ROLES_QUERY = """
+    INSERT INTO level_roles (guild_id, role_id)
+    SELECT $1, unnest($2::bigint[])
+    ON CONFLICT DO NOTHING
+"""
+# Un rol borrado en Discord ya no hay que quitárselo a nadie.
+UNTRACK_ROLE_QUERY = "DELETE FROM level_roles WHERE guild_id = $1 AND role_id = $2"
+
+
+class LevelRoleRegistry:
+    """
+    Índice nivel -> rol de Discord para cada servidor.
+    Los nombres de los roles se calculan una sola vez al arrancar y los IDs se
+    mantienen al día con los eventos de roles, así que subir de nivel no recorre listas.
+    Cada rol de nivel que se ve o se crea queda apuntado por ID en level_roles (con load()),
+    para seguir tratándolo como rol de nivel aunque cambie la tabla de nombres.
+    """
+
+    def __init__(self, name_for_level, color_for_level, max_level=200):
+        self._name_for_level = name_for_level
+        self._color_for_level = color_for_level
+        self._max_level = max_level
+        # level_names[n] es el nombre del rol del nivel n (la posición 0 no se usa).
+        self.level_names = [None] + [name_for_level(level) for level in range(1, max_level + 1)]
+        # Nivel más bajo que usa cada nombre, para elegir su color al crearlo.
+        self._first_level = {}
+        for level in range(1, max_level + 1):
+            self._first_level.setdefault(self.level_names[level], level)
+        self._guilds = {}  # guild_id -> {nombre_del_rol: role_id}
+        self._tracked = {}  # guild_id -> IDs de todos los roles de nivel conocidos (actuales y antiguos)
+        self._pool = None
+        self._save_tasks = set()
+        self._create_locks = {}  # (guild_id, nombre_del_rol) -> asyncio.Lock
+
+    def name_for_level(self, level):
+        if 0 < level <= self._max_level:
+            return self.level_names[level]
+        name = self._name_for_level(level)
+        self._first_level.setdefault(name, level)
+        return name
+
+    def is_level_role(self, name):
+        return name in self._first_level
+
+    async def load(self, repo):
+        """Lee de la DB los roles de nivel apuntados; los que se vean a partir de ahora se guardan."""
+        self._pool = repo.pool
+        rows = await repo.tracked_level_roles()
+        for row in rows:
+            self._tracked.setdefault(row['guild_id'], set()).add(row['role_id'])
+        return len(rows)
+
+    def _track(self, guild_id, role_ids):
+        tracked = self._tracked.setdefault(guild_id, set())
+        new = set(role_ids) - tracked
+        if not new:
+            return
+        tracked |= new
+        self._spawn(self._save(guild_id, sorted(new)))
+
+    def _spawn(self, coro):
+        if self._pool is None:
+            coro.close()
+            return
+        task = asyncio.create_task(coro)
+        self._save_tasks.add(task)
+        task.add_done_callback(self._save_tasks.discard)
+
+    async def _save(self, guild_id, role_ids):
+        try:
+            async with self._pool.acquire() as conn:
+                await conn.execute(TRACK_ROLES_QUERY, guild_id, role_ids)
+        except Exception as e:
+            # Se quitan de memoria para volver a intentarlo la próxima vez que se vean.
+            self._tracked.get(guild_id, set()).difference_update(role_ids)
+            print(f"⚠️ AVISO: No se pudieron guardar los roles de nivel de {guild_id}: {e}")
+
+    async def _forget(self, guild_id, role_id):
+        try:
+            async with self._pool.acquire() as conn:
+                await conn.execute(UNTRACK_ROLE_QUERY, guild_id, role_id)
+        except Exception as e:
+            # La fila que quede solo apunta a un rol inexistente: no se le quita a nadie.
+            print(f"⚠️ AVISO: No se pudo olvidar el rol de nivel {role_id} de {guild_id}: {e}")
+
+    def _roles_for(self, guild):
+        roles = self._guilds.get(guild.id)
+        if roles is None:
+            roles = {role.name: role.id for role in guild.roles if self.is_level_role(role.name)}
+            self._guilds[guild.id] = roles
+            self._track(guild.id, roles.values())
+        return roles
+
+    def level_role_ids(self, guild):
+        """IDs de los roles de nivel del servidor, incluidos los de tablas de nombres anteriores."""
+        return set(self._roles_for(guild).values()) | self._tracked.get(guild.id, set())
+
+    async def provision(self, guild):
+        """
+        Crea de golpe todos los roles de nivel que falten en el servidor
+        y pone color a los que se quedaron con el color por defecto.
+        """
+        self._guilds.pop(guild.id, None)
+        roles = self._roles_for(guild)
+        created = 0
+        for name, level in self._first_level.items():
+            color = self._color_for_level(level)
+            role_id = roles.get(name)
+            if role_id is None:
+                role = await guild.create_role(name=name, color=color, mentionable=False, reason="Roles de nivel.")
+                roles[name] = role.id
+                self._track(guild.id, [role.id])
+                created += 1
+                continue
+            role = guild.get_role(role_id)
+            if role and role.color == discord.Color.default():
+                await role.edit(color=color)
+        return created
+
+    def known_role_id(self, guild, level):
+        """ID del rol del nivel si ya existe en el servidor (sin crearlo)."""
+        return self._roles_for(guild).get(self.name_for_level(level))
+
+    async def role_id_for_level(self, guild, level):
+        name = self.name_for_level(level)
+        role_id = self._roles_for(guild).get(name)
+        if role_id is not None:
+            return role_id
+        # Solo pasa con niveles por encima de la tabla o si alguien borró el rol a mano. Varios
+        # miembros pueden subir a la vez: el primero crea el rol y los demás lo encuentran al
+        # entrar. El cerrojo va por nombre porque los niveles con el mismo nombre comparten rol.
+        async with self._create_locks.setdefault((guild.id, name), asyncio.Lock()):
+            roles = self._roles_for(guild)
+            role_id = roles.get(name)
+            if role_id is None:
+                role = await guild.create_role(name=name, color=self._color_for_level(level), mentionable=False)
+                role_id = roles[name] = role.id
+                self._track(guild.id, [role_id])
+        return role_id
+
+    # --- Eventos de roles ---
+    def on_role_create(self, role):
+        if role.guild.id in self._guilds and self.is_level_role(role.name):
+            self._guilds[role.guild.id][role.name] = role.id
+            self._track(role.guild.id, [role.id])
+
+    def on_role_delete(self, role):
+        roles = self._guilds.get(role.guild.id)
+        if roles and roles.get(role.name) == role.id:
+            del roles[role.name]
+        tracked = self._tracked.get(role.guild.id, set())
+        if role.id in tracked:
+            tracked.discard(role.id)
+            self._spawn(self._forget(role.guild.id, role.id))
+
+    def on_role_update(self, before, after):
+        if before.name != after.name:
+            # Un rol de nivel renombrado sigue apuntado por su ID: solo cambia el índice por nombre.
+            roles = self._guilds.get(before.guild.id)
+            if roles and roles.get(before.name) == before.id:
+                del roles[before.name]
+            self.on_role_create(after)
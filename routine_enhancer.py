@@ -0,0 +1,103 @@
+import hashlib
+import time
+
+import metrics
+
+# Súbelo cuando cambie el prompt: todas las rutinas se regenerarán con el nuevo.
+ENHANCER_PROMPT_VERSION = 1
+
+ENHANCER_SYSTEM_PROMPT = "Eres un entrenador de fitness que formatea rutinas para anuncios de Discord de forma visual y motivadora."
+
+ENHANCER_PROMPT = """
+Toma la siguiente rutina y mejórala para un anuncio de Discord.
+Reglas: NO cambies los ejercicios, series o repeticiones. SÓLO mejora la presentación. Usa emojis (💪,🔥), formato de Discord como **negritas** y añade una intro y cierre motivadores.
+
+Título: {title}
+Descripción: {description}
+"""
+
+
+def enhancement_key(routine):
+    """Clave de la caché: cambia si cambia la rutina o la versión del prompt."""
+    content = f"v{ENHANCER_PROMPT_VERSION}\n{routine.get('titulo_rutina', '')}\n{routine.get('descripcion_rutina', '')}"
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class RoutineEnhancer:
+    """
+    Genera con antelación la versión "bonita" de cada rutina y la guarda en la DB.
+    La publicación diaria solo consulta la caché; nunca espera a OpenAI.
+    """
+
+    def __init__(self, pool, openai_client, ai_queue, model="gpt-4o"):
+        self._pool = pool
+        self._client = openai_client
+        self._queue = ai_queue
+        self._model = model
+        self._cache = {}
+
+    async def load(self):
+        async with self._pool.acquire() as conn:
+            rows = await conn.fetch("SELECT cache_key, content FROM routine_enhancements")
+        self._cache = {row['cache_key']: row['content'] for row in rows}
+
+    def get(self, routine):
+        return self._cache.get(enhancement_key(routine))
+
+    async def warm(self, routines):
+        """
+        Genera las mejoras que falten para las rutinas actuales y borra las que ya no se usan.
+        Parte de una copia recién leída de la DB, así que solo llama a OpenAI para rutinas que
+        ninguna réplica ha mejorado aún, y solo borra lo que de verdad sobra.
+        """
+        await self.load()
+        keys = {enhancement_key(routine): routine for routine in routines}
+        generated = 0
+        for key, routine in keys.items():
+            if key in self._cache:
+                continue
+            try:
+                content = await self._generate(routine)
+            except Exception as e:
+                print(f"!!! ERROR al mejorar la rutina con IA: {e}. Se reintentará en el próximo refresco.")
+                continue
+            async with self._pool.acquire() as conn:
+                # Si otra réplica la guardó mientras tanto, nos quedamos con la suya.
+                await conn.execute(
+                    "INSERT INTO routine_enhancements (cache_key, content) VALUES ($1, $2) ON CONFLICT (cache_key) DO NOTHING",
+                    key, content
+                )
+                self._cache[key] = await conn.fetchval(
+                    "SELECT content FROM routine_enhancements WHERE cache_key = $1", key
+                ) or content
+            generated += 1
+
+        stale = [key for key in self._cache if key not in keys]
+        if stale:
+            async with self._pool.acquire() as conn:
+                await conn.execute("DELETE FROM routine_enhancements WHERE cache_key = ANY($1::text[])", stale)
+            for key in stale:
+                del self._cache[key]
+        return generated
+
+    async def _generate(self, routine):
+        # Comparte la cola (y su límite de concurrencia) con !calistenico.
+        return await self._queue.submit(lambda: self._request(routine))
+
+    async def _request(self, routine):
+        prompt = ENHANCER_PROMPT.format(
+            title=routine.get('titulo_rutina', 'Rutina del Día'),
+            description=routine.get('descripcion_rutina', 'No hay descripción.')
+        )
+        start = time.perf_counter()
+        response = await self._client.chat.completions.create(
+            model=self._model,
+            messages=[
+                {"role": "system", "content": ENHANCER_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=1024,
+            temperature=0.7
+        )
+        metrics.observe_openai("enhancer", time.perf_counter() - start, response.usage)
+        return response.choices[0].message.content
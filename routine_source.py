@@ -0,0 +1,145 @@
+import abc
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+
+def routine_key(routine):
+    """Clave estable de una rutina: no cambia aunque se reordenen las filas del Sheet."""
+    content = f"{routine.get('titulo_rutina', '')}\n{routine.get('descripcion_rutina', '')}"
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class RoutineSource(abc.ABC):
+    """
+    Fuente de rutinas con copia local en disco.
+    La publicación diaria solo lee `routines` (ya en memoria); refresh() se encarga de
+    traer cambios en segundo plano y, si la fuente falla, se sigue usando la última copia buena.
+    Cada fuente concreta implementa _fetch_routines() (y, si puede, _fetch_revision()).
+    """
+
+    def __init__(self, snapshot_path):
+        self._snapshot_path = snapshot_path
+        self.routines = []
+        self.by_key = {}
+        self.revision = None
+        self.refreshed_at = None
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        if not self._snapshot_path or not os.path.exists(self._snapshot_path):
+            return
+        try:
+            with open(self._snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self._set_routines(snapshot.get("routines", []))
+            self.revision = snapshot.get("revision")
+            self.refreshed_at = snapshot.get("refreshed_at")
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"!!! AVISO: No se pudo leer la copia local de rutinas: {e}")
+
+    def _set_routines(self, routines):
+        self.routines = routines
+        self.by_key = {routine_key(routine): routine for routine in routines}
+
+    def _save_snapshot(self):
+        # Escribimos en un temporal y lo renombramos para no dejar nunca un JSON a medias.
+        tmp_path = f"{self._snapshot_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"revision": self.revision, "refreshed_at": self.refreshed_at, "routines": self.routines}, f, ensure_ascii=False)
+        os.replace(tmp_path, self._snapshot_path)
+
+    async def refresh(self):
+        """
+        Descarga las rutinas si la fuente cambió desde la última vez.
+        Devuelve True si la copia local se ha actualizado.
+        """
+        try:
+            revision = await self._fetch_revision()
+            if revision is not None and revision == self.revision and self.routines:
+                return False
+            routines = await self._fetch_routines()
+        except Exception as e:
+            print(f"❌ ERROR al refrescar las rutinas (se usa la copia local de {len(self.routines)}): {e}")
+            return False
+
+        if not routines:
+            print("!!! AVISO: La fuente de rutinas está vacía. Se mantiene la copia anterior.")
+            return False
+
+        self._set_routines(routines)
+        self.revision = revision
+        self.refreshed_at = time.time()
+        if self._snapshot_path:
+            try:
+                await asyncio.to_thread(self._save_snapshot)
+            except OSError as e:
+                print(f"!!! AVISO: No se pudo guardar la copia local de rutinas: {e}")
+        return True
+
+    async def _fetch_revision(self):
+        """Identificador barato de la versión actual (None si la fuente no lo ofrece)."""
+        return None
+
+    @abc.abstractmethod
+    async def _fetch_routines(self):
+        """Descarga la lista completa de rutinas (dicts con `titulo_rutina` y `descripcion_rutina`)."""
+
+
+class GoogleSheetRoutineSource(RoutineSource):
+    """Lee las rutinas de la primera hoja de un Google Sheet, siempre fuera del event loop."""
+
+    def __init__(self, client, sheet_name, snapshot_path, timeout=30):
+        self._client = client
+        self._sheet_name = sheet_name
+        self._timeout = timeout
+        self._spreadsheet = None
+        super().__init__(snapshot_path)
+
+    def _open(self):
+        if self._spreadsheet is None:
+            self._spreadsheet = self._client.open(self._sheet_name)
+        return self._spreadsheet
+
+    def _read_revision(self):
+        spreadsheet = self._open()
+        # gspread 6 usa un método; las versiones anteriores, una propiedad.
+        getter = getattr(spreadsheet, "get_lastUpdateTime", None)
+        return getter() if getter else spreadsheet.lastUpdateTime
+
+    def _read_routines(self):
+        return self._open().sheet1.get_all_records()
+
+    async def _fetch_revision(self):
+        try:
+            return await asyncio.wait_for(asyncio.to_thread(self._read_revision), self._timeout)
+        except asyncio.TimeoutError:
+            raise
+        except Exception:
+            # Sin acceso a Drive no hay fecha de modificación: descargamos la hoja sin más.
+            return None
+
+    async def _fetch_routines(self):
+        return await asyncio.wait_for(asyncio.to_thread(self._read_routines), self._timeout)
+
+
+class FileRoutineSource(RoutineSource):
+    """
+    Lee las rutinas de un archivo JSON local (una lista de objetos con
+    `titulo_rutina` y `descripcion_rutina`). Sirve para pruebas y para usar el bot sin Google.
+    """
+
+    def __init__(self, path, snapshot_path=None):
+        self._path = path
+        super().__init__(snapshot_path)
+
+    async def _fetch_revision(self):
+        return os.path.getmtime(self._path)
+
+    async def _fetch_routines(self):
+        def read():
+            with open(self._path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return await asyncio.to_thread(read)
@@ -0,0 +1,108 @@
+"""
+Importa el XP de los mensajes antiguos de un servidor sin pasar por el bot.
+
+Se conecta a Discord con el token del bot, recorre el historial de los canales de texto y
+suma el XP con las mismas reglas que en directo (ver backfill.py). Se puede cortar y volver a
+lanzar: cada canal sigue desde su último punto de control y no se suma nada dos veces.
+
+    python scripts/backfill_xp.py --guild 123456789012345678 --until 2024-01-01
+"""
+import argparse
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault("ADMIN_ROLE_ID", "0")
+
+import discord  # noqa: E402
+
+import config  # noqa: E402
+from backfill import BackfillBusyError, BackfillDateError, backfill_guild_xp  # noqa: E402
+from guild_settings import GuildSettingsStore  # noqa: E402
+from migrations import run_migrations  # noqa: E402
+from repository import Repository, create_pool  # noqa: E402
+
+
+async def run(guild_id, until, dsn, token, concurrency, batch_size):
+    # Una conexión para el bloqueo, otra para las fusiones y margen para la configuración.
+    pool = await create_pool(
+        dsn, min_size=1, max_size=3, statement_cache_size=config.DB_STATEMENT_CACHE_SIZE,
+        retries=config.DB_RETRIES, backoff=config.DB_RETRY_BACKOFF_SECONDS
+    )
+    intents = discord.Intents.default()
+    intents.message_content = True
+    client = discord.Client(intents=intents)
+    try:
+        async with pool.acquire() as conn:
+            await run_migrations(conn)
+        settings_store = GuildSettingsStore()
+        await settings_store.load(Repository(pool))
+        settings = settings_store.get(guild_id)
+
+        await client.login(token)
+        connect = asyncio.create_task(client.connect())
+        await client.wait_until_ready()
+        guild = client.get_guild(guild_id)
+        if guild is None:
+            print(f"El bot no está en el servidor {guild_id}.")
+            return 1
+
+        async def progress(summary):
+            print(
+                f"  {summary['messages']} mensajes, {summary['xp_added']} XP, "
+                f"{summary['channels_done']}/{summary['channels']} canales"
+            )
+
+        print(f"Importando el XP histórico de {guild.name}...")
+        try:
+            summary = await backfill_guild_xp(
+                guild, pool, until=until, xp_per_message=settings.xp_per_message,
+                rutina_xp=settings.xp_rutina_hecha, attachment_xp=settings.xp_attachment,
+                concurrency=concurrency, batch_size=batch_size, progress=progress
+            )
+        except (BackfillBusyError, BackfillDateError) as e:
+            print(e)
+            return 1
+        print(
+            f"Hecho (mensajes anteriores a {summary['until']:%Y-%m-%d %H:%M} UTC): "
+            f"{summary['messages']} mensajes leídos, {summary['xp_added']} XP sumado, "
+            f"{summary['channels_done']}/{summary['channels']} canales terminados, {summary['skipped']} sin acceso."
+        )
+        print("Usa !reconciliar_roles aplicar en el servidor para poner los roles de nivel al día.")
+        connect.cancel()
+        return 0
+    finally:
+        await client.close()
+        await pool.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Importa el XP de los mensajes antiguos de un servidor.")
+    parser.add_argument("--guild", type=int, required=True, help="ID del servidor.")
+    parser.add_argument("--until", help="Solo mensajes anteriores a esta fecha (AAAA-MM-DD, UTC). Por defecto, el primer XP ganado en directo.")
+    parser.add_argument("--dsn", default=config.DATABASE_URL, help="Base de datos (por defecto, DATABASE_URL).")
+    parser.add_argument("--concurrency", type=int, default=config.BACKFILL_CONCURRENCY, help="Canales leídos a la vez.")
+    parser.add_argument("--batch-size", type=int, default=config.BACKFILL_BATCH_SIZE, help="Mensajes por lote.")
+    args = parser.parse_args(argv)
+    if not args.dsn:
+        parser.error("Falta --dsn (o DATABASE_URL).")
+    if not config.DISCORD_BOT_TOKEN:
+        parser.error("Falta DISCORD_BOT_TOKEN.")
+    until = None
+    if args.until:
+        try:
+            until = datetime.strptime(args.until, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        except ValueError:
+            parser.error("--until debe ser AAAA-MM-DD.")
+
+    sys.exit(asyncio.run(run(
+        args.guild, until, args.dsn, config.DISCORD_BOT_TOKEN, args.concurrency, args.batch_size
+    )))
+
+
+if __name__ == "__main__":
+    main()
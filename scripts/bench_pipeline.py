@@ -0,0 +1,437 @@
+"""
+Banco de pruebas del pipeline de mensajes: on_message -> XP -> rol de nivel.
+
+Reproduce un flujo sintético de mensajes con objetos falsos de Discord contra una DB en
+memoria (o un Postgres de pruebas con --dsn) y mide rendimiento, latencia del handler y
+round trips a la DB por mensaje. Guarda el resultado en JSON para comparar ejecuciones.
+
+    python scripts/bench_pipeline.py --messages 5000 --rate 200 --users 300
+    python scripts/bench_pipeline.py --dsn postgresql://localhost/calistenico_bench --write-behind
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault("ADMIN_ROLE_ID", "0")
+
+from repository import QUERY_NAMES, UPSERT_XP_QUERY, USER_QUERY, Repository  # noqa: E402
+from xp_buffer import FLUSH_QUERY  # noqa: E402
+
+
+# --- Objetos falsos de Discord ---
+
+class FakeRole:
+    def __init__(self, role_id, name, guild):
+        self.id = role_id
+        self.name = name
+        self.guild = guild
+
+
+class FakeChannel:
+    def __init__(self, channel_id, name, latency):
+        self.id = channel_id
+        self.name = name
+        self.sent = 0
+        self._latency = latency
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self._latency)
+        self.sent += 1
+
+
+class FakeGuild:
+    def __init__(self, guild_id, level_role_names, latency):
+        self.id = guild_id
+        self.name = "Academia (bench)"
+        self._latency = latency
+        self._next_role_id = guild_id * 1000
+        self.default_role = self._new_role("@everyone")
+        self.roles = [self.default_role] + [self._new_role(name) for name in dict.fromkeys(level_role_names)]
+        self.text_channels = [FakeChannel(guild_id * 10 + 1, "level-up", latency),
+                              FakeChannel(guild_id * 10 + 2, "charla-general", latency)]
+        self.member_count = 0
+        self.role_edits = 0
+
+    def _new_role(self, name):
+        self._next_role_id += 1
+        return FakeRole(self._next_role_id, name, self)
+
+    def get_role(self, role_id):
+        return next((role for role in self.roles if role.id == role_id), None)
+
+    async def create_role(self, name, **kwargs):
+        await asyncio.sleep(self._latency)
+        role = self._new_role(name)
+        self.roles.append(role)
+        return role
+
+
+class FakeMember:
+    def __init__(self, user_id, guild):
+        self.id = user_id
+        self.bot = False
+        self.guild = guild
+        self.roles = [guild.default_role]
+        self.mention = f"<@{user_id}>"
+
+    async def edit(self, roles=None, reason=None):
+        await asyncio.sleep(self.guild._latency)
+        self.guild.role_edits += 1
+        self.roles = [self.guild.default_role] + list(roles)
+
+    async def add_roles(self, *roles, reason=None):
+        await asyncio.sleep(self.guild._latency)
+        self.roles.extend(roles)
+
+
+class FakeAttachment:
+    filename = "progreso.jpg"
+
+
+class FakeMessage:
+    def __init__(self, author, content, attachments, channel):
+        self.author = author
+        self.guild = author.guild
+        self.channel = channel
+        self.content = content
+        self.attachments = attachments
+
+
+# --- DB en memoria ---
+
+class FakeDatabase:
+    """
+    Sustituto en memoria de Postgres que entiende las consultas del pipeline de XP.
+    Cada consulta espera `latency` segundos para simular el round trip.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.users = {}
+        self.weekly_xp = {}
+        self.xp_events = []
+
+    def _user_row(self, user):
+        return dict(user)
+
+    def upsert_xp(self, guild_id, user_id, base_xp, claims_rutina, has_attachment, today, now_ts,
+                  xp_rutina, xp_attachment, max_attachments, xp_per_level, week_start):
+        cur = self.users.get((guild_id, user_id))
+        grant_rutina = claims_rutina and (cur is None or cur['last_rutina_date'] != today)
+        attachments_base = cur['attachments_today'] if cur and cur['last_attachment_date'] == today else 0
+        grant_attachment = has_attachment and attachments_base < max_attachments
+        xp_gain = base_xp + (xp_rutina if grant_rutina else 0) + (xp_attachment if grant_attachment else 0)
+        if xp_gain:
+            key = (guild_id, week_start, user_id)
+            self.weekly_xp[key] = self.weekly_xp.get(key, 0) + xp_gain
+
+        if cur is None:
+            cur = self.users[(guild_id, user_id)] = {
+                "xp": 0, "level": 1, "last_message_timestamp": None,
+                "last_rutina_date": None, "last_attachment_date": None, "attachments_today": 0,
+            }
+        cur['xp'] += xp_gain
+        cur['level'] = cur['xp'] // xp_per_level + 1
+        cur['last_message_timestamp'] = now_ts
+        if grant_rutina:
+            cur['last_rutina_date'] = today
+        if has_attachment:
+            cur['last_attachment_date'] = today
+            cur['attachments_today'] = attachments_base + int(grant_attachment)
+
+        row = self._user_row(cur)
+        row.update(
+            old_level=(cur['xp'] - xp_gain) // xp_per_level + 1, xp_gain=xp_gain,
+            grant_rutina=grant_rutina, grant_attachment=grant_attachment,
+        )
+        return row
+
+    def flush_buffer(self, guild_ids, user_ids, xps, levels, timestamps, rutina_dates, attachment_dates,
+                     attachments_today, xp_per_level, week_start):
+        for i, (guild_id, user_id) in enumerate(zip(guild_ids, user_ids)):
+            if xps[i]:
+                key = (guild_id, week_start, user_id)
+                self.weekly_xp[key] = self.weekly_xp.get(key, 0) + xps[i]
+            cur = self.users.setdefault((guild_id, user_id), {
+                "xp": 0, "level": 1, "last_message_timestamp": None,
+                "last_rutina_date": None, "last_attachment_date": None, "attachments_today": 0,
+            })
+            cur['xp'] += xps[i]
+            cur['level'] = cur['xp'] // xp_per_level + 1
+            cur['last_message_timestamp'] = max(filter(None, (cur['last_message_timestamp'], timestamps[i])))
+            cur['last_rutina_date'] = max(filter(None, (cur['last_rutina_date'], rutina_dates[i])), default=None)
+            if attachment_dates[i] is not None:
+                cur['last_attachment_date'] = attachment_dates[i]
+                cur['attachments_today'] = attachments_today[i]
+
+    async def run(self, method, query, args):
+        await asyncio.sleep(self.latency)
+        if query == UPSERT_XP_QUERY:
+            return self.upsert_xp(*args)
+        if query == USER_QUERY:
+            user = self.users.get((args[0], args[1]))
+            return self._user_row(user) if user else None
+        if query == FLUSH_QUERY:
+            return self.flush_buffer(*args)
+        raise NotImplementedError(f"Consulta no soportada por la DB en memoria ({method}): {query.strip()[:80]}...")
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self._db = db
+
+    async def fetchrow(self, query, *args):
+        return await self._db.run("fetchrow", query, args)
+
+    async def fetchval(self, query, *args):
+        row = await self._db.run("fetchval", query, args)
+        return next(iter(row.values())) if isinstance(row, dict) else row
+
+    async def fetch(self, query, *args):
+        return await self._db.run("fetch", query, args)
+
+    async def execute(self, query, *args):
+        await self._db.run("execute", query, args)
+        return "OK"
+
+    async def copy_records_to_table(self, table, records, columns):
+        await asyncio.sleep(self._db.latency)
+        if table != "xp_events":
+            raise NotImplementedError(f"COPY a {table} no soportado por la DB en memoria")
+        self._db.xp_events.extend(records)
+
+
+class FakePool:
+    """Pool con el mismo tamaño que el real, para que también se note la espera por conexión."""
+
+    def __init__(self, db, max_size=10):
+        self._db = db
+        self._slots = asyncio.Semaphore(max_size)
+        self._max_size = max_size
+
+    async def acquire(self):
+        await self._slots.acquire()
+        return FakeConnection(self._db)
+
+    async def release(self, connection):
+        self._slots.release()
+
+    def get_size(self):
+        return self._max_size
+
+    def get_idle_size(self):
+        return self._slots._value
+
+    async def close(self):
+        pass
+
+
+# --- Generación de la carga ---
+
+def build_stream(args, guild, rng):
+    members = [FakeMember(args.user_id_base + i, guild) for i in range(args.users)]
+    guild.member_count = len(members)
+    # Con --skew > 0 unos pocos usuarios escriben mucho más que el resto (tipo Zipf).
+    weights = [1 / (rank + 1) ** args.skew for rank in range(len(members))]
+    channel = guild.text_channels[1]
+    authors = rng.choices(members, weights=weights, k=args.messages)
+    stream = []
+    for author in authors:
+        content = "RUTINA HECHA! 💪" if rng.random() < args.rutina_ratio else "mensaje de prueba"
+        attachments = [FakeAttachment()] if rng.random() < args.attachment_ratio else []
+        stream.append(FakeMessage(author, content, attachments, channel))
+    return stream
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(args):
+    import bot as bot_module
+    import config
+    import metrics
+    from xp_buffer import XPWriteBuffer
+    from xp_cooldown import XPCooldown
+    from xp_ledger import XPLedger
+
+    rng = random.Random(args.seed)
+    discord_latency = args.discord_latency_ms / 1000
+
+    if args.dsn:
+        import asyncpg
+        raw_pool = await asyncpg.create_pool(dsn=args.dsn, min_size=1, max_size=args.pool_size)
+    else:
+        raw_pool = FakePool(FakeDatabase(args.db_latency_ms / 1000), max_size=args.pool_size)
+    pool = metrics.InstrumentedPool(raw_pool, query_names=QUERY_NAMES)
+    bot_module.db_pool = pool
+    bot_module.repo = Repository(pool)
+    if args.dsn:
+        from migrations import run_migrations
+        async with pool.acquire() as connection:
+            await run_migrations(connection)
+
+    bot_module.user_cache.clear()
+    bot_module.xp_cooldown = XPCooldown(args.xp_cooldown, max_size=config.XP_COOLDOWN_MAX_USERS)
+    bot_module.xp_ledger = XPLedger(pool, max_pending=config.XP_LEDGER_MAX_PENDING)
+    bot_module.xp_buffer = (
+        XPWriteBuffer(pool, bot_module.get_level, max_pending=config.XP_FLUSH_MAX_PENDING, cache=bot_module.user_cache)
+        if args.write_behind else None
+    )
+
+    bot_module.dispatcher.start()
+
+    async def no_commands(message):
+        pass
+    bot_module.bot.process_commands = no_commands  # Solo medimos el XP, no los comandos
+
+    guild = FakeGuild(1, bot_module.role_registry.level_names[1:], discord_latency)
+    stream = build_stream(args, guild, rng)
+
+    latencies = []
+
+    async def handle(message):
+        start = time.perf_counter()
+        await bot_module.on_message(message)
+        latencies.append(time.perf_counter() - start)
+
+    queries_before = metrics.DB_QUERIES.total()
+    trips_before = metrics.DB_ROUND_TRIPS_PER_MESSAGE.summary()
+    acquire_before = metrics.DB_POOL_ACQUIRE_SECONDS.summary()
+
+    started = time.perf_counter()
+    tasks = []
+    for i, message in enumerate(stream):
+        if args.rate:
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        # Igual que discord.py: cada evento en su propia tarea.
+        tasks.append(asyncio.create_task(handle(message)))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+
+    inline_queries = metrics.DB_QUERIES.total() - queries_before
+    # Los cambios de rol y los anuncios salen después, por el dispatcher.
+    await bot_module.dispatcher.drain()
+    await bot_module.dispatcher.stop()
+    # Lo que queda en memoria también cuesta consultas: lo volcamos y lo contamos aparte.
+    if bot_module.xp_buffer:
+        await bot_module.xp_buffer.close()
+    await bot_module.xp_ledger.close()
+    total_queries = metrics.DB_QUERIES.total() - queries_before
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    trips_count, trips_sum = metrics.DB_ROUND_TRIPS_PER_MESSAGE.summary()
+    acquire_count, acquire_sum = metrics.DB_POOL_ACQUIRE_SECONDS.summary()
+    trips_count -= trips_before[0]
+    trips_sum -= trips_before[1]
+    acquire_count -= acquire_before[0]
+    acquire_sum -= acquire_before[1]
+    latencies.sort()
+    await raw_pool.close()
+
+    return {
+        "messages": len(stream),
+        "errors": len(errors),
+        "first_error": repr(errors[0]) if errors else None,
+        "elapsed_seconds": round(elapsed, 4),
+        "throughput_msgs_per_second": round(len(stream) / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        },
+        "db_round_trips_per_message": round(trips_sum / trips_count, 3) if trips_count else 0.0,
+        "db_queries_inline": inline_queries,
+        "db_queries_total": total_queries,
+        "db_queries_per_message_total": round(total_queries / len(stream), 3) if stream else 0.0,
+        "pool_acquire_wait_ms_mean": round(acquire_sum / acquire_count * 1000, 3) if acquire_count else 0.0,
+        "role_edits": guild.role_edits,
+        "level_up_announcements": guild.text_channels[0].sent,
+        "xp_cooldown_blocked": bot_module.xp_cooldown.blocked,
+        "user_cache": bot_module.user_cache.stats(),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline de mensajes y XP.")
+    parser.add_argument("--messages", type=int, default=5000, help="Mensajes a enviar.")
+    parser.add_argument("--rate", type=float, default=0, help="Mensajes por segundo (0 = todos de golpe).")
+    parser.add_argument("--users", type=int, default=200, help="Usuarios distintos.")
+    parser.add_argument("--skew", type=float, default=1.0, help="Concentración de mensajes en pocos usuarios (0 = uniforme).")
+    parser.add_argument("--attachment-ratio", type=float, default=0.1, help="Fracción de mensajes con adjunto.")
+    parser.add_argument("--rutina-ratio", type=float, default=0.05, help="Fracción de mensajes con 'RUTINA HECHA!'.")
+    parser.add_argument("--write-behind", action="store_true", help="Usar el buffer de XP en memoria.")
+    parser.add_argument("--xp-cooldown", type=int, default=None,
+                        help="Segundos de ventana del XP base (por defecto, XP_COOLDOWN_SECONDS; 0 = sin ventana).")
+    parser.add_argument("--dsn", help="Postgres de pruebas (por defecto, DB en memoria). ¡No uses la de producción!")
+    parser.add_argument("--pool-size", type=int, default=10, help="Conexiones máximas del pool.")
+    parser.add_argument("--db-latency-ms", type=float, default=1.0, help="Latencia simulada por consulta (solo DB en memoria).")
+    parser.add_argument("--discord-latency-ms", type=float, default=50.0, help="Latencia simulada de la API de Discord.")
+    parser.add_argument("--user-id-base", type=int, default=900_000_000_000_000_000, help="Primer user_id sintético.")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--label", default="", help="Etiqueta libre para identificar la ejecución.")
+    parser.add_argument("--output", help="Fichero JSON de salida (por defecto, bench_results/pipeline-<fecha>.json).")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.xp_cooldown is None:
+        import config
+        args.xp_cooldown = config.XP_COOLDOWN_SECONDS
+    results = asyncio.run(run_benchmark(args))
+    report = {
+        "benchmark": "pipeline",
+        "label": args.label,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "python": sys.version.split()[0],
+        "params": {key: value for key, value in vars(args).items() if key not in ("output", "dsn")},
+        "backend": "postgres" if args.dsn else "memory",
+        "results": results,
+    }
+
+    output = Path(args.output) if args.output else (
+        ROOT / "bench_results" / f"pipeline-{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+
+    latency = results["latency_ms"]
+    print(
+        f"{results['messages']} mensajes en {results['elapsed_seconds']}s "
+        f"({results['throughput_msgs_per_second']} msg/s, {results['errors']} errores)\n"
+        f"latencia p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms\n"
+        f"round trips por mensaje: {results['db_round_trips_per_message']} en línea, "
+        f"{results['db_queries_per_message_total']} contando volcados\n"
+        f"Resultados guardados en {output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Comprueba con EXPLAIN que las consultas frecuentes usan índices.
+
+Crea un esquema temporal, aplica las migraciones, lo llena con muchas filas sintéticas y
+falla (código de salida 1) si el plan de alguna consulta caliente hace un Seq Scan.
+El esquema se borra al terminar, así que se puede apuntar a cualquier base de datos de pruebas.
+
+    python scripts/check_query_plans.py --dsn postgresql://localhost/calistenico_dev
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault("ADMIN_ROLE_ID", "0")
+
+import asyncpg  # noqa: E402
+
+import config  # noqa: E402
+from campaigns import INACTIVE_USERS_QUERY, MARK_NUDGED_QUERY  # noqa: E402
+from class_scheduler import CLAIM_REMINDER_QUERIES, NEW_CLASSES_QUERY, SCHEDULE_QUERY  # noqa: E402
+from migrations import run_migrations  # noqa: E402
+from repository import UPSERT_XP_QUERY, USER_QUERY, USER_RANK_QUERY, WEEKLY_TOP_QUERY  # noqa: E402
+from weeks import get_week_start  # noqa: E402
+
+SCRATCH_SCHEMA = "query_plan_check"
+SEED_GUILDS = 5
+
+# La mayoría de usuarios escribió hace poco y solo unos pocos están inactivos, como en producción.
+# Las clases son casi todas futuras: las pasadas se borran en cuanto expiran.
+# Las filas se reparten entre SEED_GUILDS servidores.
+SEED_STATEMENTS = [
+    """
+    WITH seed AS (SELECT g, (random() * 20000)::int AS xp FROM generate_series(1, {rows}) AS g)
+    INSERT INTO users (guild_id, user_id, xp, level, last_message_timestamp, last_rutina_date,
+                       last_attachment_date, attachments_today)
+    SELECT g % {guilds} + 1, g, xp, xp / {xp_per_level} + 1,
+           NOW() - CASE WHEN g % 50 = 0 THEN INTERVAL '30 days' ELSE random() * INTERVAL '3 days' END,
+           CURRENT_DATE - (g % 7), CURRENT_DATE - (g % 5), g % 4
+    FROM seed
+    """,
+    """
+    INSERT INTO weekly_xp (guild_id, week_start, user_id, xp)
+    SELECT g % {guilds} + 1, w.week_start, g, CASE WHEN g % 10 = 0 THEN 0 ELSE (random() * 2000)::int END
+    FROM generate_series(1, {rows}) AS g,
+         (SELECT (date_trunc('week', NOW()) - n * INTERVAL '7 days')::date AS week_start
+          FROM generate_series(0, 7) AS n) AS w
+    WHERE g % 3 <> 0 OR w.week_start = date_trunc('week', NOW())::date
+    """,
+    """
+    INSERT INTO clases (guild_id, tipo, fecha_hora)
+    SELECT g % {guilds} + 1, CASE WHEN g % 2 = 0 THEN 'gratis' ELSE 'premium' END,
+           NOW() + (g - {rows} / 1000) * INTERVAL '10 minutes'
+    FROM generate_series(1, {rows}) AS g
+    """,
+]
+
+
+def hot_queries(rows):
+    """(nombre, consulta, parámetros) de las consultas que se ejecutan a menudo."""
+    now = datetime.now(timezone.utc)
+    today = now.date()
+    week_start = get_week_start(today)
+    user_id = rows // 2
+    guild_id = user_id % SEED_GUILDS + 1
+    return [
+        ("usuario por id", USER_QUERY, [guild_id, user_id]),
+        ("sumar XP", UPSERT_XP_QUERY, [
+            guild_id, user_id, config.XP_PER_MESSAGE, True, True, today, now, config.XP_RUTINA_HECHA,
+            config.XP_ATTACHMENT, config.MAX_ATTACHMENTS_PER_DAY, config.XP_PER_LEVEL, week_start,
+        ]),
+        ("top semanal", WEEKLY_TOP_QUERY, [guild_id, week_start]),
+        ("puesto en el ranking", USER_RANK_QUERY, [guild_id, user_id, week_start]),
+        ("usuarios inactivos", INACTIVE_USERS_QUERY, [guild_id, now - timedelta(days=config.INACTIVITY_DAYS)]),
+        ("marcar avisados", MARK_NUDGED_QUERY, [guild_id, [user_id, user_id + SEED_GUILDS], now]),
+        ("horario de !clases", SCHEDULE_QUERY, [guild_id, now, config.CLASES_LIST_LIMIT]),
+        ("borrar clases pasadas", "DELETE FROM clases WHERE fecha_hora < $1", [now]),
+        ("reclamar aviso de clase", CLAIM_REMINDER_QUERIES["24h"], [1]),
+        ("clases nuevas", NEW_CLASSES_QUERY, [rows - 10, now]),
+    ]
+
+
+def seq_scans(plan):
+    """Tablas que el plan recorre enteras."""
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        found.extend(seq_scans(child))
+    return found
+
+
+async def check(dsn, rows, keep):
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE")
+        await conn.execute(f"CREATE SCHEMA {SCRATCH_SCHEMA}")
+        await conn.execute(f"SET search_path TO {SCRATCH_SCHEMA}")
+        await run_migrations(conn)
+
+        print(f"Sembrando {rows} filas por tabla en el esquema {SCRATCH_SCHEMA}...")
+        for statement in SEED_STATEMENTS:
+            await conn.execute(statement.format(rows=rows, guilds=SEED_GUILDS, xp_per_level=config.XP_PER_LEVEL))
+        # Estadísticas y mapa de visibilidad al día, como tras el autovacuum en producción.
+        for table in ("users", "weekly_xp", "clases"):
+            await conn.execute(f"VACUUM ANALYZE {table}")
+
+        failures = 0
+        for name, query, args in hot_queries(rows):
+            plan = json.loads(await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args))[0]["Plan"]
+            scanned = seq_scans(plan)
+            status = "❌ Seq Scan en " + ", ".join(scanned) if scanned else "✅"
+            print(f"{status:<30} {name} (coste {plan['Total Cost']:.0f})")
+            if scanned:
+                failures += 1
+                print(json.dumps(plan, indent=2))
+        return failures
+    finally:
+        if not keep:
+            await conn.execute(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE")
+        await conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Falla si alguna consulta frecuente hace un Seq Scan.")
+    # Sin valor por defecto a propósito: el script siembra cientos de miles de filas y no debe
+    # poder acabar en la base de datos de producción por olvidar el argumento.
+    parser.add_argument("--dsn", required=True, help="Base de datos de pruebas (no la de producción).")
+    parser.add_argument("--rows", type=int, default=200_000, help="Filas sintéticas por tabla.")
+    parser.add_argument("--keep", action="store_true", help="No borrar el esquema temporal al terminar.")
+    args = parser.parse_args(argv)
+    if config.DATABASE_URL and args.dsn == config.DATABASE_URL:
+        parser.error("--dsn es DATABASE_URL (producción): usa una base de datos de pruebas.")
+
+    failures = asyncio.run(check(args.dsn, args.rows, args.keep))
+    if failures:
+        print(f"\n{failures} consultas frecuentes no usan índices.")
+        sys.exit(1)
+    print("\nTodas las consultas frecuentes usan índices.")
+
+
+if __name__ == "__main__":
+    main()
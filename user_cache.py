@@ -0,0 +1,99 @@
+import time
+from collections import OrderedDict
+
+
+class UserRecord:
+    """
+    Copia compacta de una fila de `users` (un usuario dentro de un servidor).
+    Admite record['xp'] igual que un asyncpg.Record para no cambiar a quien la usa.
+    """
+    FIELDS = (
+        "user_id", "xp", "level", "last_message_timestamp",
+        "last_rutina_date", "last_attachment_date", "attachments_today",
+    )
+    __slots__ = ("guild_id",) + FIELDS + ("expires_at",)
+
+    def __init__(self, guild_id, user_id, xp=0, level=1, last_message_timestamp=None,
+                 last_rutina_date=None, last_attachment_date=None, attachments_today=0):
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.xp = xp
+        self.level = level
+        self.last_message_timestamp = last_message_timestamp
+        self.last_rutina_date = last_rutina_date
+        self.last_attachment_date = last_attachment_date
+        self.attachments_today = attachments_today
+        self.expires_at = 0.0
+
+    @classmethod
+    def from_row(cls, guild_id, user_id, row):
+        """Construye el registro a partir de cualquier fila que tenga las columnas de `users`."""
+        return cls(guild_id, user_id, **{field: row[field] for field in cls.FIELDS[1:]})
+
+    @property
+    def key(self):
+        return (self.guild_id, self.user_id)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+class UserCache:
+    """
+    Caché LRU con caducidad de los usuarios que más escriben, por (guild_id, user_id).
+    Cuando se llena, expulsa al que lleva más tiempo sin usarse.
+    """
+
+    def __init__(self, max_size=5000, ttl=300):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, key):
+        record = self._records.get(key)
+        if record is None:
+            self.misses += 1
+            return None
+        if record.expires_at < time.monotonic():
+            del self._records[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._records.move_to_end(key)
+        self.hits += 1
+        return record
+
+    def put(self, record):
+        record.expires_at = time.monotonic() + self._ttl
+        self._records[record.key] = record
+        self._records.move_to_end(record.key)
+        while len(self._records) > self._max_size:
+            self._records.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._records.pop(key, None)
+
+    def clear(self):
+        self._records.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._records),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,6 @@
+from datetime import timedelta
+
+
+def get_week_start(day):
+    # El XP semanal se guarda por semana (lunes a domingo, UTC): no hay que resetear nada.
+    return day - timedelta(days=day.weekday())
@@ -0,0 +1,189 @@
+import asyncio
+import time
+from datetime import timedelta
+
+import config
+from user_cache import UserRecord
+
+# Un único INSERT ... ON CONFLICT para todos los usuarios pendientes (y su XP semanal).
+# Los arrays se pasan en paralelo y UNNEST los convierte en filas.
+FLUSH_QUERY = """
+    WITH weekly AS (
+        INSERT INTO weekly_xp (guild_id, week_start, user_id, xp)
+        SELECT pending.guild_id, $10::date, pending.user_id, pending.xp
+        FROM UNNEST($1::bigint[], $2::bigint[], $3::int[]) AS pending(guild_id, user_id, xp)
+        WHERE pending.xp <> 0
+        ON CONFLICT (guild_id, week_start, user_id) DO UPDATE SET xp = weekly_xp.xp + EXCLUDED.xp
+    )
+    INSERT INTO users AS u (guild_id, user_id, xp, level, last_message_timestamp,
+                            last_rutina_date, last_attachment_date, attachments_today)
+    SELECT * FROM UNNEST($1::bigint[], $2::bigint[], $3::int[], $4::int[], $5::timestamptz[],
+                         $6::date[], $7::date[], $8::int[])
+    ON CONFLICT (guild_id, user_id) DO UPDATE SET
+        xp = u.xp + EXCLUDED.xp,
+        level = (u.xp + EXCLUDED.xp) / $9::int + 1,
+        last_message_timestamp = GREATEST(u.last_message_timestamp, EXCLUDED.last_message_timestamp),
+        last_rutina_date = GREATEST(u.last_rutina_date, EXCLUDED.last_rutina_date),
+        last_attachment_date = COALESCE(EXCLUDED.last_attachment_date, u.last_attachment_date),
+        attachments_today = CASE
+            WHEN EXCLUDED.last_attachment_date IS NULL THEN u.attachments_today
+            ELSE EXCLUDED.attachments_today
+        END;
+"""
+
+
+class _UserState:
+    """
+    Vista en memoria de un usuario: lo que hay en la DB más lo que aún no se ha volcado.
+    """
+    __slots__ = (
+        "xp", "level", "last_rutina_date", "last_attachment_date", "attachments_today",
+        "last_message_timestamp", "pending_xp", "dirty", "touched",
+    )
+
+    def __init__(self, row):
+        self.xp = row['xp'] if row else 0
+        self.level = row['level'] if row else 1
+        self.last_rutina_date = row['last_rutina_date'] if row else None
+        self.last_attachment_date = row['last_attachment_date'] if row else None
+        self.attachments_today = row['attachments_today'] if row else 0
+        self.last_message_timestamp = row['last_message_timestamp'] if row else None
+        self.pending_xp = 0
+        self.dirty = False
+        self.touched = time.monotonic()
+
+
+class XPWriteBuffer:
+    """
+    Acumula el XP de los mensajes en memoria y lo escribe en bloque en la DB.
+    Se vuelca cada vez que se llama a flush() (lo hace una tarea periódica del bot)
+    o en cuanto se juntan `max_pending` eventos sin guardar.
+    """
+
+    def __init__(self, pool, level_fn, max_pending=200, idle_seconds=600, cache=None):
+        self._pool = pool
+        self._cache = cache
+        self._level_fn = level_fn
+        self._max_pending = max_pending
+        self._idle_seconds = idle_seconds
+        self._states = {}
+        self._pending_events = 0
+        self._flush_lock = asyncio.Lock()
+        self._week_start = None  # Semana a la que pertenece el XP pendiente
+        self._flush_task = None
+
+    @property
+    def pending_events(self):
+        return self._pending_events
+
+    async def record(self, guild_id, user_id, loader, base_xp, wants_rutina, has_attachment, today, now_ts,
+                     rutina_xp=config.XP_RUTINA_HECHA, attachment_xp=config.XP_ATTACHMENT):
+        """
+        Aplica las reglas de XP sobre la vista en memoria y devuelve
+        (nivel_anterior, nivel_nuevo, bonus_rutina, bonus_adjunto).
+        `loader(guild_id, user_id)` solo se usa la primera vez que vemos al usuario en ese servidor.
+        """
+        week_start = today - timedelta(days=today.weekday())
+        if week_start != self._week_start:
+            # Cambió la semana: lo pendiente se guarda en la anterior antes de seguir sumando.
+            if self._pending_events:
+                await self.flush()
+            self._week_start = week_start
+
+        key = (guild_id, user_id)
+        state = self._states.get(key)
+        if state is None:
+            row = await loader(guild_id, user_id)
+            # Otro mensaje del mismo usuario pudo cargarlo mientras esperábamos a la DB.
+            state = self._states.get(key)
+            if state is None:
+                state = _UserState(row)
+                self._states[key] = state
+
+        old_level = state.level
+        gained = base_xp
+        rutina_granted = attachment_granted = False
+
+        if wants_rutina and state.last_rutina_date != today:
+            gained += rutina_xp
+            state.last_rutina_date = today
+            rutina_granted = True
+
+        if has_attachment:
+            if state.last_attachment_date != today:
+                state.attachments_today = 0
+                state.last_attachment_date = today
+            if state.attachments_today < config.MAX_ATTACHMENTS_PER_DAY:
+                gained += attachment_xp
+                state.attachments_today += 1
+                attachment_granted = True
+
+        state.xp += gained
+        state.pending_xp += gained
+        state.level = max(state.level, self._level_fn(state.xp))
+        state.last_message_timestamp = now_ts
+        state.dirty = True
+        state.touched = time.monotonic()
+
+        if self._cache is not None:
+            self._cache.put(UserRecord(
+                guild_id, user_id, state.xp, state.level, state.last_message_timestamp,
+                state.last_rutina_date, state.last_attachment_date, state.attachments_today
+            ))
+
+        self._pending_events += 1
+        if self._pending_events >= self._max_pending and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+        return old_level, state.level, rutina_granted, attachment_granted
+
+    async def flush(self):
+        """
+        Escribe todos los usuarios con cambios en un solo round trip.
+        Si la escritura falla, los deltas se devuelven a la vista para el siguiente intento.
+        """
+        async with self._flush_lock:
+            batch = [(key, state, state.pending_xp) for key, state in self._states.items() if state.dirty]
+            if not batch:
+                return 0
+
+            columns = ([], [], [], [], [], [], [], [])
+            for (guild_id, user_id), state, delta in batch:
+                columns[0].append(guild_id)
+                columns[1].append(user_id)
+                columns[2].append(delta)
+                columns[3].append(state.level)
+                columns[4].append(state.last_message_timestamp)
+                columns[5].append(state.last_rutina_date)
+                columns[6].append(state.last_attachment_date)
+                columns[7].append(state.attachments_today)
+                state.pending_xp = 0
+                state.dirty = False
+            self._pending_events = 0
+
+            try:
+                async with self._pool.acquire() as conn:
+                    await conn.execute(FLUSH_QUERY, *columns, config.XP_PER_LEVEL, self._week_start)
+            except Exception as e:
+                for _, state, delta in batch:
+                    state.pending_xp += delta
+                    state.dirty = True
+                    self._pending_events += 1
+                print(f"❌ ERROR al volcar el XP acumulado ({len(batch)} usuarios): {e}")
+                return 0
+
+            self._prune()
+            return len(batch)
+
+    async def close(self):
+        """Vuelca lo pendiente antes de apagar el bot."""
+        if self._flush_task and not self._flush_task.done():
+            await self._flush_task
+        await self.flush()
+
+    def _prune(self):
+        # Olvidamos a los usuarios ya guardados que llevan un rato sin escribir.
+        limit = time.monotonic() - self._idle_seconds
+        stale = [key for key, state in self._states.items() if not state.dirty and state.touched < limit]
+        for key in stale:
+            del self._states[key]
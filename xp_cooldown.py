@@ -0,0 +1,35 @@
+import time
+from collections import OrderedDict
+
+
+class XPCooldown:
+    """
+    Ventana por usuario (y servidor) para el XP base de los mensajes: como mucho una vez cada `seconds`.
+    Vive solo en memoria y se consulta antes de tocar la DB. Cuando se llena, olvida primero
+    a quien lleva más tiempo sin ganar XP (normalmente, alguien cuya ventana ya pasó).
+    """
+    __slots__ = ("seconds", "max_size", "_last_award", "blocked")
+
+    def __init__(self, seconds=60, max_size=50000):
+        self.seconds = seconds
+        self.max_size = max_size
+        self._last_award = OrderedDict()  # (guild_id, user_id) -> time.monotonic() del último XP base
+        self.blocked = 0
+
+    def __len__(self):
+        return len(self._last_award)
+
+    def allow(self, key, now=None):
+        """True si a `key` (guild_id, user_id) le toca XP base ahora (y lo apunta); False si sigue en la ventana."""
+        if self.seconds <= 0:
+            return True
+        now = time.monotonic() if now is None else now
+        last = self._last_award.get(key)
+        if last is not None and now - last < self.seconds:
+            self.blocked += 1
+            return False
+        self._last_award[key] = now
+        self._last_award.move_to_end(key)
+        while len(self._last_award) > self.max_size:
+            self._last_award.popitem(last=False)
+        return True
@@ -0,0 +1,134 @@
+import asyncio
+
+# Motivos válidos de un movimiento de XP. "opening" es el saldo inicial de cada usuario
+# que ya tenía XP antes de existir el registro; "backfill", el importado de mensajes antiguos.
+XP_REASONS = ("message", "rutina", "attachment", "admin", "opening", "backfill")
+
+EVENT_COLUMNS = ["guild_id", "user_id", "amount", "reason", "created_at"]
+
+# Suma al resumen diario el siguiente lote de eventos por encima de la marca y la avanza, todo en
+# la misma sentencia. Los eventos se ordenan por la transacción que los insertó (tx_id, id), y
+# solo entran los de transacciones anteriores al xmin de la instantánea: esas ya terminaron, así
+# que ningún evento puede aparecer después por debajo de la marca. Un evento confirmado tarde
+# (otra réplica, el volcado diferido o la importación histórica) espera a que su transacción
+# quede atrás y entra en un lote posterior. El FOR UPDATE sobre la marca evita que dos
+# resúmenes a la vez sumen el mismo lote.
+ROLLUP_QUERY = """
+    WITH state AS (
+        SELECT last_tx_id, last_event_id FROM xp_rollup_state WHERE id = 1 FOR UPDATE
+    ), batch AS (
+        SELECT e.id, e.tx_id, e.guild_id, e.user_id, e.amount, e.created_at
+        FROM xp_events e, state s
+        WHERE (e.tx_id, e.id) > (s.last_tx_id, s.last_event_id)
+          AND e.tx_id < pg_snapshot_xmin(pg_current_snapshot())
+        ORDER BY e.tx_id, e.id
+        LIMIT $1
+    ), daily AS (
+        INSERT INTO xp_daily (guild_id, day, user_id, xp, events)
+        SELECT guild_id, (created_at AT TIME ZONE 'UTC')::date, user_id, SUM(amount), COUNT(*)
+        FROM batch
+        GROUP BY 1, 2, 3
+        ON CONFLICT (guild_id, day, user_id) DO UPDATE SET
+            xp = xp_daily.xp + EXCLUDED.xp,
+            events = xp_daily.events + EXCLUDED.events
+    ), mark AS (
+        UPDATE xp_rollup_state r SET last_tx_id = last.tx_id, last_event_id = last.id
+        FROM (SELECT tx_id, id FROM batch ORDER BY tx_id DESC, id DESC LIMIT 1) last
+        WHERE r.id = 1
+    )
+    SELECT COUNT(*) FROM batch
+"""
+
+# XP de cada usuario del servidor según el registro: el resumen diario más los eventos
+# guardados por encima de la marca, que aún no se han resumido.
+LEDGER_TOTALS = """
+    SELECT user_id, SUM(xp) AS xp FROM (
+        SELECT user_id, xp FROM xp_daily WHERE guild_id = $1
+        UNION ALL
+        SELECT e.user_id, e.amount FROM xp_events e, xp_rollup_state s
+        WHERE s.id = 1 AND e.guild_id = $1 AND (e.tx_id, e.id) > (s.last_tx_id, s.last_event_id)
+    ) ledger
+    GROUP BY user_id
+"""
+
+# Usuarios del servidor cuyo XP total no coincide con el registro.
+AUDIT_QUERY = f"""
+    SELECT u.user_id, u.xp, COALESCE(d.xp, 0) AS ledger_xp
+    FROM users u
+    LEFT JOIN ({LEDGER_TOTALS}) d USING (user_id)
+    WHERE u.guild_id = $1 AND u.xp <> COALESCE(d.xp, 0)
+    ORDER BY ABS(u.xp - COALESCE(d.xp, 0)) DESC
+    LIMIT $2
+"""
+
+# Reconstruye xp y level de los usuarios del servidor a partir del registro.
+REBUILD_QUERY = f"""
+    UPDATE users u
+    SET xp = d.xp, level = d.xp / $2::int + 1
+    FROM ({LEDGER_TOTALS}) d
+    WHERE u.guild_id = $1 AND u.user_id = d.user_id AND u.xp <> d.xp
+"""
+
+
+class XPLedger:
+    """
+    Registro de solo escritura de cada movimiento de XP.
+    Los eventos se juntan en memoria y se guardan por lotes con COPY.
+    """
+
+    def __init__(self, pool, max_pending=500):
+        self._pool = pool
+        self._max_pending = max_pending
+        self._pending = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    @property
+    def pending_events(self):
+        return len(self._pending)
+
+    def add(self, guild_id, user_id, amount, reason, created_at):
+        if not amount:
+            return
+        self._pending.append((guild_id, user_id, amount, reason, created_at))
+        if len(self._pending) >= self._max_pending and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, []
+            try:
+                async with self._pool.acquire() as conn:
+                    await conn.copy_records_to_table("xp_events", records=batch, columns=EVENT_COLUMNS)
+            except Exception as e:
+                # Los devolvemos delante para conservar el orden en el siguiente intento.
+                self._pending[:0] = batch
+                print(f"❌ ERROR al guardar {len(batch)} eventos de XP: {e}")
+                return 0
+            return len(batch)
+
+    async def close(self):
+        if self._flush_task and not self._flush_task.done():
+            await self._flush_task
+        await self.flush()
+
+    async def rollup(self, batch_size=50000):
+        """Actualiza xp_daily con los eventos ya cerrados por encima de la marca. Devuelve cuántos se procesaron."""
+        processed = 0
+        async with self._pool.acquire() as conn:
+            while True:
+                count = await conn.fetchval(ROLLUP_QUERY, batch_size)
+                processed += count or 0
+                if not count or count < batch_size:
+                    return processed
+
+    async def audit(self, guild_id, limit=10):
+        async with self._pool.acquire() as conn:
+            return await conn.fetch(AUDIT_QUERY, guild_id, limit)
+
+    async def rebuild_totals(self, guild_id, xp_per_level):
+        async with self._pool.acquire() as conn:
+            status = await conn.execute(REBUILD_QUERY, guild_id, xp_per_level)
+        return int(status.split()[-1])